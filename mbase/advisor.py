@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    索引建议
+    开启后 get_page_items 的每种查询形状执行一次 EXPLAIN FORMAT=JSON,
+    记录访问类型、扫描行数、使用的索引, 标记全表扫描和 filesort, 并给出 Index(...) 建议。
+
+    用法:
+        from mbase.advisor import query_advisor
+        query_advisor.enable()
+        ...
+        print(query_advisor.report())
+'''
+
+import threading
+from typing import List
+
+from mbase.config import MYSQL_EXPLAIN_ADVISOR
+from mbase.db import codec
+from mbase.db.query import INDEX_PREFIX_OPS, INDEX_RANGE_OPS, split_key
+
+
+# 全表扫描 / 全索引扫描
+SCAN_TYPES = ('ALL', 'index')
+
+
+def explain_summary(raw) -> dict:
+    # 解析 EXPLAIN FORMAT=JSON 的结果。 单表查询 取第一个表的信息
+    doc = codec.loads(raw) if isinstance(raw, (str, bytes)) else raw
+    tables = []
+    flags = {'using_filesort': False, 'using_temporary_table': False}
+
+    def walk(node):
+        if isinstance(node, dict):
+            for flag in flags:
+                if node.get(flag):
+                    flags[flag] = True
+            if 'table_name' in node and 'access_type' in node:
+                tables.append(node)
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(doc)
+    table = tables[0] if tables else {}
+    access_type = table.get('access_type', '')
+    return {
+        'access_type': access_type,
+        'key': table.get('key', ''),
+        'possible_keys': table.get('possible_keys', []),
+        'rows_examined': int(table.get('rows_examined_per_scan', 0) or 0),
+        'filtered': float(table.get('filtered', 100) or 100),
+        'full_scan': access_type in SCAN_TYPES,
+        'using_filesort': flags['using_filesort'],
+        'using_temporary_table': flags['using_temporary_table'],
+    }
+
+
+def suggest_index(query_keys: List[str], order_field: str = 'id', pk_name: str = 'id') -> List[str]:
+    # 建议的索引列: 等值/in 列, 然后是排序列或者一个范围列
+    eq_fields = []
+    range_fields = []
+    for key in query_keys:
+        column, op = split_key(key)
+        if op in INDEX_PREFIX_OPS and column not in eq_fields:
+            eq_fields.append(column)
+        elif op in INDEX_RANGE_OPS and column not in range_fields:
+            range_fields.append(column)
+    range_fields = [column for column in range_fields if column not in eq_fields]
+
+    fields = list(eq_fields)
+    if order_field not in ('id', pk_name) and order_field not in fields:
+        # 按映射列排序 排序列放在等值列后面, 索引顺序就是结果顺序
+        fields.append(order_field)
+    elif range_fields:
+        fields.append(range_fields[0])
+    return fields
+
+
+class QueryAdvisor(object):
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # (模型名, SQL) -> 记录。 None 表示正在 EXPLAIN
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.records = {}
+
+    def claim(self, model_name: str, sql: str) -> bool:
+        # 每种查询形状只 EXPLAIN 一次
+        key = (model_name, sql)
+        with self.lock:
+            if key in self.records:
+                return False
+            self.records[key] = None
+            return True
+
+    def release(self, model_name: str, sql: str):
+        # EXPLAIN 失败 放弃占位, 下次同样的查询再 EXPLAIN
+        key = (model_name, sql)
+        with self.lock:
+            if key in self.records and self.records[key] is None:
+                del self.records[key]
+
+    def record(self, model_class, sql: str, query_keys: List[str], order_field: str, raw) -> dict:
+        summary = explain_summary(raw)
+        summary['model'] = model_class.__name__
+        summary['sql'] = sql
+        summary['query_keys'] = list(query_keys)
+        summary['flagged'] = summary['full_scan'] or summary['using_filesort']
+
+        summary['suggestion'] = []
+        if summary['flagged']:
+            fields = suggest_index(query_keys, order_field, model_class.PK_NAME)
+            declared = [tuple(index.field_list[:len(fields)]) for index in model_class.indexes]
+            if fields and tuple(fields) not in declared:
+                summary['suggestion'] = fields
+
+        with self.lock:
+            self.records[(model_class.__name__, sql)] = summary
+        return summary
+
+    def items(self, model_name: str = '') -> List[dict]:
+        with self.lock:
+            records = [record for record in self.records.values() if record]
+        if model_name:
+            records = [record for record in records if record['model'] == model_name]
+        return records
+
+    def report(self, model_name: str = '', flagged_only: bool = False) -> str:
+        # 文本报告 按模型分组, 最后给出建议的 Index 声明
+        lines = []
+        suggestions = {}
+        for record in sorted(self.items(model_name), key=lambda item: (item['model'], -item['rows_examined'])):
+            if flagged_only and not record['flagged']:
+                continue
+            flags = []
+            if record['full_scan']:
+                flags.append('SCAN')
+            if record['using_filesort']:
+                flags.append('FILESORT')
+            lines.append(f"[{record['model']}] {' '.join(flags) or 'OK'} type:{record['access_type']} "
+                         f"key:{record['key'] or '-'} rows:{record['rows_examined']}")
+            lines.append(f"    {record['sql']}")
+            if record['suggestion']:
+                suggestions.setdefault(record['model'], [])
+                if record['suggestion'] not in suggestions[record['model']]:
+                    suggestions[record['model']].append(record['suggestion'])
+
+        for model, index_list in suggestions.items():
+            lines.append(f'class {model}:')
+            for fields in index_list:
+                args = ', '.join([f"'{field}'" for field in fields])
+                lines.append(f"    idx_{'_'.join(fields)} = Index({args})")
+        return '\n'.join(lines)
+
+
+query_advisor = QueryAdvisor(MYSQL_EXPLAIN_ADVISOR)
@@ -7,25 +7,44 @@
     @Time    : 2021-11-24
 '''
 
+import asyncio
 import time
+from contextlib import asynccontextmanager
 
-from typing import List
+from typing import Iterable, List, Optional
 
+from mbase.advisor import query_advisor
+from mbase.db.route import mark_write, use_primary
+from mbase.db.transaction import Transaction, current_transaction
+from mbase.large import LargeNotLoaded, large_table, large_table_sql
+from mbase.partition import PARTITION_TABLES_SQL
+from mbase.shard import amap_shards, merge_items
 
-async def save(self):
-    # 保存数据
-    # 初始化版本信息
-    if 'dver' in self.fields:
-        # 描述符 有默认值。判断有无得从__dict__ 来搞
-        if 'dver' not in self.__dict__:
-            self.dver = 0
-    # 添加时间戳
-    tm = int(time.time() * 1000)
 
-    if 'create_time' in self.fields and 'create_time' not in self.__dict__:
-        self.create_time = tm
-    if 'update_time' in self.fields:
-        self.update_time = tm
+async def save(self, upsert: Optional[bool] = None):
+    # 保存数据
+    # upsert 不传时 使用类配置 UPSERT_SAVE
+    if self.is_loaded() and not self.has_changed():
+        # 加载后没有修改 不需要访问数据库
+        return
+    if self.SHARD and not self.locate_shard():
+        return
+    # 先确定分片 事务按实例所在的库查找
+    tx = current_transaction(self.DB_NAME)
+    if tx and tx.batch and not tx.flushing:
+        # 事务 batch 模式 结束时合并执行
+        tx.add('save', self, upsert)
+        return
+    self.prepare_save()
+    if upsert is None:
+        upsert = self.UPSERT_SAVE
+    if self.multi_table():
+        if not ((await self.locate_partition()) if self.PARTITION else self.locate_shard()):
+            return
+        if self.id and not self.is_loaded():
+            # 插入到分片时要带上主键
+            upsert = True
+    large_values, large_removed = self.large_changes()
 
     if not self.id:
         # 没有主键
@@ -37,9 +56,24 @@ async def save(self):
             # 主键是默认的ID。直接插入
             id = await self.conn.insert(self.DB_NAME, self.TABLE_NAME, self.to_db())
             self.id = id
+            if id > 0:
+                self.mark_loaded()
+    elif self.is_loaded():
+        # 从库里加载的对象 只更新修改过的json路径
+        if not self.check_partial():
+            return
+        set_dict, remove_list, version_field = self.prepare_update()
+        await self.conn.update_fields(self.DB_NAME, self.TABLE_NAME, self.id, set_dict, remove_list, version_field)
+        self.mark_loaded()
+    elif upsert:
+        # 一次往返。 内存里的 dver 不会回写, 以库里的为准
+        version_field = 'dver' if 'dver' in self.fields else ''
+        await self.conn.upsert(self.DB_NAME, self.TABLE_NAME, self.id, self.to_db(), version_field=version_field)
+        self.mark_loaded()
     else:
-        # 更新版本用所以不用再实例化为对象。
-        raw_dict = await self.conn.get_by_pk(self.DB_NAME, self.TABLE_NAME, self.id)
+        # 更新版本用所以不用再实例化为对象。 版本要从主库读
+        with use_primary():
+            raw_dict = await self.conn.get_by_pk(self.DB_NAME, self.TABLE_NAME, self.id)
         if raw_dict:
             # 处理版本信息
             if 'dver' in self.fields:
@@ -52,9 +86,16 @@ async def save(self):
                              self.id,
                              self.to_db(),
                              self.PK_NAME)
+            self.mark_loaded()
         else:
-            # 插入
-            await self.conn.insert(self.DB_NAME, self.TABLE_NAME, self.to_db())
+            # 插入。 库里的行用自增ID
+            id = await self.conn.insert(self.DB_NAME, self.TABLE_NAME, self.to_db())
+            if id > 0:
+                self.id = id
+                self.mark_loaded()
+    self.evict_rows([self.id])
+    if (large_values or large_removed) and self.is_loaded():
+        await self.save_large(large_values, large_removed)
 
 
 async def delete(self):
@@ -62,35 +103,243 @@ async def delete(self):
     if not self.id:
         print('instance no pk')
     else:
-        await self.conn.delete(self.__class__.DB_NAME, self.__class__.TABLE_NAME, self.id)
+        if self.SHARD and not self.locate_shard():
+            return
+        if self.PARTITION and not await self.locate_partition(create=False):
+            print(f'{self.__class__.__name__} partition not exists id:{self.id}')
+            return
+        tx = current_transaction(self.DB_NAME)
+        if tx and tx.batch and not tx.flushing:
+            tx.add('delete', self)
+        else:
+            await self.conn.delete(self.DB_NAME, self.TABLE_NAME, self.id)
+            await self.delete_large_rows(self.DB_NAME, self.TABLE_NAME, [self.id])
+            self.evict_rows([self.id])
         self.id = None
 
 
+async def flush_pending(tx: Transaction):
+    # atomic(batch=True) 结束时 合并执行收集的 save()/delete()
+    saves, inserts, deletes = tx.take_pending()
+    for model_class, instances in inserts.items():
+        await model_class.bulk_create(instances)
+        for instance in instances:
+            if instance.id:
+                instance.mark_loaded()
+    for instance, upsert in saves:
+        await instance.save(upsert)
+    for (model_class, db_name, table_name), pks in deletes.items():
+        await model_class.conn.delete_by_pks(db_name, table_name, pks)
+        await model_class.delete_large_rows(db_name, table_name, pks)
+        model_class.evict_rows(pks)
+
+
+async def save_large(self, values: dict, removed: List[str] = []):
+    # 大字段写入旁表。 和主表不在一个事务里, 需要一致时放在 atomic() 里保存
+    if values:
+        await self.conn.set_large(self.DB_NAME, self.TABLE_NAME, self.large_rows(values))
+    if removed:
+        await self.conn.delete_large(self.DB_NAME, self.TABLE_NAME, [self.id], removed)
+
+
+@classmethod
+async def delete_large_rows(cls, db_name: str, table_name: str, pks: list):
+    if cls.LARGE_FIELDS and pks:
+        await cls.conn.delete_large(db_name, table_name, pks)
+
+
+async def load_large(self, names: List[str] = []):
+    # 加载大字段。 names 为空时加载全部
+    pending = [name for name in self.large_pending() if not names or name in names]
+    if not pending or not self.id:
+        return
+    rows = await self.conn.get_large(self.DB_NAME, self.TABLE_NAME, [self.id], pending)
+    self.apply_large(pending, rows.get(self.id, {}))
+
+
+def access_large(self, name: str):
+    # 异步模型不能在属性访问时查库
+    raise LargeNotLoaded(f'{self.__class__.__name__} large field:{name} not loaded, await load_large() first')
+
+
+@classmethod
+async def load_large_many(cls, instances: list):
+    # 批量加载多个实例的大字段。 不同的表并发查询
+    groups = {}
+    for instance in instances:
+        if instance.large_pending():
+            groups.setdefault((instance.DB_NAME, instance.TABLE_NAME), []).append(instance)
+    groups = list(groups.items())
+    results = await asyncio.gather(*[cls.conn.get_large(db_name, table_name, [item.id for item in items])
+                                     for (db_name, table_name), items in groups])
+    for (_, items), rows in zip(groups, results):
+        for item in items:
+            item.apply_large(item.large_pending(), rows.get(item.id, {}))
+
+
+@classmethod
+@asynccontextmanager
+async def atomic(cls, db_name: str = '', batch: bool = False):
+    # 事务 async with App.atomic(): ...  不传 db_name 使用模型的库
+    # batch 作用域内的 save()/delete() 先收集, 结束时合并成批量语句。 新对象的 id 结束后才有
+    async with cls.conn.atomic(db_name or cls.DB_NAME) as tx:
+        if tx and batch:
+            tx.batch = True
+            tx.flush = flush_pending
+        yield tx
+
+
+async def locate_partition(self, create: bool = True) -> bool:
+    # 分区模型 确定实例所在的表, 保存在实例上覆盖类属性。 分区不存在时 create 为真就创建
+    if 'TABLE_NAME' in self.__dict__:
+        return True
+    suffix = self.partition_of()
+    if not suffix:
+        print(f'{self.__class__.__name__} partition unknown id:{self.id} field:{self.PARTITION.field}')
+        return False
+    if suffix not in await self.partition_suffixes(wanted=[suffix]):
+        if not create:
+            return False
+        await self.create_partition(suffix)
+    self.__dict__['TABLE_NAME'] = self.PARTITION.table_name(self.TABLE_NAME, suffix)
+    return True
+
+
+@classmethod
+async def partition_suffixes(cls, refresh: bool = False, wanted: Iterable[str] = ()) -> List[str]:
+    # 库里已有的分区月份 从旧到新。 缓存 PARTITION_CACHE_TTL 秒
+    # 用到的分区(wanted, 当前月份)不在缓存里时 提前重新查询
+    expire, suffixes = cls.PARTITION_TABLES
+    if refresh or expire < time.time() or cls.partition_missed(wanted):
+        rows = await cls.conn.raw_query(cls.DB_NAME, PARTITION_TABLES_SQL, (f'{cls.TABLE_NAME}\\_%',), read=True)
+        suffixes = cls.PARTITION.parse_tables(cls.TABLE_NAME, [row[0] for row in rows])
+        cls.PARTITION_TABLES = (time.time() + cls.PARTITION_CACHE_TTL, suffixes)
+    return suffixes
+
+
+@classmethod
+async def create_partition(cls, suffix: str) -> str:
+    # 按模板表创建分区表
+    # DDL 会隐式提交事务 用单独的连接执行
+    table_name = cls.PARTITION.table_name(cls.TABLE_NAME, suffix)
+    sqls = cls.PARTITION.create_sqls(cls.TABLE_NAME, suffix)
+    if cls.LARGE_FIELDS:
+        sqls.append(large_table_sql(table_name))
+    await cls.conn.run_ddl(cls.DB_NAME, sqls)
+    expire, suffixes = cls.PARTITION_TABLES
+    cls.PARTITION_TABLES = (expire, sorted(set(suffixes) | {suffix}))
+    return cls.PARTITION.table_name(cls.TABLE_NAME, suffix)
+
+
+@classmethod
+async def drop_partitions(cls, keep: int) -> List[str]:
+    # 删除最近 keep 个月以前的分区表。 返回删除的表
+    tables = []
+    for suffix in cls.PARTITION.expired(await cls.partition_suffixes(refresh=True), keep):
+        table_name = cls.PARTITION.table_name(cls.TABLE_NAME, suffix)
+        sqls = [f'drop table if exists {table_name}']
+        if cls.LARGE_FIELDS:
+            sqls.append(f'drop table if exists {large_table(table_name)}')
+        await cls.conn.run_ddl(cls.DB_NAME, sqls)
+        tables.append(table_name)
+    await cls.partition_suffixes(refresh=True)
+    return tables
+
+
+@classmethod
+async def bulk_create(cls, instances: list, batch_size: int = 500) -> list:
+    # 批量添加。 多行insert 每批提交一次。 自增ID回写到实例上
+    instances = list(instances)
+    if not instances:
+        return instances
+
+    tm = int(time.time() * 1000)
+    # 按实例所在的表分组 {(DB_NAME, TABLE_NAME): [实例]}
+    groups = {}
+    for instance in instances:
+        instance.prepare_save(tm)
+        if instance.id:
+            # 已经有主键 不能用自增ID插入 逐个 upsert
+            await instance.save(upsert=True)
+            continue
+        if cls.multi_table():
+            if not ((await instance.locate_partition()) if cls.PARTITION else instance.locate_shard()):
+                continue
+        groups.setdefault((instance.DB_NAME, instance.TABLE_NAME), []).append(instance)
+
+    for (db_name, table_name), group in groups.items():
+        data_list = [instance.to_db() for instance in group]
+        large_list = [instance.large_changes()[0] for instance in group]
+        ids = await cls.conn.bulk_insert(db_name, table_name, data_list, batch_size=batch_size)
+        if len(ids) != len(group):
+            print('bulk create error')
+            continue
+
+        large_rows = []
+        for instance, pk, large_values in zip(group, ids, large_list):
+            instance.id = pk
+            large_rows += instance.large_rows(large_values)
+        if large_rows:
+            await cls.conn.set_large(db_name, table_name, large_rows)
+
+    return instances
+
+
 @classmethod
-async def get_by_pks(cls, pk_list: List[str], pk_name: str = '') -> dict:
+async def get_by_pks(cls, pk_list: List[str], pk_name: str = '', ordered: bool = False, only: List[str] = [],
+                     with_large: bool = False) -> dict:
+    # ordered 按传入主键的顺序返回
+    # only 只加载部分字段。 这样的对象保存时只能修改加载过的字段
+    # with_large 同时批量加载大字段
 
     result = {}
 
     if not pk_name:
         pk_name = cls.PK_NAME
+    only = cls.get_only(only)
 
-    raw_lines_dict = await cls.conn.get_by_pks(cls.DB_NAME, cls.TABLE_NAME, pk_list, pk_name=pk_name)
+    if cls.PARTITION:
+        await cls.partition_suffixes(wanted=cls.pk_partitions(pk_list) if pk_name == 'id' else [])
+    if cls.multi_table():
+        groups = cls.shard_pks(pk_list, pk_name)
+        results = await asyncio.gather(*[cls.conn.get_by_pks(*location, pks, pk_name=pk_name, only=only)
+                                         for location, pks in groups])
+        raw_lines_dict, locations = {}, {}
+        for (location, _), raw_dict in zip(groups, results):
+            raw_lines_dict.update(raw_dict)
+            locations.update(dict.fromkeys(raw_dict, location))
+    else:
+        use_cache = cls.use_row_cache(pk_name, only)
+        cached = cls.ROW_CACHE.get_many(pk_list) if use_cache else {}
+        missing = [pk for pk in pk_list if pk not in cached]
+        raw_lines_dict = {}
+        if missing:
+            raw_lines_dict = await cls.conn.get_by_pks(cls.DB_NAME, cls.TABLE_NAME, missing, pk_name=pk_name, only=only)
+        # 事务中读到的可能没有提交 不放入缓存
+        if use_cache and raw_lines_dict and not current_transaction(cls.DB_NAME):
+            cls.ROW_CACHE.set_many(raw_lines_dict)
+        raw_lines_dict.update(cached)
+        locations = {}
 
-    for key, raw_json in raw_lines_dict.items():
-        instance = cls()
-        instance.to_python(raw_json)
-        instance.id = raw_json['pk']
-        result[key] = instance
+    if ordered:
+        # 按传入主键的顺序返回
+        keys = [pk for pk in dict.fromkeys(pk_list) if pk in raw_lines_dict]
+    else:
+        keys = raw_lines_dict.keys()
+    for key in keys:
+        result[key] = cls.load_instance(raw_lines_dict[key], only, locations.get(key, ()))
+    if with_large:
+        await cls.load_large_many(list(result.values()))
 
     return result
 
 
 @classmethod
-async def get(cls, pk: str = '', pk_name: str = ''):
+async def get(cls, pk: str = '', pk_name: str = '', only: List[str] = [], with_large: bool = False):
     if not pk:
         print("no pk")
         return
-    result = await cls.get_by_pks([pk, ], pk_name=pk_name)
+    result = await cls.get_by_pks([pk, ], pk_name=pk_name, only=only, with_large=with_large)
     return result.get(pk)
 
 
@@ -101,28 +350,50 @@ async def get_page_items(cls, **filter) -> list:
     # cursor: int = 0
     # limit: int = 10
     # desc: bool = True
+    # only: list = [] 只加载部分字段
+    # order_by: list = [] 按映射列排序 ['-update_time']。 cursor 用 make_cursor 生成
+    # deferred: bool = DEFERRED_PAGE 先取一页主键 再用 get_by_pks 取数据
 
     result = []
-    query = {}
-    for field, value in filter.items():
-        # 支持运算符
-        if '__' in field:
-            f, _ = field.split('__')
-            if f not in cls.QUERY_FIELDS:
-                continue
-            else:
-                query[field] = value
-        elif field not in cls.QUERY_FIELDS:
-            continue
-        else:
-            query[field] = value
+    query, index_fields = cls.compile_filter(filter)
+    cursor, limit, desc, only, order_by = cls.page_options(filter)
+
+    target = cls.explain_target(query, index_fields, cursor, limit, desc, only, order_by)
+    if target:
+        try:
+            rows = await cls.conn.raw_query(cls.DB_NAME, f'explain format=json {target[0]}', target[1], read=True)
+            cls.record_explain(target, order_by, rows)
+        except Exception as e:
+            query_advisor.release(cls.__name__, target[0])
+            print(f'{cls.__name__} explain error:{e}')
 
-    # 是否命中索引
-    index_fields = cls.find_index(filter)
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+    if cls.PARTITION and cls.partition_ordered(order_by):
+        # 从新到旧(正序时从旧到新)逐个分区查询 取满 limit 就停止
+        for location in cls.partition_page_locations(query, cursor, desc, order_by):
+            items = await cls.conn.query(*location, query, cursor=cursor, limit=limit - len(result), desc=desc,
+                                         pk_name=cls.PK_NAME, index_fields=index_fields, only=only, order_by=order_by)
+            result += [cls.load_instance(item, only, location) for item in items]
+            if len(result) >= limit:
+                break
+        return result
 
-    cursor = int(filter.get('cursor', 0))
-    limit = int(filter.get('limit', 10))
-    desc = bool(filter.get('desc', True))
+    if cls.multi_table():
+        # 每个分片用同一个游标取一页 合并后取前 limit 条
+        locations = cls.shard_query(query)
+        results = await asyncio.gather(*[cls.conn.query(*location, query, cursor=cursor, limit=limit, desc=desc,
+                                                        pk_name=cls.PK_NAME, index_fields=index_fields, only=only,
+                                                        order_by=order_by) for location in locations])
+        groups = [[cls.load_instance(item, only, location) for item in items]
+                  for location, items in zip(locations, results)]
+        return merge_items(groups, cls.page_orders(desc, order_by), limit)
+
+    if filter.get('deferred', cls.DEFERRED_PAGE):
+        # 先用索引取一页主键 再按主键取数据, 可以命中行缓存
+        pks = await cls.conn.query_ids(cls.DB_NAME, cls.TABLE_NAME, query, cursor=cursor, limit=limit, desc=desc,
+                                       pk_name=cls.PK_NAME, index_fields=index_fields, order_by=order_by)
+        return list((await cls.get_by_pks(pks, pk_name='id', ordered=True, only=only)).values())
 
     items = await cls.conn.query(cls.DB_NAME,
                            cls.TABLE_NAME,
@@ -131,15 +402,13 @@ async def get_page_items(cls, **filter) -> list:
                            limit=limit,
                            desc=desc,
                            pk_name=cls.PK_NAME,
-                           index_fields=index_fields
+                           index_fields=index_fields,
+                           only=only,
+                           order_by=order_by,
                            )
 
     for item in items:
-        pk = item['pk']
-        obj = cls()
-        obj.to_python(item)
-        obj.id = pk
-        result.append(obj)
+        result.append(cls.load_instance(item, only))
 
     return result
 
@@ -147,21 +416,240 @@ async def get_page_items(cls, **filter) -> list:
 @classmethod
 async def get_query_count(cls, **filter) -> int:
     count = 0
-    query = {}
-    for field, value in filter.items():
-        # 支持运算符
-        if '__' in field:
-            f, _ = field.split('__')
-            if f not in cls.QUERY_FIELDS:
-                continue
-            else:
-                query[field] = value
-        elif field not in cls.QUERY_FIELDS:
-            continue
-        else:
-            query[field] = value
-    # 是否命中索引
-    index_fields = cls.find_index(filter)
+    query, index_fields = cls.compile_filter(filter)
+
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+    if cls.multi_table():
+        counts = await asyncio.gather(*[cls.conn.query_count(*location, query, index_fields=index_fields)
+                                        for location in cls.shard_query(query)])
+        return sum(counts)
 
     count = await cls.conn.query_count(cls.DB_NAME, cls.TABLE_NAME, query,index_fields=index_fields)
     return count
+
+
+@classmethod
+async def aggregate(cls, **kwargs) -> dict:
+    # 聚合 没有分组 返回一个 dict
+    if cls.multi_table():
+        print(f'{cls.__name__} aggregate not supported on multi table model')
+        return {}
+    aggregates, filter, _ = cls.aggregate_options([], kwargs)
+    if not aggregates:
+        return {}
+    query, index_fields = cls.compile_filter(filter)
+    items = await cls.conn.aggregate(cls.DB_NAME, cls.TABLE_NAME, query, aggregates, index_fields=index_fields)
+    return items[0] if items else {}
+
+
+@classmethod
+async def group_by(cls, fields: List[str], **kwargs) -> List[dict]:
+    # 分组聚合 每组返回一个 dict
+    if cls.multi_table():
+        print(f'{cls.__name__} group by not supported on multi table model')
+        return []
+    aggregates, filter, order_by = cls.aggregate_options(fields, kwargs)
+    if aggregates is None:
+        return []
+    query, index_fields = cls.compile_filter(filter)
+    return await cls.conn.aggregate(cls.DB_NAME, cls.TABLE_NAME, query, aggregates,
+                                    group_by=fields,
+                                    index_fields=index_fields,
+                                    order_by=order_by,
+                                    limit=int(filter.get('limit', 0)))
+
+
+@classmethod
+async def exists(cls, **filter) -> bool:
+    # 是否有满足条件的数据。 比 get_query_count 便宜, 找到一行就停止
+    query, index_fields = cls.compile_filter(filter)
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+    if cls.multi_table():
+        results = await asyncio.gather(*[cls.conn.exists(*location, query, index_fields=index_fields)
+                                         for location in cls.shard_query(query)])
+        return any(results)
+    return await cls.conn.exists(cls.DB_NAME, cls.TABLE_NAME, query, index_fields=index_fields)
+
+
+@classmethod
+async def get_approx_count(cls, **filter) -> int:
+    # 估算的数量。 不扫描数据 只适合展示量级
+    query, index_fields = cls.compile_filter(filter)
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+    if cls.multi_table():
+        counts = await asyncio.gather(*[cls.conn.estimate_count(*location, query, index_fields=index_fields)
+                                        for location in cls.shard_query(query)])
+        return sum(counts)
+    return await cls.conn.estimate_count(cls.DB_NAME, cls.TABLE_NAME, query, index_fields=index_fields)
+
+
+@classmethod
+async def get_cached_count(cls, ttl: int = 0, **filter) -> int:
+    # 精确数量 缓存 ttl 秒(默认 COUNT_CACHE_TTL)
+    key = cls.count_cache_key(filter)
+    count = cls.get_count_cache(key)
+    if count is None:
+        count = await cls.get_query_count(**filter)
+        cls.set_count_cache(key, count, ttl)
+    return count
+
+
+@classmethod
+async def get_page_with_count(cls, **filter):
+    # 分页数据和总数 一次查询。 返回 [对象], 总数
+    if cls.multi_table():
+        # 多个表不能一次查询 分别取分页和总数
+        return await cls.get_page_items(**filter), await cls.get_query_count(**filter)
+    result = []
+    query, index_fields = cls.compile_filter(filter)
+    cursor, limit, desc, only, order_by = cls.page_options(filter)
+
+    items, total = await cls.conn.query_with_count(cls.DB_NAME,
+                                                   cls.TABLE_NAME,
+                                                   query,
+                                                   cursor=cursor,
+                                                   limit=limit,
+                                                   desc=desc,
+                                                   pk_name=cls.PK_NAME,
+                                                   index_fields=index_fields,
+                                                   only=only,
+                                                   order_by=order_by,
+                                                   )
+    for item in items:
+        result.append(cls.load_instance(item, only))
+
+    cls.set_count_cache(cls.count_cache_key(filter), total)
+    return result, total
+
+
+@classmethod
+async def update_where(cls, values: dict, chunk_size: int = 0, **filter) -> int:
+    # 按条件批量修改。 一条 update 语句, 返回影响行数
+    query, index_fields = cls.compile_filter(filter)
+    if not query:
+        print('no query condition can not update')
+        return 0
+    set_dict, version_field = cls.get_update_values(values)
+
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+    counts = await amap_shards(lambda location: cls.conn.update_where(*location,
+                                                                      set_dict,
+                                                                      query,
+                                                                      index_fields=index_fields,
+                                                                      version_field=version_field,
+                                                                      chunk_size=chunk_size),
+                               cls.shard_query(query))
+    count = sum(counts)
+    # gather 的任务在复制的上下文里执行 读写路由在这里记录
+    mark_write()
+    cls.evict_rows()
+    return count
+
+
+@classmethod
+async def delete_where(cls, chunk_size: int = 0, **filter) -> int:
+    # 按条件批量删除。 返回影响行数
+    query, index_fields = cls.compile_filter(filter)
+    if not query:
+        print('no query condition can not delete')
+        return 0
+
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+    async def work(location):
+        if cls.LARGE_FIELDS:
+            return await cls.delete_where_pks(location, query, index_fields, chunk_size)
+        return await cls.conn.delete_where(*location, query, index_fields=index_fields, chunk_size=chunk_size)
+
+    counts = await amap_shards(work, cls.shard_query(query))
+    count = sum(counts)
+    mark_write()
+    cls.evict_rows()
+    return count
+
+
+@classmethod
+async def delete_where_pks(cls, location: tuple, query: dict, index_fields: list, chunk_size: int = 0) -> int:
+    # 有大字段的模型 按条件分批取主键, 删除主表的行和旁表的大字段
+    total, cursor = 0, 0
+    limit = chunk_size or 1000
+    while True:
+        with use_primary():
+            pks = await cls.conn.query_ids(*location, query, cursor=cursor, limit=limit, desc=False,
+                                           index_fields=index_fields)
+        if not pks:
+            break
+        total += await cls.conn.delete_by_pks(*location, pks, chunk_size=limit)
+        await cls.delete_large_rows(*location, pks)
+        if len(pks) < limit:
+            break
+        cursor = pks[-1]
+    return total
+
+
+@classmethod
+async def delete_by_pks(cls, pk_list: list, chunk_size: int = 1000) -> int:
+    # 根据主键批量删除。 分片、分区模型按主键所在的表分组
+    async def work(group):
+        location, pks = group
+        count = await cls.conn.delete_by_pks(*location, pks, chunk_size=chunk_size)
+        await cls.delete_large_rows(*location, pks)
+        return count
+
+    if cls.PARTITION:
+        await cls.partition_suffixes(wanted=cls.pk_partitions(pk_list))
+    counts = await amap_shards(work, cls.shard_pks(pk_list, 'id'))
+    mark_write()
+    cls.evict_rows(pk_list)
+    return sum(counts)
+
+
+@classmethod
+async def objects(cls, chunk_size: int = 100, prefetch: bool = False, server_side: bool = False, **filter):
+    # 遍历所有对象。 按主键正序, 用法 async for obj in Model.objects()
+    # prefetch 处理当前批次时 后台任务预取下一批
+    # 分片、分区模型依次遍历每个表, 主键只在表内有序
+    query, index_fields = cls.compile_filter(filter)
+    multi = cls.multi_table()
+    if cls.PARTITION:
+        await cls.partition_suffixes()
+
+    if server_side:
+        for location in cls.shard_query(query):
+            async for chunk in cls.conn.stream(*location, query, index_fields=index_fields, chunk_size=chunk_size):
+                for item in chunk:
+                    yield cls.load_instance(item, location=location if multi else ())
+        return
+
+    def fetch(location, cursor):
+        return cls.conn.query(*location,
+                              query,
+                              cursor=cursor,
+                              limit=chunk_size,
+                              desc=False,
+                              pk_name='id',
+                              index_fields=index_fields)
+
+    next_task = None
+    try:
+        for location in cls.shard_query(query):
+            items = await fetch(location, 0)
+            while items:
+                if prefetch and len(items) >= chunk_size:
+                    next_task = asyncio.ensure_future(fetch(location, items[-1]['pk']))
+                for item in items:
+                    yield cls.load_instance(item, location=location if multi else ())
+                if len(items) < chunk_size:
+                    break
+                if next_task:
+                    items = await next_task
+                    next_task = None
+                else:
+                    items = await fetch(location, items[-1]['pk'])
+    finally:
+        if next_task and not next_task.done():
+            next_task.cancel()
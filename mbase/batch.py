@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    批量读
+    多个模型的 get / get_by_pks / get_page_items 先登记, 执行时同一个库的查询合并成一条 UNION ALL,
+    一次往返拿到所有结果, 再按查询分别实例化。
+
+    用法:
+        batch = ReadBatch()
+        app = batch.get(App, app_id)
+        users = batch.get_by_pks(User, user_ids)
+        feeds = batch.get_page_items(Feed, status=1, limit=10)
+        batch.execute()            # 异步 await batch.aexecute()
+        app.result, users.result, feeds.result
+
+    分片、分区模型不参与合并, 执行时单独调用模型自己的方法。
+'''
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import List
+
+from mbase.db import codec
+from mbase.db.query import page_plan, pks_sql
+from mbase.db.transaction import current_transaction
+from mbase.shard import merge_items
+
+
+class BatchRead(ABC):
+    # 登记的一个读操作。 执行后结果在 result。 子类实现 load 和 fallback
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        # 合并执行的 sql, 参数。 sql 为空时不需要查库
+        self.sql = ''
+        self.args = ()
+        self.result = None
+
+    @abstractmethod
+    def load(self, rows: list):
+        # rows 这个查询的 [(id, data), ...]
+        pass
+
+    @abstractmethod
+    def fallback(self):
+        # 不能合并时 调用模型自己的方法。 异步模型返回的是协程
+        pass
+
+
+class PksRead(BatchRead):
+
+    def __init__(self, model_class, pk_list: list, pk_name: str = '', ordered: bool = False, only: List[str] = [],
+                 single: bool = False):
+        super().__init__(model_class)
+        self.pk_list = list(pk_list)
+        self.pk_name = pk_name or model_class.PK_NAME
+        self.ordered = ordered
+        self.only = model_class.get_only(only)
+        # get 只返回一个对象
+        self.single = single
+
+        self.use_cache = model_class.use_row_cache(self.pk_name, self.only)
+        self.cached = model_class.ROW_CACHE.get_many(self.pk_list) if self.use_cache else {}
+        missing = list(dict.fromkeys([pk for pk in self.pk_list if pk not in self.cached]))
+        if missing:
+            self.sql = pks_sql(model_class.TABLE_NAME, len(missing), self.pk_name, tuple(self.only))
+            self.args = tuple(missing)
+
+    def load(self, rows: list):
+        model_class = self.model_class
+        raw_lines_dict = {}
+        for pk, raw_data in rows:
+            json_data = codec.loads(raw_data)
+            json_data['pk'] = pk
+            raw_lines_dict[pk if self.pk_name == 'id' else json_data[self.pk_name]] = json_data
+        # 事务中读到的可能没有提交 不放入缓存
+        if self.use_cache and raw_lines_dict and not current_transaction(model_class.DB_NAME):
+            model_class.ROW_CACHE.set_many(raw_lines_dict)
+        raw_lines_dict.update(self.cached)
+
+        if self.ordered or self.single:
+            keys = [pk for pk in dict.fromkeys(self.pk_list) if pk in raw_lines_dict]
+        else:
+            keys = raw_lines_dict.keys()
+        result = {key: model_class.load_instance(raw_lines_dict[key], self.only) for key in keys}
+        self.result = result.get(self.pk_list[0]) if self.single else result
+
+    def fallback(self):
+        if self.single:
+            return self.model_class.get(self.pk_list[0], pk_name=self.pk_name, only=self.only)
+        return self.model_class.get_by_pks(self.pk_list, pk_name=self.pk_name, ordered=self.ordered, only=self.only)
+
+
+class PageRead(BatchRead):
+
+    def __init__(self, model_class, filter: dict):
+        super().__init__(model_class)
+        self.filter = filter
+        query, index_fields = model_class.compile_filter(filter)
+        cursor, self.limit, self.desc, self.only, self.order_by = model_class.page_options(filter)
+        plan, query, values = page_plan(model_class.TABLE_NAME, query, cursor, self.desc, model_class.PK_NAME,
+                                        index_fields, self.only, self.order_by)
+        if plan:
+            self.sql = plan.select_sql
+            self.args = plan.bind(query, values, self.limit)
+
+    def load(self, rows: list):
+        items = []
+        for pk, raw_data in rows:
+            json_data = codec.loads(raw_data)
+            json_data['pk'] = pk
+            items.append(self.model_class.load_instance(json_data, self.only))
+        # UNION ALL 不保证各部分的顺序 按分页的排序重新排一次
+        self.result = merge_items([items], self.model_class.page_orders(self.desc, self.order_by), self.limit)
+
+    def fallback(self):
+        return self.model_class.get_page_items(**self.filter)
+
+
+class ReadBatch(object):
+
+    def __init__(self):
+        self.reads = []
+
+    def add(self, read: BatchRead) -> BatchRead:
+        self.reads.append(read)
+        return read
+
+    def get_by_pks(self, model_class, pk_list: list, pk_name: str = '', ordered: bool = False,
+                   only: List[str] = []) -> BatchRead:
+        return self.add(PksRead(model_class, pk_list, pk_name, ordered, only))
+
+    def get(self, model_class, pk, pk_name: str = '', only: List[str] = []) -> BatchRead:
+        return self.add(PksRead(model_class, [pk], pk_name, only=only, single=True))
+
+    def get_page_items(self, model_class, **filter) -> BatchRead:
+        return self.add(PageRead(model_class, filter))
+
+    def groups(self) -> dict:
+        # 需要查库的读操作 按库分组。 不需要查库的直接得到结果
+        groups = {}
+        for read in self.reads:
+            if read.model_class.multi_table():
+                continue
+            if not read.sql:
+                read.load([])
+                continue
+            groups.setdefault(read.model_class.DB_NAME, []).append(read)
+        return groups
+
+    def execute(self) -> list:
+        # 同步执行。 返回各个读操作的结果 和登记顺序一致
+        for read in self.reads:
+            if read.model_class.multi_table():
+                read.result = read.fallback()
+
+        for db_name, reads in self.groups().items():
+            rows = reads[0].model_class.conn.batch_query(db_name, [(read.sql, read.args) for read in reads])
+            for tag, read in enumerate(reads):
+                read.load(rows.get(tag, []))
+        return [read.result for read in self.reads]
+
+    async def aexecute(self) -> list:
+        # 异步执行。 不同的库并发查询
+        for read in self.reads:
+            if read.model_class.multi_table():
+                read.result = await read.fallback()
+
+        groups = list(self.groups().items())
+        results = await asyncio.gather(*[
+            reads[0].model_class.conn.batch_query(db_name, [(read.sql, read.args) for read in reads])
+            for db_name, reads in groups
+        ])
+        for (_, reads), rows in zip(groups, results):
+            for tag, read in enumerate(reads):
+                read.load(rows.get(tag, []))
+        return [read.result for read in self.reads]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    行缓存
+    get_by_pks 先查模型的 ROW_CACHE, 没有的再查库。 save/delete 时删除对应的缓存。
+    缓存的是库里的原始json, 取出时重新解码 实例之间互不影响。
+
+    用法:
+        class App(MysqlBaseModel):
+            ROW_CACHE = LocalRowCache(size=10000, ttl=60)
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+from mbase.db import codec
+
+
+class LocalRowCache(object):
+    # 进程内 LRU 缓存。 ttl 秒后过期
+
+    def __init__(self, size: int = 10000, ttl: float = 60):
+        self.size = size
+        self.ttl = ttl
+        # 主键 -> (过期时间, json字符串)
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, pks: list) -> dict:
+        result = {}
+        now = time.time()
+        with self.lock:
+            for pk in pks:
+                item = self.rows.get(pk)
+                if item is None:
+                    continue
+                if item[0] < now:
+                    del self.rows[pk]
+                    continue
+                self.rows.move_to_end(pk)
+                result[pk] = item[1]
+        return {pk: codec.loads(raw) for pk, raw in result.items()}
+
+    def set_many(self, rows: dict):
+        expire = time.time() + self.ttl
+        items = [(pk, codec.dumps(raw_json)) for pk, raw_json in rows.items()]
+        with self.lock:
+            for pk, raw in items:
+                self.rows[pk] = (expire, raw)
+                self.rows.move_to_end(pk)
+            while len(self.rows) > self.size:
+                self.rows.popitem(last=False)
+
+    def delete_many(self, pks: list):
+        with self.lock:
+            for pk in pks:
+                self.rows.pop(pk, None)
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
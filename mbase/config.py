@@ -14,5 +14,29 @@ MYSQL_CONFIG = {
     #     "password": "12345678",
     #     "db": "crucio_insight",
     #     "charset": "utf8mb4",
+    #     # 连接池配置 (可选)
+    #     "pool_min_size": 1,
+    #     "pool_max_size": 10,
+    #     # 等待空闲连接的超时时间(秒)
+    #     "pool_timeout": 30,
+    #     # 连接存活超过该时间(秒)后重建
+    #     "pool_recycle": 3600,
+    #     # 连接空闲超过该时间(秒)才做 ping 检查
+    #     "pool_ping_interval": 30,
+    #     # get_by_pks 每条语句 IN 列表的最大长度
+    #     "in_chunk_size": 1000,
+    #     # 从库 (可选)。 没写的项和主库一致。 读走从库, 写走主库
+    #     "replicas": [
+    #         {"host": "replica1"},
+    #         {"host": "replica2"},
+    #     ],
+    #     # 从库选择 round_robin 轮询 / least_outstanding 正在使用连接最少的
+    #     "replica_policy": "round_robin",
     # }
 }
+
+# data 列的json编解码库 orjson / ujson / json。 为空时自动选择已安装的
+MYSQL_JSON_CODEC = ''
+
+# 开启后每种查询形状 EXPLAIN 一次 记录到 mbase.advisor.query_advisor
+MYSQL_EXPLAIN_ADVISOR = False
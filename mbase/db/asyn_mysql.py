@@ -6,33 +6,54 @@
     @Version : 1.0
     @Time    : 2020-11-03
 '''
-import json
-from typing import List
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
 from asyncio.locks import Lock
 
 import aiomysql
 from mbase.config import MYSQL_CONFIG
+from mbase.db import codec
+from mbase.db.route import ReplicaRouter, mark_write, read_primary, use_primary
+from mbase.db.transaction import (ATOMIC, PinnedConnection, Transaction, conn_transaction, current_transaction,
+                                  enter_transaction)
+from mbase.db.query import (OP_DICT, TABLE_ROWS_SQL, aggregate_plan, build_where, chunk_list, data_expr, explain_rows,
+                            json_path, json_update_expr, page_plan, plain_value, union_sql, version_expr, where_plan)
+from mbase.large import delete_large_sql, select_large_sql, upsert_large_sql
 
 
-# 运算符字典
-OP_DICT = {
-    'gte': '>=',
-    'gt': '>',
-    'lte': '<=',
-    'lt': '<',
-    'ne': '<>',
-}
-
 INIT_LOCK = Lock()
 
 
 class AMConnection(object):
 
     CONN_DICT = {}
+    # 每个库的从库连接池 和从库选择
+    REPLICA_DICT = {}
+    ROUTER_DICT = {}
+
+    @classmethod
+    async def create_pool(cls, config: dict):
+        return await aiomysql.pool.create_pool(
+            host=config.get('host'),
+            port=config.get('port', 3306),
+            user=config.get('user'),
+            password=config.get('password'),
+            db=config.get('db'),
+            charset=config.get('charset'),
+            connect_timeout=360,
+        )
 
     @classmethod
-    async def get_pool(cls, db_name: str):
-        print('async get_conn')
+    async def get_pool(cls, db_name: str, read: bool = False):
+        # read 读操作。 配置了从库 且不需要读主库时 返回从库连接池
+        if read and not read_primary():
+            replicas = await cls.get_replicas(db_name)
+            if replicas:
+                return cls.ROUTER_DICT[db_name].choose(replicas, lambda pool: pool.size - pool.freesize)
+        elif not read:
+            mark_write()
+
         if db_name in cls.CONN_DICT:
             pool = cls.CONN_DICT[db_name]
         else:
@@ -41,21 +62,35 @@ class AMConnection(object):
                     if db_name in cls.CONN_DICT:
                         pool = cls.CONN_DICT[db_name]
                     else:
-                        config = MYSQL_CONFIG.get(db_name)
-                        pool = await aiomysql.pool.create_pool(
-                            host=config.get('host'),
-                            user=config.get('user'),
-                            password=config.get('password'),
-                            db=config.get('db'),
-                            charset=config.get('charset'),
-                            connect_timeout=360,
-                        )
+                        pool = await cls.create_pool(MYSQL_CONFIG.get(db_name))
                         cls.CONN_DICT[db_name] = pool
             else:
                 pool = None
 
         return pool
 
+    @classmethod
+    async def get_replicas(cls, db_name: str) -> list:
+        # 从库连接池。 从库配置没写的项 和主库一致
+        if db_name in cls.REPLICA_DICT:
+            return cls.REPLICA_DICT[db_name]
+
+        config = MYSQL_CONFIG.get(db_name)
+        if not config:
+            return []
+
+        async with INIT_LOCK:
+            if db_name not in cls.REPLICA_DICT:
+                pools = []
+                for replica in config.get('replicas', []):
+                    replica_config = dict(config)
+                    replica_config.update(replica)
+                    pools.append(await cls.create_pool(replica_config))
+                cls.ROUTER_DICT[db_name] = ReplicaRouter(config.get('replica_policy', 'round_robin'))
+                cls.REPLICA_DICT[db_name] = pools
+
+        return cls.REPLICA_DICT[db_name]
+
     @classmethod
     def release_conn(cls, db_name: str, conn):
         print('release conn')
@@ -63,9 +98,62 @@ class AMConnection(object):
             pool = cls.CONN_DICT[db_name]
             pool.release(conn)
 
+    @classmethod
+    async def connect(cls, db_name: str, pool):
+        # 事务中的主库 使用事务的连接, 同一时间只执行一条语句
+        tx = current_transaction(db_name)
+        if tx and pool is cls.CONN_DICT.get(db_name):
+            await tx.lock.acquire()
+            return PinnedConnection(tx)
+        return await pool
+
+    @classmethod
+    async def commit(cls, conn):
+        # 事务中的连接 推迟到事务结束时提交
+        if not conn_transaction(conn):
+            await conn.commit()
+
+    @classmethod
+    @asynccontextmanager
+    async def atomic(cls, db_name: str, batch: bool = False):
+        # 事务。 作用域内使用同一个主库连接, 结束时提交一次, 出错时回滚
+        # 嵌套时并入外层事务
+        tx = current_transaction(db_name)
+        if tx:
+            yield tx
+            return
+
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            print('no conn')
+            yield None
+            return
+
+        with use_primary():
+            with (await pool) as conn:
+                await conn.begin()
+                tx = Transaction(db_name, conn, batch)
+                tx.lock = asyncio.Lock()
+                token = enter_transaction(tx)
+                try:
+                    yield tx
+                    if tx.pending and tx.flush:
+                        tx.flushing = True
+                        await tx.flush(tx)
+                except BaseException:
+                    ATOMIC.reset(token)
+                    await conn.rollback()
+                    raise
+                ATOMIC.reset(token)
+                if tx.failed:
+                    print(f'{db_name} transaction rollback')
+                    await conn.rollback()
+                else:
+                    await conn.commit()
+
     @classmethod
     def process_in_params(cls, args):
-        in_p = ', '.join(list([f'{x}' for x in args]))
+        in_p = ', '.join(list(['%s' for x in args]))
         return in_p
 
     @classmethod
@@ -77,41 +165,108 @@ class AMConnection(object):
             print('no conn')
             return last_id
         try:
-            with (await pool) as conn:
+            with (await cls.connect(db_name, pool)) as conn:
                 cursor = await conn.cursor()
                 sql = f'insert into {table_name}(data) value(%s)'
-                await cursor.execute(sql, (json.dumps(data_dict),))
+                await cursor.execute(sql, (codec.dumps(data_dict),))
                 last_id = cursor.lastrowid
-                await conn.commit()
+                await cls.commit(conn)
         except:
             pass
 
         return last_id
 
     @classmethod
-    async def get_by_pks(cls, db_name: str, table_name: str, pks: List[int], pk_name: str = 'id') -> dict:
+    async def bulk_insert(cls,
+                          db_name: str,
+                          table_name: str,
+                          data_list: List[dict],
+                          batch_size: int = 500,
+                          max_bytes: int = 2 * 1024 * 1024) -> List[int]:
+        # 批量添加。 多行 insert, 每批提交一次, 返回自增ID(与 data_list 顺序一致)
+        ids = []
+        if not db_name or not table_name or not data_list:
+            return ids
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return ids
+
+        batches = []
+        batch, batch_bytes = [], 0
+        for data_dict in data_list:
+            raw_data = codec.dumps(data_dict)
+            size = len(raw_data.encode('utf-8')) + 4
+            if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(raw_data)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('select @@auto_increment_increment')
+                step = int((await cursor.fetchone())[0] or 1)
+                for rows in batches:
+                    sql = f'insert into {table_name}(data) values ' + ', '.join(['(%s)'] * len(rows))
+                    await cursor.execute(sql, rows)
+                    # 多行插入 lastrowid 是第一行的ID
+                    first_id = cursor.lastrowid
+                    ids.extend([first_id + i * step for i in range(len(rows))])
+                    await cls.commit(conn)
+
+        return ids
+
+    @classmethod
+    async def get_by_pks(cls,
+                         db_name: str,
+                         table_name: str,
+                         pks: List[int],
+                         pk_name: str = 'id',
+                         chunk_size: int = 0,
+                         only: List[str] = []) -> dict:
         # 根据IDS 获取json信息
+        # only 只取部分字段
+        # 主键去重后按 chunk_size 切分 IN 列表, 多个分段并发查询
         result = {}
         if not db_name or not table_name or not pks:
-            print(0)
             return result
 
-        pool = await cls.get_pool(db_name)
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return result
 
-        with (await pool) as conn:
-            async with conn.cursor() as cursor:
-                sql = f'select id, data from {table_name} where {pk_name} in (%s)'
-                sql = sql % (AMConnection.process_in_params(pks),)
-                await cursor.execute(sql)
-                items = await cursor.fetchall()
-                for item in items:
-                    pk, raw_data = item
-                    json_data = json.loads(raw_data)
-                    json_data['pk'] = pk
-                    if pk_name == 'id':
-                        result[pk] = json_data
-                    else:
-                        result[json_data[pk_name]] = json_data
+        if not chunk_size:
+            chunk_size = MYSQL_CONFIG.get(db_name, {}).get('in_chunk_size', 1000)
+        pks = list(dict.fromkeys(pks))
+        if only and pk_name != 'id' and pk_name not in only:
+            only = list(only) + [pk_name]
+        select_sql = f'select id, {data_expr(tuple(only))} from {table_name}'
+
+        async def _fetch(chunk):
+            with (await cls.connect(db_name, pool)) as conn:
+                async with conn.cursor() as cursor:
+                    sql = f'{select_sql} where {pk_name} in (%s)'
+                    sql = sql % (cls.process_in_params(chunk),)
+                    await cursor.execute(sql, chunk)
+                    return await cursor.fetchall()
+
+        chunks = chunk_list(pks, chunk_size)
+        if len(chunks) == 1:
+            chunk_items = [await _fetch(chunks[0])]
+        else:
+            chunk_items = await asyncio.gather(*[_fetch(chunk) for chunk in chunks])
+
+        for items in chunk_items:
+            for item in items:
+                pk, raw_data = item
+                json_data = codec.loads(raw_data)
+                json_data['pk'] = pk
+                if pk_name == 'id':
+                    result[pk] = json_data
+                else:
+                    result[json_data[pk_name]] = json_data
 
         return result
 
@@ -132,14 +287,68 @@ class AMConnection(object):
         if not pool:
             return -1
 
-        with (await pool) as conn:
+        with (await cls.connect(db_name, pool)) as conn:
             async with conn.cursor() as cursor:
                 sql = f'update {table_name} set data = %s where {pk_name} = %s'
                 # sql = f'update {table_name} set data = %s where {pk_name} = %s and dver = %s'
-                raw_data = json.dumps(data_dict)
+                raw_data = codec.dumps(data_dict)
                 await cursor.execute(sql, (raw_data, pk))
                 total = cursor.rowcount
-                await conn.commit()
+                await cls.commit(conn)
+
+        return total
+
+    @classmethod
+    async def upsert(cls, db_name: str, table_name: str, pk: int, data_dict: dict, version_field: str = 'dver') -> int:
+        # 一次往返 添加或更新。 版本号在SQL里计算(< 127 加1 否则归0), 不需要先读旧数据
+        total = 0
+        if not db_name or not table_name or not pk or not data_dict:
+            return total
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return -1
+
+        sql = f'insert into {table_name}(id, data) values(%s, %s) on duplicate key update data = '
+        if version_field:
+            sql += f"JSON_SET(VALUES(data), '{json_path((version_field,))}', {version_expr(version_field)})"
+        else:
+            sql += 'VALUES(data)'
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, (pk, codec.dumps(data_dict)))
+                total = cursor.rowcount
+                await cls.commit(conn)
+
+        return total
+
+    @classmethod
+    async def update_fields(cls,
+                            db_name: str,
+                            table_name: str,
+                            pk: int,
+                            set_dict: dict,
+                            remove_list: List[tuple] = [],
+                            version_field: str = '') -> int:
+        # 只修改 data 里指定的json路径。 set_dict {路径tuple: 值}
+        total = 0
+        if not db_name or not table_name or not pk:
+            return total
+        if not set_dict and not remove_list and not version_field:
+            return total
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return -1
+
+        expr, args = json_update_expr(set_dict, remove_list, version_field)
+        sql = f'update {table_name} set data = {expr} where id = %s'
+        args.append(pk)
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, tuple(args))
+                total = cursor.rowcount
+                await cls.commit(conn)
 
         return total
 
@@ -150,140 +359,356 @@ class AMConnection(object):
         if not pool:
             return
 
-        with (await pool) as conn:
+        with (await cls.connect(db_name, pool)) as conn:
             async with conn.cursor() as cursor:
                 sql = f'delete from {table_name} where {pk_name} = %s'
                 await cursor.execute(sql, (pk,))
-                await conn.commit()
+                await cls.commit(conn)
+
+    @classmethod
+    async def execute_where(cls,
+                            db_name: str,
+                            table_name: str,
+                            head_sql: str,
+                            head_args: list,
+                            query_dict: dict,
+                            index_fields: List[str] = [],
+                            chunk_size: int = 0) -> int:
+        # 按条件执行 update / delete。 返回影响行数
+        # chunk_size > 0 时按主键区间分段执行 每段单独提交, 避免长时间持有大量行锁
+        total = 0
+        query_arr, args = build_where(query_dict, index_fields)
+        if not query_arr:
+            print('no condition can not execute')
+            return total
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return total
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                if chunk_size <= 0:
+                    await cursor.execute(f'{head_sql} where {" and ".join(query_arr)}', tuple(head_args + args))
+                    total = cursor.rowcount
+                    await cls.commit(conn)
+                    return total
+
+                await cursor.execute(f'select min(id), max(id) from {table_name} where {" and ".join(query_arr)}',
+                                     tuple(args))
+                min_id, max_id = await cursor.fetchone()
+                if min_id is None:
+                    return total
+                sql = f'{head_sql} where {" and ".join(query_arr + ["id >= %s", "id < %s"])}'
+                start = min_id
+                while start <= max_id:
+                    await cursor.execute(sql, tuple(head_args + args + [start, start + chunk_size]))
+                    total += cursor.rowcount
+                    await cls.commit(conn)
+                    start += chunk_size
+
+        return total
+
+    @classmethod
+    async def update_where(cls,
+                           db_name: str,
+                           table_name: str,
+                           set_dict: dict,
+                           query_dict: dict,
+                           index_fields: List[str] = [],
+                           version_field: str = '',
+                           chunk_size: int = 0) -> int:
+        # 按条件批量修改json字段。 set_dict {路径tuple: 值}
+        if not db_name or not table_name or (not set_dict and not version_field):
+            return 0
+        expr, head_args = json_update_expr(set_dict, [], version_field)
+        head_sql = f'update {table_name} set data = {expr}'
+        return await cls.execute_where(db_name, table_name, head_sql, head_args, query_dict, index_fields, chunk_size)
+
+    @classmethod
+    async def delete_where(cls,
+                           db_name: str,
+                           table_name: str,
+                           query_dict: dict,
+                           index_fields: List[str] = [],
+                           chunk_size: int = 0) -> int:
+        # 按条件批量删除
+        if not db_name or not table_name:
+            return 0
+        head_sql = f'delete from {table_name}'
+        return await cls.execute_where(db_name, table_name, head_sql, [], query_dict, index_fields, chunk_size)
+
+    @classmethod
+    async def delete_by_pks(cls,
+                            db_name: str,
+                            table_name: str,
+                            pks: list,
+                            pk_name: str = 'id',
+                            chunk_size: int = 1000) -> int:
+        # 根据主键批量删除。 分段执行 每段单独提交
+        total = 0
+        if not db_name or not table_name or not pks:
+            return total
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return total
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                for chunk in chunk_list(list(pks), chunk_size):
+                    sql = f"delete from {table_name} where {pk_name} in ({', '.join(['%s'] * len(chunk))})"
+                    await cursor.execute(sql, chunk)
+                    total += cursor.rowcount
+                    await cls.commit(conn)
+
+        return total
+
+    @classmethod
+    async def get_large(cls, db_name: str, table_name: str, pks: list, names: List[str] = [],
+                        chunk_size: int = 1000) -> dict:
+        # 旁表 {table_name}_large 的大字段。 返回 {主键: {字段名: (压缩方式, 值)}}
+        result = {}
+        if not db_name or not table_name or not pks:
+            return result
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return result
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                for chunk in chunk_list(list(dict.fromkeys(pks)), chunk_size):
+                    await cursor.execute(select_large_sql(table_name, len(chunk), len(names)),
+                                         tuple(chunk) + tuple(names))
+                    for pk, name, method, value in await cursor.fetchall():
+                        result.setdefault(pk, {})[name] = (method, value)
+
+        return result
+
+    @classmethod
+    async def set_large(cls, db_name: str, table_name: str, rows: List[tuple], chunk_size: int = 50) -> int:
+        # 写入旁表。 rows [(主键, 字段名, 压缩方式, 值)], 分段执行 每段单独提交
+        total = 0
+        if not db_name or not table_name or not rows:
+            return total
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return total
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                for chunk in chunk_list(list(rows), chunk_size):
+                    await cursor.execute(upsert_large_sql(table_name, len(chunk)),
+                                         [value for row in chunk for value in row])
+                    total += cursor.rowcount
+                    await cls.commit(conn)
+
+        return total
+
+    @classmethod
+    async def delete_large(cls, db_name: str, table_name: str, pks: list, names: List[str] = [],
+                           chunk_size: int = 1000) -> int:
+        # 删除旁表里主键的大字段。 names 为空时删除全部
+        total = 0
+        if not db_name or not table_name or not pks:
+            return total
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return total
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                for chunk in chunk_list(list(pks), chunk_size):
+                    await cursor.execute(delete_large_sql(table_name, len(chunk), len(names)),
+                                         tuple(chunk) + tuple(names))
+                    total += cursor.rowcount
+                    await cls.commit(conn)
+
+        return total
 
     @classmethod
     async def query(cls,
               db_name: str,
               table_name: str,
               query_dict: dict,
-              cursor: int = 0,
+              cursor=0,
               limit: int = 10,
               desc: bool = True,
               pk_name: str = 'id',
               index_fields: List[str] = [],
+              only: List[str] = [],
+              order_by: List[str] = [],
               ) -> List[dict]:
         # 分页获取数量
+        # only 只取部分字段
+        # order_by 按映射列排序 ['-update_time', 'id']。 这时 cursor 是 encode_cursor 生成的游标
         result = []
 
-        base_sql = f'select id, data from {table_name} '
-        query_arr = []
-        args = []
-
-        if index_fields:
-            # 先组织索引查找条件
-            for column in index_fields:
-                if column in query_dict:
-                    value = query_dict.get(column)
-                    query_arr.append(f'{column}=%s')
-                    args.append(value)
-                    # 查询条件已经用过了。删除
-                    query_dict.pop(column)
-                else:
-                    break
-
-        # 组织普通查找条件
-        for column, value in query_dict.items():
-            if '__' in column:
-                column, op = column.split('__')
-                mysql_op = OP_DICT.get(op, None)
-                if not mysql_op:
-                    continue
-                query_arr.append(f'{column}{mysql_op}%s')
-                args.append(value)
-            else:
-                query_arr.append(f'{column}=%s')
-                args.append(value)
-
-        if cursor > 0:
-            if desc:
-                query_arr.append(f'{pk_name} < %s')
-            else:
-                query_arr.append(f'{pk_name} > %s')
-            args.append(cursor)
-
-        if query_arr:
-            query_sql = ' and '.join(query_arr)
-            if desc:
-                sql = f'{base_sql} where {query_sql} order by {pk_name} desc limit %s'
-            else:
-                sql = f'{base_sql} where {query_sql} limit %s'
-        else:
-            if desc:
-                sql = f'{base_sql} order by {pk_name} desc limit %s'
-            else:
-                sql = f'{base_sql} limit %s'
-
-        args.append(limit)
+        plan, query_dict, values = page_plan(table_name, query_dict, cursor, desc, pk_name, index_fields, only, order_by)
+        if not plan:
+            return result
+        sql = plan.select_sql
+        args = plan.bind(query_dict, values, limit)
 
-        pool = await cls.get_pool(db_name)
+        pool = await cls.get_pool(db_name, read=True)
         if not pool:
             return []
 
-        with (await pool) as conn:
+        with (await cls.connect(db_name, pool)) as conn:
             async with conn.cursor() as cursor:
-                await cursor.execute(sql, tuple(args))
+                await cursor.execute(sql, args)
                 items = await cursor.fetchall()
                 for pk, raw_data in items:
-                    json_data = json.loads(raw_data)
+                    json_data = codec.loads(raw_data)
                     json_data['pk'] = pk
                     result.append(json_data)
 
         return result
 
     @classmethod
-    async def query_count(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> int:
-        # 分页获取数量
-        count = 0
+    async def query_ids(cls,
+                        db_name: str,
+                        table_name: str,
+                        query_dict: dict,
+                        cursor=0,
+                        limit: int = 10,
+                        desc: bool = True,
+                        pk_name: str = 'id',
+                        index_fields: List[str] = [],
+                        order_by: List[str] = [],
+                        ) -> List[int]:
+        # 分页只取主键 再用 get_by_pks 取数据
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return []
 
-        base_sql = f'select count(1) from {table_name} '
-        query_arr = []
-        args = []
-
-        if index_fields:
-            # 先组织索引查找条件
-            for column in index_fields:
-                if column in query_dict:
-                    value = query_dict.get(column)
-                    query_arr.append(f'{column}=%s')
-                    args.append(value)
-                    # 查询条件已经用过了。删除
-                    query_dict.pop(column)
-                else:
-                    break
+        plan, query_dict, values = page_plan(table_name, query_dict, cursor, desc, pk_name, index_fields, [], order_by)
+        if not plan:
+            return []
 
-        for column, value in query_dict.items():
-            if '__' in column:
-                column, op = column.split('__')
-                mysql_op = OP_DICT.get(op, None)
-                if not mysql_op:
-                    continue
-                query_arr.append(f'{column}{mysql_op}%s')
-                args.append(value)
-            else:
-                query_arr.append(f'{column}=%s')
-                args.append(value)
+        with (await cls.connect(db_name, pool)) as conn:
+            cursor = await conn.cursor()
+            await cursor.execute(plan.ids_sql, plan.bind(query_dict, values, limit))
+            rows = await cursor.fetchall()
+        return [row[0] for row in rows]
+
+    @classmethod
+    async def query_with_count(cls,
+                               db_name: str,
+                               table_name: str,
+                               query_dict: dict,
+                               cursor=0,
+                               limit: int = 10,
+                               desc: bool = True,
+                               pk_name: str = 'id',
+                               index_fields: List[str] = [],
+                               only: List[str] = [],
+                               order_by: List[str] = [],
+                               ):
+        # 分页数据和总数 一次往返。 返回 [数据], 总数
+        # 总数用标量子查询放在每一行里。 这一页没有数据时再单独计数
+        result = []
+        total = 0
+
+        plan, query_dict, values = page_plan(table_name, query_dict, cursor, desc, pk_name, index_fields, only, order_by)
+        if not plan:
+            return result, total
+        sql = plan.select_count_sql
+        args = plan.bind_with_count(query_dict, values, limit)
+
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return result, total
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as db:
+                await db.execute(sql, args)
+                items = await db.fetchall()
+                for pk, raw_data, count in items:
+                    json_data = codec.loads(raw_data)
+                    json_data['pk'] = pk
+                    result.append(json_data)
+                    total = count
+                # 第一页没有数据 总数就是0
+                if not items and values:
+                    await db.execute(plan.count_sql, tuple(plan.bind_where(query_dict)))
+                    item = await db.fetchone()
+                    total = item[0]
+
+        return result, total
+
+    @classmethod
+    async def stream(cls,
+                     db_name: str,
+                     table_name: str,
+                     query_dict: dict,
+                     index_fields: List[str] = [],
+                     chunk_size: int = 1000) -> AsyncIterator[List[dict]]:
+        # 服务端游标流式读取。 按主键正序, 每次返回 chunk_size 条, 内存占用固定
+        # 事务中改为在事务的连接上按主键分段查询, 能读到未提交的写入, 分段之间不占用连接
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return
+
+        query_arr, args = build_where(query_dict, index_fields)
+        if current_transaction(db_name):
+            last_pk = 0
+            while True:
+                sql = (f'select id, data from {table_name} where {" and ".join(query_arr + ["id > %s"])} '
+                       f'order by id limit {chunk_size}')
+                with (await cls.connect(db_name, pool)) as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(sql, tuple(args + [last_pk]))
+                        items = await cursor.fetchall()
+                if not items:
+                    break
+                chunk = []
+                for pk, raw_data in items:
+                    json_data = codec.loads(raw_data)
+                    json_data['pk'] = pk
+                    chunk.append(json_data)
+                yield chunk
+                if len(items) < chunk_size:
+                    break
+                last_pk = items[-1][0]
+            return
 
+        sql = f'select id, data from {table_name}'
         if query_arr:
-            query_sql = ' and '.join(query_arr)
-            sql = f'{base_sql} where {query_sql}'
-        else:
-            sql = base_sql
+            sql = f'{sql} where {" and ".join(query_arr)}'
+        sql = f'{sql} order by id'
+
+        with (await cls.connect(db_name, pool)) as conn:
+            cursor = await conn.cursor(aiomysql.SSCursor)
+            try:
+                await cursor.execute(sql, tuple(args))
+                while True:
+                    items = await cursor.fetchmany(chunk_size)
+                    if not items:
+                        break
+                    chunk = []
+                    for pk, raw_data in items:
+                        json_data = codec.loads(raw_data)
+                        json_data['pk'] = pk
+                        chunk.append(json_data)
+                    yield chunk
+            finally:
+                await cursor.close()
+
+    @classmethod
+    async def query_count(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> int:
+        # 分页获取数量
+        count = 0
+
+        plan, query_dict = where_plan(table_name, query_dict, index_fields)
+        sql = plan.count_sql
+        args = plan.bind_where(query_dict)
         total = 0
-        pool = await cls.get_pool(db_name)
+        pool = await cls.get_pool(db_name, read=True)
         if not pool:
             return total
 
-        with (await pool) as conn:
+        with (await cls.connect(db_name, pool)) as conn:
             async with conn.cursor() as cursor:
-                if query_arr:
-                    await cursor.execute(sql, tuple(args))
-                else:
-                    await cursor.execute(sql)
+                await cursor.execute(sql, tuple(args))
 
                 item = await cursor.fetchone()
                 count = item[0]
@@ -292,20 +717,114 @@ class AMConnection(object):
         return total
 
     @classmethod
-    async def raw_query(cls, db_name: str, sql: str) -> list:
+    async def aggregate(cls,
+                        db_name: str,
+                        table_name: str,
+                        query_dict: dict,
+                        aggregates: dict,
+                        group_by: List[str] = [],
+                        index_fields: List[str] = [],
+                        order_by: List[str] = [],
+                        limit: int = 0) -> List[dict]:
+        # 在映射列上做聚合 每个分组返回一个 dict
+        sql, args, columns = aggregate_plan(table_name, query_dict, aggregates, group_by, index_fields, order_by, limit)
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return []
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, args)
+                items = await cursor.fetchall()
+        return [dict(zip(columns, [plain_value(value) for value in item])) for item in items]
+
+    @classmethod
+    async def exists(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> bool:
+        # 是否有满足条件的数据。 找到一行就停止
+        plan, query_dict = where_plan(table_name, query_dict, index_fields)
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return False
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(plan.exists_sql, tuple(plan.bind_where(query_dict)))
+                item = await cursor.fetchone()
+                return item is not None
+
+    @classmethod
+    async def estimate_count(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> int:
+        # 估算数量 不扫描数据
+        # 没有条件时用 information_schema 的表行数, 有条件时用 EXPLAIN 的 rows * filtered
+        plan, query_dict = where_plan(table_name, query_dict, index_fields)
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return 0
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                if not plan.conditions:
+                    await cursor.execute(TABLE_ROWS_SQL, (table_name,))
+                    item = await cursor.fetchone()
+                    return int(item[0] or 0) if item else 0
+
+                await cursor.execute(f'explain {plan.count_sql}', tuple(plan.bind_where(query_dict)))
+                columns = [col[0] for col in cursor.description]
+                return explain_rows(columns, await cursor.fetchone())
+
+    @classmethod
+    async def run_ddl(cls, db_name: str, sqls: List[str]) -> bool:
+        # 执行建表、删表等 DDL。 不用事务固定的连接, 不会隐式提交当前事务
+        pool = await cls.get_pool(db_name)
+        if not pool:
+            return False
+        try:
+            with (await pool) as conn:
+                async with conn.cursor() as cursor:
+                    for sql in sqls:
+                        await cursor.execute(sql)
+            return True
+        except Exception as e:
+            print(f'ddl error:{e}')
+            return False
+
+    @classmethod
+    async def raw_query(cls, db_name: str, sql: str, args: Optional[tuple] = None, read: bool = False) -> list:
         # 执行裸查询
+        # read 只读的查询 可以走从库, 不会让后面的读取粘在主库
         result = []
-        pool = await cls.get_pool(db_name)
+        pool = await cls.get_pool(db_name, read=read)
         if not pool:
             return result
 
-        with (await pool) as conn:
+        with (await cls.connect(db_name, pool)) as conn:
             async with conn.cursor() as cursor:
-                await cursor.execute(sql)
+                await cursor.execute(sql, args)
                 items = await cursor.fetchall()
                 result = items
 
         return result
 
+    @classmethod
+    async def batch_query(cls, db_name: str, parts: List[tuple]) -> dict:
+        # 同一个库的多个查询 UNION ALL 一次往返
+        # parts [(sql, 参数), ...] 每个 sql 都是 select id, data ... 。 返回 {序号: [(id, data), ...]}
+        result = {}
+        if not parts:
+            return result
+        pool = await cls.get_pool(db_name, read=True)
+        if not pool:
+            return result
+        sql, args = union_sql(parts)
+
+        with (await cls.connect(db_name, pool)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, args)
+                items = await cursor.fetchall()
+
+        for tag, pk, raw_data in items:
+            result.setdefault(tag, []).append((pk, raw_data))
+        return result
+
 
 mysql_connect = AMConnection()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    data 列的json编解码
+    默认按 orjson > ujson > json 的顺序使用已安装的库。
+    MYSQL_JSON_CODEC 或 set_codec 可指定 orjson / ujson / json。
+
+    用法:
+        from mbase.db import codec
+        codec.dumps(data_dict)
+        codec.loads(raw_data)
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from mbase.config import MYSQL_JSON_CODEC
+
+
+def json_dumps(obj) -> str:
+    return json.dumps(obj)
+
+
+def json_loads(raw):
+    # 标准库可以直接解析 bytes
+    return json.loads(raw)
+
+
+def orjson_dumps(obj) -> str:
+    # orjson 返回 bytes。 JSON列不接受 binary 字符集的参数, 转成 str
+    # 超出 64 位的整数等 orjson 不支持的值 退回标准库
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    except TypeError:
+        return json.dumps(obj)
+
+
+def orjson_loads(raw):
+    return orjson.loads(raw)
+
+
+def ujson_dumps(obj) -> str:
+    try:
+        return ujson.dumps(obj, ensure_ascii=False)
+    except (TypeError, OverflowError):
+        return json.dumps(obj)
+
+
+def ujson_loads(raw):
+    return ujson.loads(raw)
+
+
+CODECS = {
+    'json': (json_dumps, json_loads),
+}
+if orjson:
+    CODECS['orjson'] = (orjson_dumps, orjson_loads)
+if ujson:
+    CODECS['ujson'] = (ujson_dumps, ujson_loads)
+
+name = ''
+dumps = json_dumps
+loads = json_loads
+
+
+def set_codec(codec_name: str = '') -> str:
+    # 切换编解码库。 不传或者没有安装时自动选择
+    global name, dumps, loads
+
+    if codec_name and codec_name not in CODECS:
+        print(f'json codec:{codec_name} not installed')
+        codec_name = ''
+    if not codec_name:
+        for codec_name in ('orjson', 'ujson', 'json'):
+            if codec_name in CODECS:
+                break
+
+    name = codec_name
+    dumps, loads = CODECS[codec_name]
+    return name
+
+
+set_codec(MYSQL_JSON_CODEC)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    根据模型生成 MySQL 建表、改表语句
+    data 列存json, 做了字段映射的字段生成 GENERATED 列, 索引建在生成列上。
+'''
+
+from typing import List
+
+from mbase.db.query import json_path
+from mbase.fields import BoolField, DateTimeField, EnumField, FloatField, IntField, StringField
+
+
+# 字段类型 -> 生成列类型。 子类在前
+COLUMN_TYPES = [
+    (DateTimeField, 'BIGINT'),
+    (EnumField, 'INT'),
+    (BoolField, 'TINYINT'),
+    (IntField, 'BIGINT'),
+    (FloatField, 'DOUBLE'),
+    (StringField, 'VARCHAR(255)'),
+]
+
+# 默认表选项 和 sample/t.sql 一致使用压缩行格式
+TABLE_OPTIONS = 'ENGINE=InnoDB ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=4 DEFAULT CHARSET=utf8mb4'
+
+# 索引名最长 64
+MAX_NAME_LENGTH = 64
+
+SCHEMA_COLUMNS_SQL = ('select COLUMN_NAME, COLUMN_TYPE, EXTRA from information_schema.COLUMNS '
+                      'where TABLE_SCHEMA = database() and TABLE_NAME = %s')
+SCHEMA_INDEXES_SQL = ('select INDEX_NAME, COLUMN_NAME from information_schema.STATISTICS '
+                      'where TABLE_SCHEMA = database() and TABLE_NAME = %s order by INDEX_NAME, SEQ_IN_INDEX')
+
+
+def column_type(field) -> str:
+    # 指定了 column_type 用指定的
+    if getattr(field, 'column_type', ''):
+        return field.column_type
+    for field_class, sql_type in COLUMN_TYPES:
+        if isinstance(field, field_class):
+            return sql_type
+    return 'VARCHAR(255)'
+
+
+def column_expr(field, column: str = 'data') -> str:
+    # 生成列表达式。 json 的 true/false 不能直接转成数字, 单独比较
+    path = json_path((field.name,))
+    if isinstance(field, BoolField):
+        return f"JSON_EXTRACT({column}, '{path}') = CAST('true' AS JSON)"
+    return f"JSON_UNQUOTE(JSON_EXTRACT({column}, '{path}'))"
+
+
+def column_config(field) -> dict:
+    return {
+        'name': field.name,
+        'type': column_type(field),
+        'expr': column_expr(field),
+        'stored': bool(getattr(field, 'stored', False)),
+    }
+
+
+def index_name(fields: tuple, unique: bool = False) -> str:
+    prefix = 'udx' if unique else 'idx'
+    return f"{prefix}_{'_'.join(fields)}"[:MAX_NAME_LENGTH]
+
+
+def index_config(index) -> dict:
+    unique = bool(getattr(index, 'unique', False))
+    return {
+        'name': index.index_name or index_name(index.field_list, unique),
+        'fields': list(index.field_list),
+        'unique': unique,
+    }
+
+
+def column_sql(column: dict) -> str:
+    kind = 'STORED' if column['stored'] else 'VIRTUAL'
+    return f"{column['name']} {column['type']} GENERATED ALWAYS AS ({column['expr']}) {kind}"
+
+
+def index_sql(index: dict) -> str:
+    kind = 'UNIQUE' if index['unique'] else 'KEY'
+    return f"{kind} {index['name']}({', '.join(index['fields'])})"
+
+
+def create_table_sql(table_name: str, table_config: dict) -> str:
+    lines = [
+        'id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT',
+        'data JSON NOT NULL',
+    ]
+    lines += [column_sql(column) for column in table_config.get('columns', [])]
+    lines.append('PRIMARY KEY(id)')
+    lines += [index_sql(index) for index in table_config.get('indexes', [])]
+
+    body = ',\n  '.join(lines)
+    options = table_config.get('options') or TABLE_OPTIONS
+    return f'create table if not exists {table_name}(\n  {body}\n) {options}'
+
+
+def alter_table_sqls(table_name: str, table_config: dict, columns: dict, indexes: dict) -> List[str]:
+    # 和库里的表结构比较 生成缺少的列和索引
+    # columns 库里的 {列名: 类型}, indexes 库里的 {索引名: (列, ...)}
+    # 只增加不删除。 虚拟列和二级索引可以在线添加 ALGORITHM=INPLACE, LOCK=NONE
+    sqls = []
+    for column in table_config.get('columns', []):
+        if column['name'] in columns:
+            continue
+        if column['stored']:
+            # STORED 列需要重建表 不能 INPLACE
+            sqls.append(f'alter table {table_name} add column {column_sql(column)}')
+        else:
+            sqls.append(f'alter table {table_name} add column {column_sql(column)}, ALGORITHM=INPLACE, LOCK=NONE')
+
+    exist_fields = set(indexes.values())
+    for index in table_config.get('indexes', []):
+        if index['name'] in indexes or tuple(index['fields']) in exist_fields:
+            continue
+        sqls.append(f'alter table {table_name} add {index_sql(index)}, ALGORITHM=INPLACE, LOCK=NONE')
+    return sqls
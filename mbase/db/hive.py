@@ -12,15 +12,7 @@ from typing import List
 
 from pyhive import hive
 
-
-# 运算符字典
-OP_DICT = {
-    'gte': '>=',
-    'gt': '>',
-    'lte': '<=',
-    'lt': '<',
-    'ne': '<>',
-}
+from mbase.db.query import build_where
 
 
 class HiveConnection(object):
@@ -61,21 +53,8 @@ class HiveConnection(object):
         result = []
 
         base_sql = f'select * from {table_name} '
-        query_arr = []
-        args = []
-
-        for column, value in query_dict.items():
-            # 支持 大于 大于等于 小于 小于等于 不等于 运算符
-            if '__' in column:
-                column, op = column.split('__')
-                mysql_op = OP_DICT.get(op, None)
-                if not mysql_op:
-                    continue
-                query_arr.append(f'{column}{mysql_op}%s')
-                args.append(value)
-            else:
-                query_arr.append(f'{column}=%s')
-                args.append(value)
+        # 和 MySQL 共用条件拼装 支持同样的运算符
+        query_arr, args = build_where(query_dict)
 
         if cursor > 0:
             if desc:
@@ -112,21 +91,7 @@ class HiveConnection(object):
         count = 0
 
         base_sql = f'select count(1) from {table_name} '
-        query_arr = []
-        args = []
-
-        for column, value in query_dict.items():
-            # 支持运算符
-            if '__' in column:
-                column, op = column.split('__')
-                mysql_op = OP_DICT.get(op, None)
-                if not mysql_op:
-                    continue
-                query_arr.append(f'{column}{mysql_op}%s')
-                args.append(value)
-            else:
-                query_arr.append(f'{column}=%s')
-                args.append(value)
+        query_arr, args = build_where(query_dict)
 
         if query_arr:
             query_sql = ' and '.join(query_arr)
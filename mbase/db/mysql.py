@@ -7,45 +7,174 @@
     @Time    : 2020-11-03
 '''
 
-import json
-from typing import List
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
 
 import pymysql
+import pymysql.cursors
 
 from mbase.config import MYSQL_CONFIG
-
-
-# 运算符字典
-OP_DICT = {
-    'gte': '>=',
-    'gt': '>',
-    'lte': '<=',
-    'lt': '<',
-    'ne': '<>',
-}
+from mbase.db import codec
+from mbase.db.ddl import SCHEMA_COLUMNS_SQL, SCHEMA_INDEXES_SQL, alter_table_sqls, create_table_sql
+from mbase.db.pool import ConnectionPool
+from mbase.db.route import ReplicaRouter, mark_write, read_primary, use_primary
+from mbase.db.transaction import Transaction, conn_transaction, current_transaction, enter_transaction, ATOMIC
+from mbase.db.query import (OP_DICT, TABLE_ROWS_SQL, aggregate_plan, build_where, chunk_list, data_expr, explain_rows,
+                            json_path, json_update_expr, page_plan, plain_value, union_sql, version_expr, where_plan)
+from mbase.large import delete_large_sql, select_large_sql, upsert_large_sql
 
 
 class MConnection(object):
 
+    # 每个库一个连接池
     CONN_DICT = {}
+    # 每个库的从库连接池 和从库选择
+    REPLICA_DICT = {}
+    ROUTER_DICT = {}
+    INIT_LOCK = threading.Lock()
+
+    @classmethod
+    def create_pool(cls, config: dict) -> ConnectionPool:
+
+        def creator():
+            return pymysql.connect(host=config.get('host'),
+                                   port=config.get('port', 3306),
+                                   user=config.get('user'),
+                                   password=config.get('password'),
+                                   db=config.get('db'),
+                                   charset=config.get('charset'))
+
+        return ConnectionPool(creator,
+                              min_size=config.get('pool_min_size', 1),
+                              max_size=config.get('pool_max_size', 10),
+                              timeout=config.get('pool_timeout', 30),
+                              recycle=config.get('pool_recycle', 3600),
+                              ping_interval=config.get('pool_ping_interval', 30))
 
     @classmethod
-    def get_conn(cls, db_name: str):
+    def get_pool(cls, db_name: str, read: bool = False) -> Optional[ConnectionPool]:
+        # read 读操作。 配置了从库 且不需要读主库时 返回从库连接池
+        if read and not read_primary():
+            replicas = cls.get_replicas(db_name)
+            if replicas:
+                return cls.ROUTER_DICT[db_name].choose(replicas, lambda pool: pool.in_use)
+        elif not read:
+            mark_write()
+
         if db_name in cls.CONN_DICT:
             return cls.CONN_DICT[db_name]
-        else:
-            if db_name in MYSQL_CONFIG:
-                config = MYSQL_CONFIG.get(db_name)
-                conn = pymysql.connect(host=config.get('host'),
-                                       user=config.get('user'),
-                                       password=config.get('password'),
-                                       db=config.get('db'),
-                                       charset=config.get('charset'))
-                cls.CONN_DICT[db_name] = conn
-
-                return conn
+
+        if db_name not in MYSQL_CONFIG:
+            return None
+
+        with cls.INIT_LOCK:
+            if db_name in cls.CONN_DICT:
+                return cls.CONN_DICT[db_name]
+            pool = cls.create_pool(MYSQL_CONFIG.get(db_name))
+            cls.CONN_DICT[db_name] = pool
+
+        return pool
+
+    @classmethod
+    def get_replicas(cls, db_name: str) -> List[ConnectionPool]:
+        # 从库连接池。 从库配置没写的项 和主库一致
+        if db_name in cls.REPLICA_DICT:
+            return cls.REPLICA_DICT[db_name]
+
+        config = MYSQL_CONFIG.get(db_name)
+        if not config:
+            return []
+
+        with cls.INIT_LOCK:
+            if db_name in cls.REPLICA_DICT:
+                return cls.REPLICA_DICT[db_name]
+            pools = []
+            for replica in config.get('replicas', []):
+                replica_config = dict(config)
+                replica_config.update(replica)
+                pools.append(cls.create_pool(replica_config))
+            cls.ROUTER_DICT[db_name] = ReplicaRouter(config.get('replica_policy', 'round_robin'))
+            cls.REPLICA_DICT[db_name] = pools
+
+        return pools
+
+    @classmethod
+    def pool_status(cls, db_name: str) -> dict:
+        # 连接池统计信息
+        pool = cls.CONN_DICT.get(db_name)
+        if not pool:
+            return {}
+        status = pool.status()
+        if cls.REPLICA_DICT.get(db_name):
+            status['replicas'] = [replica.status() for replica in cls.REPLICA_DICT[db_name]]
+        return status
+
+    @classmethod
+    def execute(cls, db_name: str, work, default=None, read: bool = False, pool: Optional[ConnectionPool] = None):
+        # 从连接池取连接执行 work(conn)。 连接断开时重连重试一次
+        # read 读操作 可以走从库。 pool 指定连接池
+        pool = pool or cls.get_pool(db_name, read)
+        if not pool:
+            return default
+
+        with pool.connection() as conn:
+            try:
+                return work(conn)
+            except Exception as e:
+                tx = conn_transaction(conn)
+                if tx:
+                    # 事务中出错不重试 结束时回滚
+                    tx.failed = True
+                    raise e
+                if not conn.open:
+                    conn.ping()
+                    return work(conn)
+                else:
+                    raise e
+
+    @classmethod
+    def commit(cls, conn):
+        # 事务中的连接 推迟到事务结束时提交
+        if not conn_transaction(conn):
+            conn.commit()
+
+    @classmethod
+    @contextmanager
+    def atomic(cls, db_name: str, batch: bool = False):
+        # 事务。 作用域内同一线程使用同一个主库连接, 结束时提交一次, 出错时回滚
+        # 嵌套时并入外层事务
+        tx = current_transaction(db_name)
+        if tx:
+            yield tx
+            return
+
+        pool = cls.get_pool(db_name)
+        if not pool:
+            print('no conn')
+            yield None
+            return
+
+        with use_primary(), pool.connection() as conn:
+            conn.begin()
+            tx = Transaction(db_name, conn, batch)
+            token = enter_transaction(tx)
+            try:
+                yield tx
+                if tx.pending and tx.flush:
+                    tx.flushing = True
+                    tx.flush(tx)
+            except BaseException:
+                ATOMIC.reset(token)
+                conn.rollback()
+                raise
+            ATOMIC.reset(token)
+            if tx.failed:
+                print(f'{db_name} transaction rollback')
+                conn.rollback()
             else:
-                return None
+                conn.commit()
 
     @classmethod
     def process_in_params(cls, args):
@@ -55,56 +184,133 @@ class MConnection(object):
     @classmethod
     def insert(cls, db_name: str, table_name: str, data_dict: dict) -> int:
         # 添加
-        conn = cls.get_conn(db_name)
         last_id = -1
-        if not conn:
+        if not cls.get_pool(db_name):
             print('no conn')
             return last_id
-        try:
-            conn.ping()
+
+        def _work(conn):
             with conn.cursor() as db:
                 sql = f'insert into {table_name}(data) value(%s)'
-                db.execute(sql, (json.dumps(data_dict),))
-                last_id = db.lastrowid
-            conn.commit()
+                db.execute(sql, (codec.dumps(data_dict),))
+                row_id = db.lastrowid
+            cls.commit(conn)
+            return row_id
+
+        try:
+            last_id = cls.execute(db_name, _work, last_id)
         except:
             pass
 
         return last_id
 
     @classmethod
-    def get_by_pks(cls, db_name: str, table_name: str, pks: List[int], pk_name: str = 'id') -> dict:
+    def bulk_insert(cls,
+                    db_name: str,
+                    table_name: str,
+                    data_list: List[dict],
+                    batch_size: int = 500,
+                    max_bytes: int = 2 * 1024 * 1024) -> List[int]:
+        # 批量添加。 多行 insert, 每批提交一次, 返回自增ID(与 data_list 顺序一致)
+        # 每批按行数和语句字节数切分, 避免超过 max_allowed_packet
+        ids = []
+        if not db_name or not table_name or not data_list:
+            return ids
+
+        batches = []
+        batch, batch_bytes = [], 0
+        for data_dict in data_list:
+            raw_data = codec.dumps(data_dict)
+            size = len(raw_data.encode('utf-8')) + 4
+            if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(raw_data)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+
+        pool = cls.get_pool(db_name)
+        if not pool:
+            return ids
+
+        def _step(conn):
+            with conn.cursor() as db:
+                db.execute('select @@auto_increment_increment')
+                return int(db.fetchone()[0] or 1)
+
+        def _insert(rows):
+            def _work(conn):
+                with conn.cursor() as db:
+                    sql = f'insert into {table_name}(data) values ' + ', '.join(['(%s)'] * len(rows))
+                    db.execute(sql, rows)
+                    # 多行插入 lastrowid 是第一行的ID。
+                    # innodb_autoinc_lock_mode 为 0/1 时同一条语句分配的ID是连续的
+                    first_id = db.lastrowid
+                    cls.commit(conn)
+                    return first_id
+            return _work
+
+        # 每批单独执行。 断线重试只重做当前这一批, 已经提交的批次不会重复插入
+        step = cls.execute(db_name, _step, 1, pool=pool)
+        for rows in batches:
+            first_id = cls.execute(db_name, _insert(rows), 0, pool=pool)
+            ids.extend([first_id + i * step for i in range(len(rows))])
+        return ids
+
+    @classmethod
+    def get_by_pks(cls,
+                   db_name: str,
+                   table_name: str,
+                   pks: List[int],
+                   pk_name: str = 'id',
+                   chunk_size: int = 0,
+                   only: List[str] = []) -> dict:
         # 根据IDS 获取json信息
+        # only 只取部分字段
+        # 主键去重后按 chunk_size 切分 IN 列表, 多个分段用连接池里的连接并发查询
+        # 事务中在事务的连接上依次查询, 能读到未提交的写入
         result = {}
         if not db_name or not table_name or not pks:
             return result
 
-        conn = cls.get_conn(db_name)
-        if not conn:
+        pool = cls.get_pool(db_name, read=True)
+        if not pool:
             return result
 
-        def _work():
-            with conn.cursor() as db:
-                sql = f'select id, data from {table_name} where {pk_name} in (%s)'
-                sql = sql % (cls.process_in_params(pks),)
-                db.execute(sql, pks)
-                items = db.fetchall()
-                for item in items:
-                    pk, raw_data = item
-                    json_data = json.loads(raw_data)
-                    json_data['pk'] = pk
-                    if pk_name == 'id':
-                        result[pk] = json_data
-                    else:
-                        result[json_data[pk_name]] = json_data
-        try:
-            _work()
-        except Exception as e:
-            if not conn.open:
-                conn.ping()
-                _work()
-            else:
-                raise e
+        if not chunk_size:
+            chunk_size = MYSQL_CONFIG.get(db_name, {}).get('in_chunk_size', 1000)
+        pks = list(dict.fromkeys(pks))
+        if only and pk_name != 'id' and pk_name not in only:
+            only = list(only) + [pk_name]
+        select_sql = f'select id, {data_expr(tuple(only))} from {table_name}'
+
+        def _fetch(chunk):
+            def _work(conn):
+                with conn.cursor() as db:
+                    sql = f'{select_sql} where {pk_name} in (%s)'
+                    sql = sql % (cls.process_in_params(chunk),)
+                    db.execute(sql, chunk)
+                    return db.fetchall()
+            # 各个分段用同一个连接池
+            return cls.execute(db_name, _work, [], pool=pool)
+
+        chunks = chunk_list(pks, chunk_size)
+        if len(chunks) == 1 or current_transaction(db_name):
+            chunk_items = [_fetch(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), pool.max_size)) as executor:
+                chunk_items = list(executor.map(_fetch, chunks))
+
+        for items in chunk_items:
+            for item in items:
+                pk, raw_data = item
+                json_data = codec.loads(raw_data)
+                json_data['pk'] = pk
+                if pk_name == 'id':
+                    result[pk] = json_data
+                else:
+                    result[json_data[pk_name]] = json_data
 
         return result
 
@@ -120,223 +326,565 @@ class MConnection(object):
         total = 0
         if not db_name or not table_name or not pk or not data_dict:
             return total
-        conn = cls.get_conn(db_name)
-        if not conn:
-            return -1
 
-        def _work():
+        def _work(conn):
             with conn.cursor() as db:
                 sql = f'update {table_name} set data = %s where {pk_name} = %s'
                 # sql = f'update {table_name} set data = %s where {pk_name} = %s and dver = %s'
-                raw_data = json.dumps(data_dict)
+                raw_data = codec.dumps(data_dict)
                 db.execute(sql, (raw_data, pk))
-                total = db.rowcount
-        try:
-            _work()
-        except Exception as e:
-            if not conn.open:
-                conn.ping()
-                _work()
-            else:
-                raise e
+                count = db.rowcount
+            # 连接会放回池中复用 不能留下未提交的事务
+            cls.commit(conn)
+            return count
 
-        return total
+        return cls.execute(db_name, _work, -1)
+
+    @classmethod
+    def upsert(cls, db_name: str, table_name: str, pk: int, data_dict: dict, version_field: str = 'dver') -> int:
+        # 一次往返 添加或更新。 版本号在SQL里计算(< 127 加1 否则归0), 不需要先读旧数据
+        total = 0
+        if not db_name or not table_name or not pk or not data_dict:
+            return total
+
+        sql = f'insert into {table_name}(id, data) values(%s, %s) on duplicate key update data = '
+        if version_field:
+            sql += f"JSON_SET(VALUES(data), '{json_path((version_field,))}', {version_expr(version_field)})"
+        else:
+            sql += 'VALUES(data)'
+
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, (pk, codec.dumps(data_dict)))
+                count = db.rowcount
+            cls.commit(conn)
+            return count
+
+        return cls.execute(db_name, _work, -1)
+
+    @classmethod
+    def update_fields(cls,
+                      db_name: str,
+                      table_name: str,
+                      pk: int,
+                      set_dict: dict,
+                      remove_list: List[tuple] = [],
+                      version_field: str = '') -> int:
+        # 只修改 data 里指定的json路径。 set_dict {路径tuple: 值}
+        total = 0
+        if not db_name or not table_name or not pk:
+            return total
+        if not set_dict and not remove_list and not version_field:
+            return total
+
+        expr, args = json_update_expr(set_dict, remove_list, version_field)
+        sql = f'update {table_name} set data = {expr} where id = %s'
+        args.append(pk)
+
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, tuple(args))
+                count = db.rowcount
+            cls.commit(conn)
+            return count
+
+        return cls.execute(db_name, _work, -1)
 
     @classmethod
     def delete(cls, db_name: str, table_name: str, pk: int, pk_name: str = 'id') -> None:
         # 删除
-        conn = cls.get_conn(db_name)
-        if not conn:
-            return
-
-        def _work():
+        def _work(conn):
             with conn.cursor() as db:
                 sql = f'delete from {table_name} where {pk_name} = %s'
                 db.execute(sql, (pk,))
+            cls.commit(conn)
 
-        try:
-            _work()
-        except Exception as e:
-            if not conn.open:
-                conn.ping()
-                _work()
-            else:
-                raise e
+        cls.execute(db_name, _work)
+
+    @classmethod
+    def execute_where(cls,
+                      db_name: str,
+                      table_name: str,
+                      head_sql: str,
+                      head_args: list,
+                      query_dict: dict,
+                      index_fields: List[str] = [],
+                      chunk_size: int = 0) -> int:
+        # 按条件执行 update / delete。 返回影响行数
+        # chunk_size > 0 时按主键区间分段执行 每段单独提交, 避免长时间持有大量行锁
+        query_arr, args = build_where(query_dict, index_fields)
+        if not query_arr:
+            print('no condition can not execute')
+            return 0
+
+        def _run(sql, sql_args):
+            def _work(conn):
+                with conn.cursor() as db:
+                    db.execute(sql, sql_args)
+                    count = db.rowcount
+                    cls.commit(conn)
+                    return count
+            return _work
+
+        if chunk_size <= 0:
+            sql = f'{head_sql} where {" and ".join(query_arr)}'
+            return cls.execute(db_name, _run(sql, tuple(head_args + args)), 0)
+
+        def _range(conn):
+            with conn.cursor() as db:
+                db.execute(f'select min(id), max(id) from {table_name} where {" and ".join(query_arr)}', tuple(args))
+                return db.fetchone()
+
+        min_id, max_id = cls.execute(db_name, _range, (None, None))
+        if min_id is None:
+            return 0
+        # 每段单独执行。 断线重试只重做当前这一段, 已经提交的段不会重复修改(例如版本号再加一次)
+        total = 0
+        sql = f'{head_sql} where {" and ".join(query_arr + ["id >= %s", "id < %s"])}'
+        start = min_id
+        while start <= max_id:
+            total += cls.execute(db_name, _run(sql, tuple(head_args + args + [start, start + chunk_size])), 0)
+            start += chunk_size
+        return total
+
+    @classmethod
+    def update_where(cls,
+                     db_name: str,
+                     table_name: str,
+                     set_dict: dict,
+                     query_dict: dict,
+                     index_fields: List[str] = [],
+                     version_field: str = '',
+                     chunk_size: int = 0) -> int:
+        # 按条件批量修改json字段。 set_dict {路径tuple: 值}
+        if not db_name or not table_name or (not set_dict and not version_field):
+            return 0
+        expr, head_args = json_update_expr(set_dict, [], version_field)
+        head_sql = f'update {table_name} set data = {expr}'
+        return cls.execute_where(db_name, table_name, head_sql, head_args, query_dict, index_fields, chunk_size)
+
+    @classmethod
+    def delete_where(cls,
+                     db_name: str,
+                     table_name: str,
+                     query_dict: dict,
+                     index_fields: List[str] = [],
+                     chunk_size: int = 0) -> int:
+        # 按条件批量删除
+        if not db_name or not table_name:
+            return 0
+        head_sql = f'delete from {table_name}'
+        return cls.execute_where(db_name, table_name, head_sql, [], query_dict, index_fields, chunk_size)
+
+    @classmethod
+    def delete_by_pks(cls, db_name: str, table_name: str, pks: list, pk_name: str = 'id', chunk_size: int = 1000) -> int:
+        # 根据主键批量删除。 分段执行 每段单独提交
+        if not db_name or not table_name or not pks:
+            return 0
+
+        def _work(conn):
+            total = 0
+            with conn.cursor() as db:
+                for chunk in chunk_list(list(pks), chunk_size):
+                    sql = f'delete from {table_name} where {pk_name} in ({cls.process_in_params(chunk)})'
+                    db.execute(sql, chunk)
+                    total += db.rowcount
+                    cls.commit(conn)
+            return total
+
+        return cls.execute(db_name, _work, 0)
+
+    @classmethod
+    def get_large(cls, db_name: str, table_name: str, pks: list, names: List[str] = [], chunk_size: int = 1000) -> dict:
+        # 旁表 {table_name}_large 的大字段。 返回 {主键: {字段名: (压缩方式, 值)}}
+        result = {}
+        if not db_name or not table_name or not pks:
+            return result
+
+        def _work(conn):
+            rows = []
+            with conn.cursor() as db:
+                for chunk in chunk_list(list(dict.fromkeys(pks)), chunk_size):
+                    db.execute(select_large_sql(table_name, len(chunk), len(names)), tuple(chunk) + tuple(names))
+                    rows.extend(db.fetchall())
+            return rows
+
+        for pk, name, method, value in cls.execute(db_name, _work, [], read=True):
+            result.setdefault(pk, {})[name] = (method, value)
+        return result
+
+    @classmethod
+    def set_large(cls, db_name: str, table_name: str, rows: List[tuple], chunk_size: int = 50) -> int:
+        # 写入旁表。 rows [(主键, 字段名, 压缩方式, 值)], 分段执行 每段单独提交
+        if not db_name or not table_name or not rows:
+            return 0
+
+        def _work(conn):
+            total = 0
+            with conn.cursor() as db:
+                for chunk in chunk_list(list(rows), chunk_size):
+                    db.execute(upsert_large_sql(table_name, len(chunk)), [value for row in chunk for value in row])
+                    total += db.rowcount
+                    cls.commit(conn)
+            return total
+
+        return cls.execute(db_name, _work, 0)
+
+    @classmethod
+    def delete_large(cls, db_name: str, table_name: str, pks: list, names: List[str] = [], chunk_size: int = 1000) -> int:
+        # 删除旁表里主键的大字段。 names 为空时删除全部
+        if not db_name or not table_name or not pks:
+            return 0
+
+        def _work(conn):
+            total = 0
+            with conn.cursor() as db:
+                for chunk in chunk_list(list(pks), chunk_size):
+                    db.execute(delete_large_sql(table_name, len(chunk), len(names)), tuple(chunk) + tuple(names))
+                    total += db.rowcount
+                    cls.commit(conn)
+            return total
+
+        return cls.execute(db_name, _work, 0)
 
     @classmethod
     def query(cls,
               db_name: str,
               table_name: str,
               query_dict: dict,
-              cursor: int = 0,
+              cursor=0,
               limit: int = 10,
               desc: bool = True,
               pk_name: str = 'id',
               index_fields: List[str] = [],
+              only: List[str] = [],
+              order_by: List[str] = [],
               ) -> List[dict]:
         # 分页获取数量
+        # only 只取部分字段
+        # order_by 按映射列排序 ['-update_time', 'id']。 这时 cursor 是 encode_cursor 生成的游标
         result = []
 
-        base_sql = f'select id, data from {table_name} '
-        query_arr = []
-        args = []
-
-        if index_fields:
-            # 先组织索引查找条件
-            for column in index_fields:
-                if column in query_dict:
-                    value = query_dict.get(column)
-                    query_arr.append(f'{column}=%s')
-                    args.append(value)
-                    # 查询条件已经用过了。删除
-                    query_dict.pop(column)
-                else:
-                    break
-
-        # 组织普通查找条件
-        for column, value in query_dict.items():
-            if '__' in column:
-                column, op = column.split('__')
-                mysql_op = OP_DICT.get(op, None)
-                if not mysql_op:
-                    continue
-                query_arr.append(f'{column}{mysql_op}%s')
-                args.append(value)
-            else:
-                query_arr.append(f'{column}=%s')
-                args.append(value)
+        plan, query_dict, values = page_plan(table_name, query_dict, cursor, desc, pk_name, index_fields, only, order_by)
+        if not plan:
+            return result
+        sql = plan.select_sql
+        args = plan.bind(query_dict, values, limit)
 
-        if cursor > 0:
-            if desc:
-                query_arr.append(f'{pk_name} < %s')
-            else:
-                query_arr.append(f'{pk_name} > %s')
-            args.append(cursor)
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, args)
+                items = db.fetchall()
+                for pk, raw_data in items:
+                    json_data = codec.loads(raw_data)
+                    json_data['pk'] = pk
+                    result.append(json_data)
 
-        if query_arr:
-            query_sql = ' and '.join(query_arr)
-            if desc:
-                sql = f'{base_sql} where {query_sql} order by {pk_name} desc limit %s'
-            else:
-                sql = f'{base_sql} where {query_sql} limit %s'
-        else:
-            if desc:
-                sql = f'{base_sql} order by {pk_name} desc limit %s'
-            else:
-                sql = f'{base_sql} limit %s'
+        cls.execute(db_name, _work, read=True)
 
-        args.append(limit)
+        return result
 
-        conn = cls.get_conn(db_name)
-        if not conn:
+    @classmethod
+    def query_ids(cls,
+                  db_name: str,
+                  table_name: str,
+                  query_dict: dict,
+                  cursor=0,
+                  limit: int = 10,
+                  desc: bool = True,
+                  pk_name: str = 'id',
+                  index_fields: List[str] = [],
+                  order_by: List[str] = [],
+                  ) -> List[int]:
+        # 分页只取主键 再用 get_by_pks 取数据
+        plan, query_dict, values = page_plan(table_name, query_dict, cursor, desc, pk_name, index_fields, [], order_by)
+        if not plan:
             return []
+        sql = plan.ids_sql
+        args = plan.bind(query_dict, values, limit)
 
-        def _work():
+        def _work(conn):
             with conn.cursor() as db:
-                db.execute(sql, tuple(args))
+                db.execute(sql, args)
+                return [row[0] for row in db.fetchall()]
+
+        return cls.execute(db_name, _work, [], read=True)
+
+    @classmethod
+    def query_with_count(cls,
+                         db_name: str,
+                         table_name: str,
+                         query_dict: dict,
+                         cursor=0,
+                         limit: int = 10,
+                         desc: bool = True,
+                         pk_name: str = 'id',
+                         index_fields: List[str] = [],
+                         only: List[str] = [],
+                         order_by: List[str] = [],
+                         ):
+        # 分页数据和总数 一次往返。 返回 [数据], 总数
+        # 总数用标量子查询放在每一行里。 这一页没有数据时再单独计数
+        plan, query_dict, values = page_plan(table_name, query_dict, cursor, desc, pk_name, index_fields, only, order_by)
+        if not plan:
+            return [], 0
+        sql = plan.select_count_sql
+        args = plan.bind_with_count(query_dict, values, limit)
+
+        def _work(conn):
+            result = []
+            total = 0
+            with conn.cursor() as db:
+                db.execute(sql, args)
                 items = db.fetchall()
-                for pk, raw_data in items:
-                    json_data = json.loads(raw_data)
+                for pk, raw_data, count in items:
+                    json_data = codec.loads(raw_data)
                     json_data['pk'] = pk
                     result.append(json_data)
-        try:
-            _work()
-        except Exception as e:
-            if not conn.open:
-                conn.ping()
-                _work()
-            else:
-                raise e
+                    total = count
+                # 第一页没有数据 总数就是0
+                if not items and values:
+                    db.execute(plan.count_sql, tuple(plan.bind_where(query_dict)))
+                    total = db.fetchone()[0]
+            return result, total
 
-        return result
+        return cls.execute(db_name, _work, ([], 0), read=True)
 
     @classmethod
-    def query_count(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> int:
-        # 分页获取数量
-        count = 0
-
-        base_sql = f'select count(1) from {table_name} '
-        query_arr = []
-        args = []
-
-        if index_fields:
-            # 先组织索引查找条件
-            for column in index_fields:
-                if column in query_dict:
-                    value = query_dict.get(column)
-                    query_arr.append(f'{column}=%s')
-                    args.append(value)
-                    # 查询条件已经用过了。删除
-                    query_dict.pop(column)
-                else:
-                    break
+    def stream(cls,
+               db_name: str,
+               table_name: str,
+               query_dict: dict,
+               index_fields: List[str] = [],
+               chunk_size: int = 1000) -> Iterator[List[dict]]:
+        # 服务端游标流式读取。 按主键正序, 每次返回 chunk_size 条, 内存占用固定
+        # 遍历期间独占一个连接。 事务中改为在事务的连接上按主键分段查询, 能读到未提交的写入
+        pool = cls.get_pool(db_name, read=True)
+        if not pool:
+            return
 
-        for column, value in query_dict.items():
-            if '__' in column:
-                column, op = column.split('__')
-                mysql_op = OP_DICT.get(op, None)
-                if not mysql_op:
-                    continue
-                query_arr.append(f'{column}{mysql_op}%s')
-                args.append(value)
-            else:
-                query_arr.append(f'{column}=%s')
-                args.append(value)
+        query_arr, args = build_where(query_dict, index_fields)
+        if current_transaction(db_name):
+            last_pk = 0
+            while True:
+                sql = (f'select id, data from {table_name} where {" and ".join(query_arr + ["id > %s"])} '
+                       f'order by id limit {chunk_size}')
+
+                def _work(conn):
+                    with conn.cursor() as db:
+                        db.execute(sql, tuple(args + [last_pk]))
+                        return db.fetchall()
 
+                items = cls.execute(db_name, _work, [], read=True)
+                if not items:
+                    break
+                chunk = []
+                for pk, raw_data in items:
+                    json_data = codec.loads(raw_data)
+                    json_data['pk'] = pk
+                    chunk.append(json_data)
+                yield chunk
+                if len(items) < chunk_size:
+                    break
+                last_pk = items[-1][0]
+            return
+
+        sql = f'select id, data from {table_name}'
         if query_arr:
-            query_sql = ' and '.join(query_arr)
-            sql = f'{base_sql} where {query_sql}'
-        else:
-            sql = base_sql
-        total = 0
-        conn = cls.get_conn(db_name)
-        if not conn:
-            return total
+            sql = f'{sql} where {" and ".join(query_arr)}'
+        sql = f'{sql} order by id'
+
+        with pool.exclusive_connection() as conn:
+            db = conn.cursor(pymysql.cursors.SSCursor)
+            try:
+                db.execute(sql, tuple(args))
+                while True:
+                    items = db.fetchmany(chunk_size)
+                    if not items:
+                        break
+                    chunk = []
+                    for pk, raw_data in items:
+                        json_data = codec.loads(raw_data)
+                        json_data['pk'] = pk
+                        chunk.append(json_data)
+                    yield chunk
+            finally:
+                # 提前结束时 close 会读完剩余数据 连接才能复用
+                db.close()
 
-        def _work():
+    @classmethod
+    def query_count(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> int:
+        # 分页获取数量
+        plan, query_dict = where_plan(table_name, query_dict, index_fields)
+        sql = plan.count_sql
+        args = plan.bind_where(query_dict)
+
+        def _work(conn):
             with conn.cursor() as db:
-                if query_arr:
-                    db.execute(sql, tuple(args))
-                else:
-                    db.execute(sql)
+                db.execute(sql, tuple(args))
 
                 item = db.fetchone()
-                count = item[0]
-                total = count
-        try:
-            _work()
-        except Exception as e:
-            if not conn.open:
-                conn.ping()
-                _work()
-            else:
-                raise e
+                return item[0]
 
-        return total
+        return cls.execute(db_name, _work, 0, read=True)
 
     @classmethod
-    def raw_query(cls, db_name: str, sql: str) -> list:
+    def aggregate(cls,
+                  db_name: str,
+                  table_name: str,
+                  query_dict: dict,
+                  aggregates: dict,
+                  group_by: List[str] = [],
+                  index_fields: List[str] = [],
+                  order_by: List[str] = [],
+                  limit: int = 0) -> List[dict]:
+        # 在映射列上做聚合 每个分组返回一个 dict
+        sql, args, columns = aggregate_plan(table_name, query_dict, aggregates, group_by, index_fields, order_by, limit)
+
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, args)
+                items = db.fetchall()
+            return [dict(zip(columns, [plain_value(value) for value in item])) for item in items]
+
+        return cls.execute(db_name, _work, [], read=True)
+
+    @classmethod
+    def exists(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> bool:
+        # 是否有满足条件的数据。 找到一行就停止
+        plan, query_dict = where_plan(table_name, query_dict, index_fields)
+        sql = plan.exists_sql
+        args = plan.bind_where(query_dict)
+
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, tuple(args))
+                return db.fetchone() is not None
+
+        return cls.execute(db_name, _work, False, read=True)
+
+    @classmethod
+    def estimate_count(cls, db_name: str, table_name: str, query_dict: dict, index_fields: List[str] = []) -> int:
+        # 估算数量 不扫描数据
+        # 没有条件时用 information_schema 的表行数, 有条件时用 EXPLAIN 的 rows * filtered
+        plan, query_dict = where_plan(table_name, query_dict, index_fields)
+        args = plan.bind_where(query_dict)
+
+        def _work(conn):
+            with conn.cursor() as db:
+                if not plan.conditions:
+                    db.execute(TABLE_ROWS_SQL, (table_name,))
+                    item = db.fetchone()
+                    return int(item[0] or 0) if item else 0
+
+                db.execute(f'explain {plan.count_sql}', tuple(args))
+                columns = [col[0] for col in db.description]
+                return explain_rows(columns, db.fetchone())
+
+        return cls.execute(db_name, _work, 0, read=True)
+
+    @classmethod
+    def raw_query(cls, db_name: str, sql: str, args: Optional[tuple] = None, read: bool = False) -> list:
         # 执行裸查询
-        result = []
-        conn = cls.get_conn(db_name)
-        if not conn:
+        # read 只读的查询 可以走从库, 不会让后面的读取粘在主库
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, args)
+                return db.fetchall()
+
+        return cls.execute(db_name, _work, [], read=read)
+
+    @classmethod
+    def batch_query(cls, db_name: str, parts: List[tuple]) -> dict:
+        # 同一个库的多个查询 UNION ALL 一次往返
+        # parts [(sql, 参数), ...] 每个 sql 都是 select id, data ... 。 返回 {序号: [(id, data), ...]}
+        result = {}
+        if not parts:
             return result
+        sql, args = union_sql(parts)
+
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(sql, args)
+                return db.fetchall()
+
+        for tag, pk, raw_data in cls.execute(db_name, _work, [], read=True):
+            result.setdefault(tag, []).append((pk, raw_data))
+        return result
 
-        def _work():
+    @classmethod
+    def run_ddl(cls, db_name: str, sqls: List[str]) -> bool:
+        # 执行建表、删表等 DDL。 用独占的连接, 不会隐式提交当前事务
+        pool = cls.get_pool(db_name)
+        if not pool:
+            return False
+        try:
+            with pool.exclusive_connection() as conn:
+                with conn.cursor() as db:
+                    for sql in sqls:
+                        db.execute(sql)
+            return True
+        except Exception as e:
+            print(f'ddl error:{e}')
+            return False
+
+    @classmethod
+    def table_schema(cls, db_name: str, table_name: str):
+        # 库里的表结构。 返回 {列名: 类型}, {索引名: (列, ...)} ; 表不存在时返回 None, None
+        def _work(conn):
+            with conn.cursor() as db:
+                db.execute(SCHEMA_COLUMNS_SQL, (table_name,))
+                columns = {name: column_type for name, column_type, _ in db.fetchall()}
+                db.execute(SCHEMA_INDEXES_SQL, (table_name,))
+                indexes = {}
+                for name, column in db.fetchall():
+                    indexes[name] = indexes.get(name, ()) + (column,)
+            if not columns:
+                return None, None
+            return columns, indexes
+
+        return cls.execute(db_name, _work, (None, None), read=True)
+
+    @classmethod
+    def create_table(cls, db_name: str, table_name: str, table_config: dict) -> bool:
+        # 建表 已经存在时不处理
+        sql = create_table_sql(table_name, table_config)
+
+        def _work(conn):
             with conn.cursor() as db:
                 db.execute(sql)
-                items = db.fetchall()
-                result = items
+            return True
+
         try:
-            _work()
+            return cls.execute(db_name, _work, False)
         except Exception as e:
-            if not conn.open:
-                conn.ping()
-                _work()
-            else:
-                raise e
+            print(f'create table:{table_name} error:{e}')
+            return False
 
-        return result
+    @classmethod
+    def sync_table(cls, db_name: str, table_name: str, table_config: dict, dry_run: bool = False) -> List[str]:
+        # 表不存在时建表, 存在时补齐缺少的生成列和索引。 返回需要执行的语句
+        # dry_run 只返回语句不执行
+        columns, indexes = cls.table_schema(db_name, table_name)
+        if columns is None:
+            if not dry_run:
+                cls.create_table(db_name, table_name, table_config)
+            return [create_table_sql(table_name, table_config)]
+
+        sqls = alter_table_sqls(table_name, table_config, columns, indexes)
+        if dry_run or not sqls:
+            return sqls
+
+        def _work(conn):
+            with conn.cursor() as db:
+                for sql in sqls:
+                    db.execute(sql)
+
+        try:
+            cls.execute(db_name, _work)
+        except Exception as e:
+            print(f'alter table:{table_name} error:{e}')
+        return sqls
 
 
 mysql_connect = MConnection()
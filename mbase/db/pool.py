@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    同步MySQL连接池
+    线程安全, 每个线程独占一个连接, 同一线程内嵌套获取复用同一个连接。
+    连接空闲超过 ping_interval 才做存活检查, 存活超过 recycle 重建连接。
+'''
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    # 等待连接超时
+    pass
+
+
+class PooledConnection(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+
+class ConnectionPool(object):
+
+    def __init__(self,
+                 creator,
+                 min_size: int = 1,
+                 max_size: int = 10,
+                 timeout: float = 30,
+                 recycle: float = 3600,
+                 ping_interval: float = 30):
+        # creator 无参函数。 返回一个新的连接
+        self.creator = creator
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        self._idle = deque()
+        # 已创建(空闲 + 使用中)的连接数
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        # 统计信息
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'pings': 0,
+            'discarded': 0,
+        }
+
+        for _ in range(min(self.min_size, self.max_size)):
+            self._idle.append(self._create())
+            self._size += 1
+
+    def _create(self) -> PooledConnection:
+        record = PooledConnection(self.creator())
+        self._stats['created'] += 1
+        return record
+
+    def _close(self, record: PooledConnection):
+        try:
+            record.conn.close()
+        except Exception:
+            pass
+
+    def _check(self, record: PooledConnection) -> PooledConnection:
+        # 取出连接时检查。 只有空闲时间超过阈值才ping, 避免每条语句一次往返
+        now = time.time()
+        if self.recycle and now - record.created_at > self.recycle:
+            self._close(record)
+            self._stats['recycled'] += 1
+            return self._create()
+
+        if now - record.last_used > self.ping_interval:
+            self._stats['pings'] += 1
+            record.conn.ping(reconnect=True)
+        return record
+
+    def acquire(self):
+        # 同一线程嵌套获取 复用同一个连接
+        local = self._local
+        record = getattr(local, 'record', None)
+        if record is not None:
+            local.depth += 1
+            return record.conn
+
+        record = self._checkout()
+        local.record = record
+        local.depth = 1
+        local.broken = False
+        return record.conn
+
+    def _checkout(self) -> PooledConnection:
+        start = time.time()
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    record = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # 先占位 在锁外创建连接
+                    self._size += 1
+                    record = None
+                    break
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'wait connection timeout:{self.timeout}s')
+                waited = True
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            wait_time = time.time() - start
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+
+        try:
+            if record is None:
+                record = self._create()
+            else:
+                record = self._check(record)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return record
+
+    def release(self, discard: bool = False):
+        local = self._local
+        record = getattr(local, 'record', None)
+        if record is None:
+            return
+        if discard:
+            local.broken = True
+        local.depth -= 1
+        if local.depth > 0:
+            return
+
+        broken = local.broken
+        local.record = None
+        local.broken = False
+        self._checkin(record, broken)
+
+    def _checkin(self, record: PooledConnection, broken: bool = False):
+        if broken or not record.conn.open:
+            self._close(record)
+        else:
+            record.last_used = time.time()
+
+        with self._cond:
+            self._in_use -= 1
+            if broken or not record.conn.open:
+                self._size -= 1
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append(record)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            # 连接断开的不再放回池中
+            broken = not conn.open
+            raise
+        finally:
+            self.release(discard=broken)
+
+    @contextmanager
+    def exclusive_connection(self):
+        # 独占一个连接 不和当前线程的其他操作共用。 用于流式游标等长时间占用的场景
+        record = self._checkout()
+        broken = False
+        try:
+            yield record.conn
+        except Exception:
+            broken = not record.conn.open
+            raise
+        finally:
+            self._checkin(record, broken)
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def status(self) -> dict:
+        with self._cond:
+            info = dict(self._stats)
+            info['size'] = self._size
+            info['idle'] = len(self._idle)
+            info['in_use'] = self._in_use
+            info['max_size'] = self.max_size
+        if info['waits']:
+            info['wait_time_avg'] = info['wait_time_total'] / info['waits']
+        else:
+            info['wait_time_avg'] = 0.0
+        return info
+
+    def close(self):
+        # 关闭空闲连接。 使用中的连接归还时正常处理
+        with self._cond:
+            while self._idle:
+                record = self._idle.pop()
+                self._size -= 1
+                self._close(record)
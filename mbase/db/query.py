@@ -0,0 +1,593 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    同步、异步 MySQL 连接共用的SQL拼装
+'''
+
+import base64
+from decimal import Decimal
+from functools import lru_cache
+from typing import List, Optional
+
+from mbase.db import codec
+
+
+# 运算符字典
+OP_DICT = {
+    'gte': '>=',
+    'gt': '>',
+    'lte': '<=',
+    'lt': '<',
+    'ne': '<>',
+}
+
+# 不是简单二元比较的运算符。 SQL模板 每个 %s 对应一个参数
+# in / nin 的参数是一个元组, 由驱动展开成 (a, b, c), 所以语句形状不随元素个数变化
+OP_TEMPLATE = {
+    'in': '{column} in %s',
+    'nin': '{column} not in %s',
+    'between': '{column} between %s and %s',
+    'isnull': '{column} is null',
+    'notnull': '{column} is not null',
+    'startswith': '{column} like %s',
+}
+
+# 可以作为索引前缀使用的运算符(等值查找)
+INDEX_PREFIX_OPS = ('', 'in')
+# 范围查找。 索引等值前缀后面 最多再用上一个范围列
+INDEX_RANGE_OPS = ('gt', 'gte', 'lt', 'lte', 'between', 'startswith', 'isnull', 'notnull')
+
+
+def split_key(key: str):
+    # 'age__gte' -> ('age', 'gte')  'age' -> ('age', '')
+    if '__' in key:
+        column, op = key.split('__', 1)
+        return column, op
+    return key, ''
+
+
+def condition_sql(column: str, op: str = '') -> str:
+    # 单个条件的SQL。 不支持的运算符返回空
+    if not op:
+        return f'{column}=%s'
+    if op in OP_DICT:
+        return f'{column}{OP_DICT[op]}%s'
+    if op in OP_TEMPLATE:
+        return OP_TEMPLATE[op].format(column=column)
+    return ''
+
+
+def escape_like(value: str) -> str:
+    # LIKE 的通配符按普通字符匹配
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def bind_value(op: str, value) -> list:
+    # 条件值 转换为SQL参数
+    if op in ('in', 'nin'):
+        # 空的 in 匹配不到任何行。 (NULL) 保证语句合法
+        return [tuple(value) or (None,)]
+    if op == 'between':
+        low, high = value
+        return [low, high]
+    if op in ('isnull', 'notnull'):
+        return []
+    if op == 'startswith':
+        return [escape_like(value) + '%']
+    return [value]
+
+
+def normalize_query(query_dict: dict) -> dict:
+    # 取值决定SQL形状的条件 改写成固定形状
+    # x__isnull=False -> x__notnull=True ,  x__nin=[] 没有限制 去掉
+    result = {}
+    for key, value in query_dict.items():
+        column, op = split_key(key)
+        if op == 'isnull' and not value:
+            result[f'{column}__notnull'] = True
+        elif op == 'nin' and not value:
+            continue
+        else:
+            result[key] = value
+    return result
+
+
+def json_path(path: tuple) -> str:
+    # ('user', 'name') -> $."user"."name"
+    return '$' + ''.join([f'."{key}"' for key in path])
+
+
+def data_expr(only: tuple = (), column: str = 'data') -> str:
+    # 只取部分字段时 用 JSON_OBJECT 拼出只包含这些字段的json
+    if not only:
+        return column
+    parts = ', '.join([f"'{name}', JSON_EXTRACT({column}, '{json_path((name,))}')" for name in only])
+    return f'JSON_OBJECT({parts})'
+
+
+def version_expr(version_field: str, column: str = 'data') -> str:
+    # 版本号在SQL里计算。 < 127 加1 否则归0
+    old_version = f"COALESCE(CAST(JSON_EXTRACT({column}, '{json_path((version_field,))}') AS SIGNED), 0)"
+    return f'IF({old_version} < 127, {old_version} + 1, 0)'
+
+
+class ArrayOps(object):
+    # 列表字段的增量修改 [(操作, 下标, 值)]。 操作是 append / insert / remove
+
+    def __init__(self, ops: list):
+        self.ops = ops
+
+    def expr(self, expr: str, path: str, args: list) -> str:
+        # 按操作顺序嵌套, 和内存里列表的修改顺序一致。 连续的 append 合并成一次调用
+        pairs = []
+        for op, index, value in self.ops:
+            if op == 'append':
+                pairs.append(f"'{path}', CAST(%s AS JSON)")
+                args.append(codec.dumps(value))
+                continue
+            if pairs:
+                expr = f"JSON_ARRAY_APPEND({expr}, {', '.join(pairs)})"
+                pairs = []
+            if op == 'insert':
+                expr = f"JSON_ARRAY_INSERT({expr}, '{path}[{index}]', CAST(%s AS JSON))"
+                args.append(codec.dumps(value))
+            elif op == 'remove':
+                expr = f"JSON_REMOVE({expr}, '{path}[{index}]')"
+        if pairs:
+            expr = f"JSON_ARRAY_APPEND({expr}, {', '.join(pairs)})"
+        return expr
+
+
+def json_update_expr(set_dict: dict, remove_list: List[tuple] = [], version_field: str = '', column: str = 'data'):
+    # 生成 JSON_SET / JSON_REMOVE 表达式 只修改指定的路径
+    # set_dict {路径tuple: 值}。 值都按json传入, 保证类型和整体写入时一致; 值是 ArrayOps 时只修改列表里变化的元素
+    expr = column
+    args = []
+
+    array_ops = [(path, value) for path, value in set_dict.items() if isinstance(value, ArrayOps)]
+    if array_ops:
+        # 库里没有这个字段时 先设为空数组
+        inits = ', '.join([f"'{json_path(path)}', IFNULL(JSON_EXTRACT({column}, '{json_path(path)}'), JSON_ARRAY())"
+                           for path, _ in array_ops])
+        expr = f'JSON_SET({expr}, {inits})'
+        for path, ops in array_ops:
+            expr = ops.expr(expr, json_path(path), args)
+
+    parts = []
+    for path, value in set_dict.items():
+        if isinstance(value, ArrayOps):
+            continue
+        parts.append(f"'{json_path(path)}', CAST(%s AS JSON)")
+        args.append(codec.dumps(value))
+    if version_field:
+        parts.append(f"'{json_path((version_field,))}', {version_expr(version_field, column)}")
+    if parts:
+        expr = f"JSON_SET({expr}, {', '.join(parts)})"
+
+    if remove_list:
+        paths = ', '.join([f"'{json_path(path)}'" for path in remove_list])
+        expr = f'JSON_REMOVE({expr}, {paths})'
+
+    return expr, args
+
+
+def parse_order(order_by: List[str], pk_name: str = 'id', desc: bool = True) -> tuple:
+    # ['-update_time', 'id'] -> (('update_time', True), ('id', False))
+    # 没有主键时 追加主键保证排序唯一, 方向和最后一列相同
+    orders = []
+    for field in order_by:
+        if field.startswith('-'):
+            orders.append((field[1:], True))
+        else:
+            orders.append((field.lstrip('+'), False))
+    if pk_name not in [column for column, _ in orders]:
+        orders.append((pk_name, orders[-1][1] if orders else desc))
+    return tuple(orders)
+
+
+def encode_cursor(values: list) -> str:
+    # 排序值 + 主键 编码成不透明的游标
+    raw = codec.dumps(list(values))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str) -> list:
+    padding = '=' * (-len(token) % 4)
+    return codec.loads(base64.urlsafe_b64decode(token + padding).decode('utf-8'))
+
+
+def cursor_values(cursor, orders: tuple = ()) -> Optional[list]:
+    # 游标转换成排序列的值。 没有游标返回 [] , 游标不合法返回 None
+    # 没有 orders 时 游标就是主键
+    if not cursor:
+        return []
+    if not orders:
+        return [cursor]
+    try:
+        values = decode_cursor(cursor)
+    except Exception:
+        values = None
+    if not isinstance(values, list) or len(values) != len(orders):
+        print(f'invalid cursor:{cursor}')
+        return None
+    return values
+
+
+class IndexPlan(object):
+    # 一个索引对某种查询形状的匹配情况和得分
+
+    def __init__(self, index, query_keys: tuple, order_field: str = 'id'):
+        self.index_name = index.index_name
+        self.fields = tuple(index.field_list)
+        self.unique = bool(getattr(index, 'unique', False))
+
+        ops = {}
+        for key in query_keys:
+            column, op = split_key(key)
+            ops.setdefault(column, set()).add(op)
+
+        # 等值前缀。 in 也算, 但 in 之后的列不能保证顺序
+        self.eq_fields = []
+        self.has_in = False
+        for field in self.fields:
+            field_ops = ops.get(field, set())
+            if '' in field_ops:
+                pass
+            elif 'in' in field_ops:
+                self.has_in = True
+            else:
+                break
+            self.eq_fields.append(field)
+
+        # 等值前缀后面的一个范围列
+        self.range_field = ''
+        if len(self.eq_fields) < len(self.fields):
+            field = self.fields[len(self.eq_fields)]
+            if ops.get(field, set()) & set(INDEX_RANGE_OPS):
+                self.range_field = field
+
+        # 所有列都是等值(非in)的唯一索引 最多一行
+        self.point_lookup = self.unique and not self.has_in and len(self.eq_fields) == len(self.fields)
+
+        # 排序可以直接用索引顺序 不需要 filesort
+        # 二级索引末尾隐含主键 id。 前缀都是等值(非in)时 下一列就是排序列才行
+        self.order_ok = False
+        if self.eq_fields and not self.has_in and not self.range_field:
+            rest = self.fields[len(self.eq_fields):]
+            if rest:
+                self.order_ok = rest[0] == order_field
+            else:
+                self.order_ok = order_field == 'id'
+
+        self.score = (
+            self.point_lookup * 1000
+            + len(self.eq_fields) * 10
+            + bool(self.range_field) * 5
+            + self.order_ok * 3
+        )
+
+    @property
+    def usable(self) -> bool:
+        return bool(self.eq_fields or self.range_field)
+
+    @property
+    def key_fields(self) -> tuple:
+        # 实际用到的索引列 按索引顺序
+        if self.range_field:
+            return tuple(self.eq_fields) + (self.range_field,)
+        return tuple(self.eq_fields)
+
+    def to_dict(self) -> dict:
+        return {
+            'index_name': self.index_name,
+            'fields': list(self.fields),
+            'eq_fields': list(self.eq_fields),
+            'range_field': self.range_field,
+            'unique': self.unique,
+            'point_lookup': self.point_lookup,
+            'order_ok': self.order_ok,
+            'score': self.score,
+        }
+
+    def __repr__(self):
+        return f'<IndexPlan {self.index_name or self.fields} score:{self.score} key:{self.key_fields}>'
+
+
+def plan_index(indexes: list, query_keys: tuple, order_field: str = 'id') -> List[IndexPlan]:
+    # 给每个索引打分 按得分从高到低返回能用上的索引
+    # 得分相同时 列少的索引优先
+    plans = [IndexPlan(index, query_keys, order_field) for index in indexes]
+    plans = [plan for plan in plans if plan.usable]
+    plans.sort(key=lambda plan: (-plan.score, len(plan.fields)))
+    return plans
+
+
+class CompiledQuery(object):
+    # 一种查询形状编译好的SQL模板
+    # 形状 = 条件字段和运算符、使用的索引、排序、有无游标。 同形状的查询只需要绑定参数
+
+    def __init__(self,
+                 table_name: str,
+                 keys: tuple,
+                 index_fields: tuple = (),
+                 desc: bool = True,
+                 pk_name: str = 'id',
+                 with_cursor: bool = False,
+                 only: tuple = (),
+                 orders: tuple = ()):
+        self.table_name = table_name
+        self.keys = keys
+        self.index_fields = index_fields
+        self.desc = desc
+        self.pk_name = pk_name
+        self.with_cursor = with_cursor
+        self.only = only
+        # 排序列 ((列, 是否倒序), ...)。 默认按主键
+        self.orders = orders or ((pk_name, desc),)
+        # 游标值的下标 按SQL里的 %s 顺序
+        self.cursor_index = []
+
+        # 条件 和 每个条件对应的参数key
+        self.conditions = []
+        self.arg_keys = []
+
+        remaining = list(keys)
+        # 先按索引顺序组织索引查找条件。 等值和 in 是索引前缀, 之后最多一个范围列
+        for column in index_fields:
+            prefix_keys = [key for key in remaining
+                           if split_key(key)[0] == column and split_key(key)[1] in INDEX_PREFIX_OPS]
+            if not prefix_keys:
+                range_keys = [key for key in remaining
+                              if split_key(key)[0] == column and split_key(key)[1] in INDEX_RANGE_OPS]
+                for key in range_keys:
+                    remaining.remove(key)
+                    self.add_condition(key)
+                break
+            for key in prefix_keys:
+                remaining.remove(key)
+                self.add_condition(key)
+
+        # 组织普通查找条件
+        for key in remaining:
+            self.add_condition(key)
+
+        self.where_sql = ' and '.join(self.conditions)
+
+        page_conditions = list(self.conditions)
+        if with_cursor:
+            page_conditions.append(self.keyset_condition())
+        # 正序也要明确排序 游标翻页才准确
+        order_sql = 'order by ' + ', '.join([f'{column} desc' if is_desc else column
+                                             for column, is_desc in self.orders])
+        page_sql = f'from {table_name}{self.where_clause(page_conditions)} {order_sql} limit %s'
+        self.count_sql = f'select count(1) from {table_name}{self.where_clause(self.conditions)}'
+        self.select_sql = f'select id, {data_expr(only)} {page_sql}'
+        # 只取主键。 条件和排序列都在二级索引里时是覆盖索引 不用回表
+        self.ids_sql = f'select id {page_sql}'
+        # 一次查询同时拿到分页数据和总数。 标量子查询的参数在前
+        self.select_count_sql = f'select id, {data_expr(only)}, ({self.count_sql}) {page_sql}'
+        self.exists_sql = f'select 1 from {table_name}{self.where_clause(self.conditions)} limit 1'
+
+    def keyset_condition(self) -> str:
+        # 游标翻页条件。 方向一致时用行构造器 (a, b, id) < (%s, %s, %s)
+        # 方向不一致时展开成 (a < %s) or (a = %s and b > %s) ...
+        columns = [column for column, _ in self.orders]
+        directions = set([is_desc for _, is_desc in self.orders])
+
+        if len(directions) == 1:
+            op = '<' if self.orders[0][1] else '>'
+            self.cursor_index = list(range(len(columns)))
+            if len(columns) == 1:
+                return f'{columns[0]} {op} %s'
+            return f"({', '.join(columns)}) {op} ({', '.join(['%s'] * len(columns))})"
+
+        parts = []
+        for i, (column, is_desc) in enumerate(self.orders):
+            part = [f'{columns[j]} = %s' for j in range(i)]
+            part.append(f"{column} {'<' if is_desc else '>'} %s")
+            self.cursor_index.extend(range(i + 1))
+            parts.append('(' + ' and '.join(part) + ')')
+        return '(' + ' or '.join(parts) + ')'
+
+    def add_condition(self, key: str):
+        condition = condition_sql(*split_key(key))
+        if not condition:
+            return
+        self.conditions.append(condition)
+        self.arg_keys.append(key)
+
+    @staticmethod
+    def where_clause(conditions: list) -> str:
+        if not conditions:
+            return ''
+        return ' where ' + ' and '.join(conditions)
+
+    def bind_where(self, query_dict: dict) -> list:
+        args = []
+        for key in self.arg_keys:
+            args.extend(bind_value(split_key(key)[1], query_dict[key]))
+        return args
+
+    def bind(self, query_dict: dict, cursor=0, limit: int = 10) -> tuple:
+        # cursor 主键 或者 排序列的值列表
+        args = self.bind_where(query_dict)
+        if self.with_cursor:
+            values = cursor if isinstance(cursor, (list, tuple)) else [cursor]
+            args.extend([values[i] for i in self.cursor_index])
+        args.append(limit)
+        return tuple(args)
+
+    def bind_with_count(self, query_dict: dict, cursor=0, limit: int = 10) -> tuple:
+        # select_count_sql 的参数
+        return tuple(self.bind_where(query_dict)) + self.bind(query_dict, cursor, limit)
+
+    def __repr__(self):
+        return f'<CompiledQuery {self.select_sql}>'
+
+
+@lru_cache(maxsize=1024)
+def compile_query(table_name: str,
+                  keys: tuple,
+                  index_fields: tuple = (),
+                  desc: bool = True,
+                  pk_name: str = 'id',
+                  with_cursor: bool = False,
+                  only: tuple = (),
+                  orders: tuple = ()) -> CompiledQuery:
+    # 按形状缓存编译结果
+    return CompiledQuery(table_name, keys, index_fields, desc, pk_name, with_cursor, only, orders)
+
+
+# 表行数估计值。 InnoDB 的统计信息 误差可能有 40%
+TABLE_ROWS_SQL = 'select TABLE_ROWS from information_schema.TABLES where TABLE_SCHEMA = database() and TABLE_NAME = %s'
+
+
+def explain_rows(columns: list, row) -> int:
+    # EXPLAIN 结果估算的行数 rows * filtered
+    if not row:
+        return 0
+    item = dict(zip(columns, row))
+    rows = item.get('rows') or 0
+    filtered = item.get('filtered')
+    if filtered is None:
+        filtered = 100
+    return int(float(rows) * float(filtered) / 100)
+
+
+def page_plan(table_name: str,
+              query_dict: dict,
+              cursor=0,
+              desc: bool = True,
+              pk_name: str = 'id',
+              index_fields: List[str] = [],
+              only: List[str] = [],
+              order_by: List[str] = []):
+    # 分页查询的编译结果。 返回 plan, 规范化后的查询条件, 游标值
+    # 游标不合法时 plan 为 None
+    orders = parse_order(order_by, pk_name, desc) if order_by else ()
+    values = cursor_values(cursor, orders)
+    if values is None:
+        return None, query_dict, values
+
+    # 同形状的查询复用编译好的SQL 只绑定参数
+    query_dict = normalize_query(query_dict)
+    plan = compile_query(table_name, tuple(sorted(query_dict)), tuple(index_fields), desc, pk_name, bool(values),
+                         tuple(only), orders)
+    return plan, query_dict, values
+
+
+def where_plan(table_name: str, query_dict: dict, index_fields: List[str] = []):
+    # 只有查询条件的编译结果(计数、是否存在)。 返回 plan, 规范化后的查询条件
+    query_dict = normalize_query(query_dict)
+    return compile_query(table_name, tuple(sorted(query_dict)), tuple(index_fields)), query_dict
+
+
+class Aggregate(object):
+    # 聚合函数。 字段是做了映射的列
+    FUNC = ''
+
+    def __init__(self, field: str, distinct: bool = False):
+        self.field = field
+        self.distinct = distinct
+
+    def sql(self) -> str:
+        distinct = 'DISTINCT ' if self.distinct else ''
+        return f'{self.FUNC}({distinct}{self.field})'
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.sql()}>'
+
+
+class Count(Aggregate):
+    # 只有计数可以不传字段 COUNT(*)
+    FUNC = 'COUNT'
+
+    def __init__(self, field: str = '*', distinct: bool = False):
+        super().__init__(field, distinct)
+
+
+class Sum(Aggregate):
+    FUNC = 'SUM'
+
+
+class Avg(Aggregate):
+    FUNC = 'AVG'
+
+
+class Min(Aggregate):
+    FUNC = 'MIN'
+
+
+class Max(Aggregate):
+    FUNC = 'MAX'
+
+
+def aggregate_plan(table_name: str,
+                   query_dict: dict,
+                   aggregates: dict,
+                   group_by: List[str] = [],
+                   index_fields: List[str] = [],
+                   order_by: List[str] = [],
+                   limit: int = 0):
+    # 聚合查询。 aggregates {别名: Aggregate}
+    # order_by 可以是分组字段或者别名 ['-total']
+    # 返回 sql, 参数, 结果列名
+    plan, query_dict = where_plan(table_name, query_dict, index_fields)
+
+    columns = list(group_by) + list(aggregates)
+    select_parts = list(group_by) + [f'{agg.sql()} as {alias}' for alias, agg in aggregates.items()]
+    sql = f"select {', '.join(select_parts)} from {table_name}{plan.where_clause(plan.conditions)}"
+    if group_by:
+        sql += f" group by {', '.join(group_by)}"
+    if order_by:
+        sql += ' order by ' + ', '.join([f'{field[1:]} desc' if field.startswith('-') else field.lstrip('+')
+                                         for field in order_by])
+    args = plan.bind_where(query_dict)
+    if limit:
+        sql += ' limit %s'
+        args.append(limit)
+    return sql, tuple(args), columns
+
+
+def plain_value(value):
+    # SUM / AVG 返回 Decimal。 整数转 int, 其他转 float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    return value
+
+
+def build_where(query_dict: dict, index_fields: List[str] = []):
+    # 组织查找条件。 返回 [条件], [参数]
+    query_dict = normalize_query(query_dict)
+    plan = compile_query('', tuple(sorted(query_dict)), tuple(index_fields))
+    return list(plan.conditions), plan.bind_where(query_dict)
+
+
+def pks_sql(table_name: str, size: int, pk_name: str = 'id', only: tuple = ()) -> str:
+    # 按主键 IN 查询。 只取部分字段且主键不是 id 时 要取出主键字段
+    if only and pk_name != 'id' and pk_name not in only:
+        only = tuple(only) + (pk_name,)
+    return f"select id, {data_expr(tuple(only))} from {table_name} where {pk_name} in ({', '.join(['%s'] * size)})"
+
+
+def union_sql(parts: List[tuple]) -> tuple:
+    # 多个 select id, data ... 查询合并成一条 UNION ALL, 一次往返
+    # 第一列是查询的序号 区分每行属于哪个查询。 返回 sql, 参数
+    sqls = []
+    args = []
+    for tag, (sql, part_args) in enumerate(parts):
+        sqls.append(f"(select {tag} as tag, {sql[len('select '):]})")
+        args.extend(part_args)
+    return ' union all '.join(sqls), tuple(args)
+
+
+def chunk_list(items: list, size: int) -> List[list]:
+    # 按大小切分列表
+    if size <= 0:
+        return [items]
+    return [items[i:i + size] for i in range(0, len(items), size)]
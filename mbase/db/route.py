@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    读写分离
+    MYSQL_CONFIG 里配置了 replicas 时 读走从库, 写走主库。
+    sticky_primary(seconds) 作用域内写过之后 seconds 秒内的读也走主库, 保证读到自己的写。
+    use_primary() 作用域内的读都走主库。
+    作用域用 contextvars 保存, 同步线程和 asyncio 任务都互不影响。
+
+    用法:
+        with sticky_primary(5):
+            await item.save()
+            item = await App.get(pk)    # 主库
+'''
+
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# 当前作用域 写之后粘在主库的秒数
+STICKY_SECONDS = ContextVar('mbase_sticky_seconds', default=0)
+# 读主库的截止时间
+STICKY_UNTIL = ContextVar('mbase_sticky_until', default=0.0)
+# 强制读主库
+FORCE_PRIMARY = ContextVar('mbase_force_primary', default=False)
+
+
+@contextmanager
+def sticky_primary(seconds: float = 5):
+    seconds_token = STICKY_SECONDS.set(seconds)
+    until_token = STICKY_UNTIL.set(0.0)
+    try:
+        yield
+    finally:
+        STICKY_UNTIL.reset(until_token)
+        STICKY_SECONDS.reset(seconds_token)
+
+
+@contextmanager
+def use_primary():
+    token = FORCE_PRIMARY.set(True)
+    try:
+        yield
+    finally:
+        FORCE_PRIMARY.reset(token)
+
+
+def mark_write():
+    # 写主库时调用
+    seconds = STICKY_SECONDS.get()
+    if seconds:
+        STICKY_UNTIL.set(time.time() + seconds)
+
+
+def read_primary() -> bool:
+    # 当前的读是否需要走主库
+    return FORCE_PRIMARY.get() or STICKY_UNTIL.get() > time.time()
+
+
+class ReplicaRouter(object):
+    # 从库选择
+    # round_robin 轮询,  least_outstanding 选正在使用的连接最少的
+
+    def __init__(self, policy: str = 'round_robin'):
+        self.policy = policy
+        self.counter = itertools.count()
+
+    def choose(self, pools: list, outstanding):
+        # outstanding(pool) 返回连接池正在使用的连接数
+        if self.policy == 'least_outstanding':
+            return min(pools, key=outstanding)
+        return pools[next(self.counter) % len(pools)]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    事务
+    atomic 作用域内同一个库的读写使用同一个连接, 写操作的提交推迟到结束时一次完成, 出错时回滚。
+    batch 模式下 save()/delete() 先收集, 结束时合并成批量语句执行。
+    当前的事务用 contextvars 保存, 同步线程和 asyncio 任务都互不影响。
+
+    用法:
+        with App.atomic():
+            a.save()
+            b.delete()
+
+        async with App.atomic(batch=True):
+            for item in items:
+                await item.save()
+'''
+
+from contextvars import ContextVar
+from typing import Optional
+
+
+# 当前作用域的事务 {库名: Transaction}
+ATOMIC = ContextVar('mbase_atomic', default=None)
+
+
+class Transaction(object):
+
+    def __init__(self, db_name: str, conn, batch: bool = False):
+        self.db_name = db_name
+        self.conn = conn
+        self.batch = batch
+        # 执行出错 结束时回滚
+        self.failed = False
+        # 正在执行收集的操作 不再收集
+        self.flushing = False
+        # batch 模式收集的操作 {id(实例): (操作, 实例, 主键, upsert)}
+        self.pending = {}
+        # batch 模式 结束时执行收集的操作 flush(tx)。 由模型设置
+        self.flush = None
+        # 异步连接同一时间只能执行一条语句
+        self.lock = None
+
+    def add(self, action: str, instance, upsert: Optional[bool] = None):
+        # 同一个实例只保留最后一次操作
+        self.pending.pop(id(instance), None)
+        self.pending[id(instance)] = (action, instance, instance.id, upsert)
+
+    def take_pending(self):
+        # 取出收集的操作 分成 逐个保存 [(实例, upsert)], 批量插入 {模型: [实例]}, 批量删除 {(模型, 库, 表): [主键]}
+        saves, inserts, deletes = [], {}, {}
+        for action, instance, pk, upsert in self.pending.values():
+            if action == 'delete':
+                key = (instance.__class__, instance.DB_NAME, instance.TABLE_NAME)
+                deletes.setdefault(key, []).append(pk)
+            elif not instance.id and instance.PK_NAME == 'id' and not instance.multi_table():
+                inserts.setdefault(instance.__class__, []).append(instance)
+            else:
+                saves.append((instance, upsert))
+        self.pending = {}
+        return saves, inserts, deletes
+
+
+class PinnedConnection(object):
+    # 异步事务固定的连接。 退出时不归还连接池, 出错时标记事务回滚
+
+    def __init__(self, tx: Transaction):
+        self.tx = tx
+
+    def __enter__(self):
+        return self.tx.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.tx.failed = True
+        self.tx.lock.release()
+
+
+def current_transaction(db_name: str) -> Optional[Transaction]:
+    return (ATOMIC.get() or {}).get(db_name)
+
+
+def in_transaction() -> bool:
+    # 当前作用域有事务。 事务的连接不能交给其他线程使用
+    return bool(ATOMIC.get())
+
+
+def conn_transaction(conn) -> Optional[Transaction]:
+    # 连接所属的事务
+    for tx in (ATOMIC.get() or {}).values():
+        if tx.conn is conn:
+            return tx
+    return None
+
+
+def enter_transaction(tx: Transaction):
+    # 返回 token, 结束时 ATOMIC.reset(token)
+    transactions = dict(ATOMIC.get() or {})
+    transactions[tx.db_name] = tx
+    return ATOMIC.set(transactions)
@@ -12,6 +12,8 @@ from typing import Optional
 from enum import IntEnum
 from datetime import datetime
 
+from mbase.large import LargeRef
+
 
 DB_OPTIONS_PARAMS_KEY = [
     "max_versions",
@@ -24,10 +26,58 @@ DB_OPTIONS_PARAMS_KEY = [
     "time_to_live",
 ]
 
+# 修改记录保存在实例 __dict__ 里。 不是字段 to_db 时会被忽略
+CHANGED_KEY = '_changed_fields'
+REMOVED_KEY = '_removed_fields'
+# 列表字段的操作记录 [(操作, 下标, 元素)]。 保存时转成 JSON_ARRAY_APPEND / JSON_ARRAY_INSERT / JSON_REMOVE
+OPS_KEY = '_list_ops'
+# 操作记录超过这个数量时 不如整体写入
+MAX_LIST_OPS = 100
+
+
+def mark_changed(instance, name: str):
+    # 记录实例上被修改过的字段
+    data = instance.__dict__
+    changed = data.get(CHANGED_KEY)
+    if changed is None:
+        changed = data[CHANGED_KEY] = set()
+    changed.add(name)
+    removed = data.get(REMOVED_KEY)
+    if removed:
+        removed.discard(name)
+
+
+def mark_removed(instance, name: str):
+    # 记录实例上被删除的字段
+    data = instance.__dict__
+    removed = data.get(REMOVED_KEY)
+    if removed is None:
+        removed = data[REMOVED_KEY] = set()
+    removed.add(name)
+    changed = data.get(CHANGED_KEY)
+    if changed:
+        changed.discard(name)
+
+
+def get_changed(instance) -> set:
+    return instance.__dict__.get(CHANGED_KEY) or set()
+
+
+def get_removed(instance) -> set:
+    return instance.__dict__.get(REMOVED_KEY) or set()
+
+
+def clear_changed(instance):
+    instance.__dict__.pop(CHANGED_KEY, None)
+    instance.__dict__.pop(REMOVED_KEY, None)
+    instance.__dict__.pop(OPS_KEY, None)
+
 
 class BaseField(object):
     DATA_TYPE = str
     DEFAULT = None
+    # 大字段 保存到旁表 {TABLE_NAME}_large
+    large = False
 
     def __init__(self,
                  name='',
@@ -38,6 +88,12 @@ class BaseField(object):
                  # 是否进行字段映射。 默认不映射。
                  # 没有映射的字段 不能进行字段条件查询
                  column_mapping: bool = False,
+                 # 映射列的类型 为空时按字段类型生成
+                 column_type: str = '',
+                 # 映射列是否 STORED。 默认 VIRTUAL
+                 stored: bool = False,
+                 # 大字段 值保存到旁表, data 里只留引用。 不能和 column_mapping 一起用
+                 large: bool = False,
 
                  # db定义字段
                  max_versions: Optional[int] = None,
@@ -53,6 +109,9 @@ class BaseField(object):
         self.family = family
         self.is_pk = is_pk
         self.column_mapping = column_mapping
+        self.column_type = column_type
+        self.stored = stored
+        self.large = large
 
         self.max_versions = max_versions
         self.compression = compression
@@ -77,15 +136,26 @@ class BaseField(object):
         if isinstance(instance, BaseFamily):
             if self.name not in instance.__dict__:
                 return self.db_name()
-        return data.get(self.name, self.DEFAULT)
+        value = data.get(self.name, self.DEFAULT)
+        if self.large and isinstance(value, LargeRef):
+            # 大字段第一次访问时 从旁表加载
+            instance.access_large(self.name)
+            value = data.get(self.name, self.DEFAULT)
+        return value
 
     def __set__(self, instance, value):
         if isinstance(value, self.__class__.DATA_TYPE):
             instance.__dict__[self.name] = value
+            mark_changed(instance, self.name)
             # print(f'set:{self.name}:{value}')
         else:
             print("赋值类型错误", f'set:{self.name}:{value}', self.__class__.DATA_TYPE, type(value))
 
+    def __delete__(self, instance):
+        if self.name in instance.__dict__:
+            instance.__dict__.pop(self.name)
+            mark_removed(instance, self.name)
+
     def to_python(self, value_str: str = ''):
         # 子类具体实现
         return self.__class__.DATA_TYPE(value_str)
@@ -142,6 +212,7 @@ class FloatField(BaseField):
             # print(f'set:{self.name}:{value}')
         else:
             instance.__dict__[self.name] = self.__class__.DATA_TYPE(value)
+        mark_changed(instance, self.name)
 
 
 class DateTimeField(BaseField):
@@ -166,6 +237,7 @@ class DateTimeField(BaseField):
             instance.__dict__[self.name] = int(time.mktime(value.timetuple()) * 1000)
         else:
             instance.__dict__[self.name] = self.__class__.DATA_TYPE(value)
+        mark_changed(instance, self.name)
 
     @classmethod
     def format(cls, tm_msint: int):
@@ -225,17 +297,39 @@ class ObjectField(BaseField):
         return db_dict
 
 
+class LazyItem(object):
+    # 还没有实例化的列表元素。 保存库里的原始值
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+
 class ListField(BaseField):
     # 目前只支MySQL
+    # lazy=True 时 从库里加载的元素访问到才实例化, 没访问过的元素保存时直接写回原始值
 
-    def __init__(self, name='', family: str = '', item_class=None):
+    def __init__(self, name='', family: str = '', item_class=None, lazy: bool = False, large: bool = False):
         self.name = name
         self.family = family
         self.is_pk = False
         self.column_mapping = False
         self.item_cls = item_class
+        self.lazy = lazy
+        self.large = large
         self.items = []
 
+    @property
+    def items(self) -> list:
+        # 直接访问 items 时全部实例化
+        for index in range(len(self._items)):
+            self.load_item(index)
+        return self._items
+
+    @items.setter
+    def items(self, value: list):
+        self._items = value
+
     def __unicode__(self):
         return f"{self.name}:"
 
@@ -269,70 +363,143 @@ class ListField(BaseField):
             attr.items = tmp_list
             instance.__dict__[self.name] = attr
 
+        mark_changed(instance, self.name)
+
     def __get__(self, instance, name):
         if instance is None:
             return self
 
+        if self.large and isinstance(instance.__dict__.get(self.name), LargeRef):
+            instance.access_large(self.name)
         if self.name not in instance.__dict__:
-            instance.__dict__[self.name] = self.__class__(item_class=self.item_cls)
+            instance.__dict__[self.name] = self.__class__(item_class=self.item_cls, lazy=self.lazy)
         data = instance.__dict__
 
         return data.get(self.name)
 
     def __iter__(self):
-        return iter(self.items)
+        for index in range(len(self._items)):
+            yield self.load_item(index)
 
     def __getitem__(self, index):
-        return self.items[index]
+        if isinstance(index, slice):
+            return [self.load_item(i) for i in range(*index.indices(len(self._items)))]
+        return self.load_item(index)
 
     def count(self):
-        return len(self.items)
+        return len(self._items)
 
     def __len__(self):
-        return len(self.items)
+        return len(self._items)
+
+    def load_item(self, index: int):
+        # 实例化第 index 个元素
+        item = self._items[index]
+        if isinstance(item, LazyItem):
+            item = self._items[index] = self.decode_item(item.raw)
+        return item
+
+    def decode_item(self, value):
+        if isinstance(value, dict):
+            ins = self.item_cls()
+            if isinstance(ins, dict):
+                return value
+            ins.to_python(value_dict=value)
+            return ins
+        return value
+
+    def record_op(self, op: str, index: Optional[int] = None, item=None):
+        # 记录列表操作。 clear 等无法逐个表示的修改记为 reset, 保存时整体写入
+        mark_changed(self, 'items')
+        self.__dict__.setdefault(OPS_KEY, []).append((op, index, item))
 
     def append(self, item):
         if isinstance(item, self.item_cls):
-            self.items.append(item)
+            self._items.append(item)
+            self.record_op('append', item=item)
 
     def insert(self, index, item):
         if isinstance(item, self.item_cls):
-            self.items.insert(index, item)
-
-    def pop(self, index):
-        return self.items.pop(index)
+            # 下标按插入前的长度换算成非负数 和 JSON_ARRAY_INSERT 一致
+            size = len(self._items)
+            index = max(index + size, 0) if index < 0 else min(index, size)
+            self._items.insert(index, item)
+            self.record_op('insert', index, item)
+
+    def pop(self, index=-1):
+        if index < 0:
+            index += len(self._items)
+        item = self.load_item(index)
+        self._items.pop(index)
+        self.record_op('remove', index)
+        return item
 
     def clear(self):
         self.items = []
-
-    def to_db(self, is_hb=False) -> dict:
-        #
-        result = {}
-        values = []
-        for item in self.items:
-            if isinstance(item, ObjectField):
-                db_dict = item.to_db(is_hb=False)
-                values.append(db_dict)
-            else:
-                values = self.items
-
-        return values
+        self.record_op('reset')
+
+    def pending_ops(self) -> Optional[list]:
+        # 加载后的列表操作 [(操作, 下标, 库里的值)]。 需要整体写入时返回 None
+        ops = self.__dict__.get(OPS_KEY)
+        if not ops or len(ops) > MAX_LIST_OPS:
+            return None
+        result = []
+        for op, index, item in ops:
+            if op == 'reset':
+                return None
+            result.append((op, index, None if op == 'remove' else self.item_to_db(item)))
+        return result
+
+    def items_changed(self) -> bool:
+        # 加载的元素有没有原地修改过。 append / insert 的新元素保存时按当前值写入, 不算
+        added = {id(item) for _, _, item in self.__dict__.get(OPS_KEY) or [] if item is not None}
+        return any(nested_changed(item) for item in self._items if id(item) not in added)
+
+    def item_to_db(self, item):
+        if isinstance(item, LazyItem):
+            return item.raw
+        if isinstance(item, ObjectField):
+            return item.to_db(is_hb=False)
+        return item
+
+    def to_db(self, is_hb=False) -> list:
+        return [self.item_to_db(item) for item in self._items]
 
     def to_python(self, value_list: list = []):
-        # 从DB还原成对象
-        items = []
-        # 处理子对象
-        for item in value_list:
-            if isinstance(item, dict):
-                ins = self.item_cls()
-                if isinstance(ins, dict):
-                    items.append(item)
-                else:
-                    ins.to_python(value_dict=item)
-                    items.append(ins)
-            else:
-                items.append(item)
-        self.items = items
+        # 从DB还原成对象。 lazy 时子对象先保存原始值
+        if self.lazy:
+            self.items = [LazyItem(item) if isinstance(item, dict) else item for item in value_list]
+        else:
+            self.items = [self.decode_item(item) for item in value_list]
+
+
+def nested_changed(value) -> bool:
+    # 子对象、列表里实例化过的元素 有没有原地修改过
+    if isinstance(value, ObjectField):
+        if get_changed(value) or get_removed(value):
+            return True
+        children = list(value.__dict__.values())
+    elif isinstance(value, ListField):
+        if get_changed(value):
+            return True
+        children = [item for item in value._items if not isinstance(item, LazyItem)]
+    else:
+        return False
+    return any(nested_changed(child) for child in children)
+
+
+def clear_nested(value):
+    # 清空子对象、列表元素上的修改记录
+    if isinstance(value, ObjectField):
+        clear_changed(value)
+        children = list(value.__dict__.values())
+    elif isinstance(value, ListField):
+        clear_changed(value)
+        children = [item for item in value._items if not isinstance(item, LazyItem)]
+    else:
+        return
+    for child in children:
+        clear_nested(child)
 
 
 class EnumField(BaseField):
@@ -348,12 +515,16 @@ class EnumField(BaseField):
                  # 没有映射的字段 不能进行字段条件查询
                  column_mapping: bool = False,
                  enum_class: IntEnum =None,
+                 column_type: str = '',
+                 stored: bool = False,
                  ):
         self.name = name
         self.family = family
         self.is_pk = False
         self.column_mapping = column_mapping
         self.enum_class = enum_class
+        self.column_type = column_type
+        self.stored = stored
 
     def __unicode__(self):
         if self.family:
@@ -370,6 +541,7 @@ class EnumField(BaseField):
     def __set__(self, instance, value):
         if isinstance(value, self.__class__.DATA_TYPE):
             instance.__dict__[self.name] = value
+            mark_changed(instance, self.name)
             # print(f'set:{self.name}:{value}')
         else:
             print("赋值类型错误", f'set:{self.name}:{value}', self.__class__.DATA_TYPE, type(value))
@@ -451,7 +623,9 @@ class BaseFamily(object):
 
 class Index(object):
 
-    def __init__(self, *field_list, index_name: str = ''):
+    def __init__(self, *field_list, index_name: str = '', unique: bool = False):
 
         self.index_name = index_name
         self.field_list = field_list
+        # 唯一索引。 所有列都等值查找时最多一行
+        self.unique = unique
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    大字段旁表
+    字段声明 large=True 后, 值保存到同一个库的 {TABLE_NAME}_large(pk, name, codec, value), data 里只留 {"$large": 1},
+    select id, data 不再带上很少读的大字段。
+    加载时大字段是 LargeRef 占位, 第一次访问时查旁表; get_by_pks(..., with_large=True) 一次查询批量加载。
+    值按 LARGE_COMPRESSION 压缩: auto 安装了 zstandard 时用 zstd, 否则 zlib; 空字符串不压缩。
+
+    用法:
+        class Article(MysqlBaseModel):
+            html = StringField(large=True)
+            blocks = ListField(item_class=Block, large=True)
+
+        article = Article.get(pk)              # article.html 访问时加载
+        Article.get_by_pks(pks, with_large=True)
+
+    异步模型访问前要先 await article.load_large() 或 get_by_pks(..., with_large=True), 否则抛出 LargeNotLoaded。
+    旁表和主表分开写入, 需要一致时在 atomic() 里保存。 delete_where 按主键分批删除, 同时清理旁表。
+'''
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from mbase.db import codec
+
+
+# data 里大字段的占位
+LARGE_REF_KEY = '$large'
+# 小于这个字节数的值不压缩
+MIN_COMPRESS_SIZE = 512
+# 值已经压缩过 旁表不再用压缩行格式
+LARGE_TABLE_OPTIONS = 'ENGINE=InnoDB DEFAULT CHARSET=utf8mb4'
+
+
+class LargeNotLoaded(Exception):
+    # 异步模型访问还没有加载的大字段
+    pass
+
+
+class LargeRef(object):
+    # 还没有从旁表加载的大字段
+
+    def __repr__(self):
+        return '<LargeRef not loaded>'
+
+
+def large_ref() -> dict:
+    return {LARGE_REF_KEY: 1}
+
+
+def is_large_ref(value) -> bool:
+    return isinstance(value, dict) and LARGE_REF_KEY in value
+
+
+def large_table(table_name: str) -> str:
+    return f'{table_name}_large'
+
+
+def large_table_sql(table_name: str) -> str:
+    lines = [
+        'pk BIGINT UNSIGNED NOT NULL',
+        'name VARCHAR(64) NOT NULL',
+        "codec VARCHAR(8) NOT NULL DEFAULT ''",
+        'value LONGBLOB NOT NULL',
+        'PRIMARY KEY(pk, name)',
+    ]
+    body = ',\n  '.join(lines)
+    return f'create table if not exists {large_table(table_name)}(\n  {body}\n) {LARGE_TABLE_OPTIONS}'
+
+
+def select_large_sql(table_name: str, size: int, names_size: int = 0) -> str:
+    sql = f"select pk, name, codec, value from {large_table(table_name)} where pk in ({', '.join(['%s'] * size)})"
+    if names_size:
+        sql += f" and name in ({', '.join(['%s'] * names_size)})"
+    return sql
+
+
+def upsert_large_sql(table_name: str, size: int) -> str:
+    values = ', '.join(['(%s, %s, %s, %s)'] * size)
+    return (f'insert into {large_table(table_name)}(pk, name, codec, value) values {values} '
+            f'on duplicate key update codec = VALUES(codec), value = VALUES(value)')
+
+
+def delete_large_sql(table_name: str, size: int, names_size: int = 0) -> str:
+    sql = f"delete from {large_table(table_name)} where pk in ({', '.join(['%s'] * size)})"
+    if names_size:
+        sql += f" and name in ({', '.join(['%s'] * names_size)})"
+    return sql
+
+
+def compress(value, method: str = 'auto') -> tuple:
+    # 值编码成 json 后压缩。 返回 (压缩方式, bytes)
+    raw = codec.dumps(value).encode('utf-8')
+    if method == 'auto' or (method == 'zstd' and not zstandard):
+        method = 'zstd' if zstandard else 'zlib'
+    if len(raw) < MIN_COMPRESS_SIZE:
+        return '', raw
+    if method == 'zstd':
+        return method, zstandard.ZstdCompressor().compress(raw)
+    if method == 'zlib':
+        return method, zlib.compress(raw)
+    return '', raw
+
+
+def decompress(method: str, blob):
+    blob = bytes(blob)
+    if method == 'zstd':
+        blob = zstandard.ZstdDecompressor().decompress(blob)
+    elif method == 'zlib':
+        blob = zlib.decompress(blob)
+    return codec.loads(blob.decode('utf-8'))
@@ -16,10 +16,19 @@ class ModelManager(object):
         # print(table_name)
         self.models[table_name] = model_class
 
-    def init_db(self):
+    def init_db(self, dry_run: bool = False):
+        # 建表。 MySQL 表已存在时补齐缺少的生成列和索引
+        # dry_run 只打印语句
         for table_name, class_obj in self.models.items():
+            # 基类没有表名
+            if not table_name:
+                continue
             print(f'init table:{table_name}')
-            class_obj.create_table()
+            if hasattr(class_obj, 'sync_table'):
+                for sql in class_obj.sync_table(dry_run=dry_run):
+                    print(sql)
+            else:
+                class_obj.create_table()
 
 
 model_manages = ModelManager()
@@ -8,13 +8,50 @@
 '''
 
 import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from typing import Iterable, List, Optional
 
+from mbase.advisor import query_advisor
 from mbase.manager import model_manages
 #from mbase.db.hbase import hb_connection
 from mbase.db.mysql import mysql_connect
+from mbase.db.route import mark_write, use_primary
+from mbase.db.transaction import Transaction, current_transaction, in_transaction
+from mbase.db.ddl import TABLE_OPTIONS, column_config, create_table_sql, index_config
+from mbase.db.query import (Aggregate, ArrayOps, Avg, Count, Max, Min, Sum, CompiledQuery, IndexPlan, compile_query,
+                            cursor_values, encode_cursor, normalize_query, parse_order, page_plan, plan_index,
+                            split_key, where_plan)
 from mbase.fields import BaseField, BaseFamily, EnumField, Index, ObjectField, ListField
+from mbase.fields import clear_changed, clear_nested, get_changed, get_removed, nested_changed
+from mbase.large import LargeRef, compress, decompress, is_large_ref, large_ref, large_table, large_table_sql
+from mbase.partition import PARTITION_TABLES_SQL
+from mbase.shard import map_shards, merge_items
+
+
+# 实例是否从库里加载。 保存在 __dict__ 里
+LOADED_KEY = '_loaded'
+# 只加载了部分字段时 记录加载的字段
+ONLY_KEY = '_only'
+# 保存时自动维护的字段
+AUTO_FIELDS = {'dver', 'create_time', 'update_time'}
+
+
+def flush_pending(tx: Transaction):
+    # atomic(batch=True) 结束时 合并执行收集的 save()/delete()
+    saves, inserts, deletes = tx.take_pending()
+    for model_class, instances in inserts.items():
+        model_class.bulk_create(instances)
+        for instance in instances:
+            if instance.id:
+                instance.mark_loaded()
+    for instance, upsert in saves:
+        instance.save(upsert)
+    for (model_class, db_name, table_name), pks in deletes.items():
+        model_class.conn.delete_by_pks(db_name, table_name, pks)
+        model_class.delete_large_rows(db_name, table_name, pks)
+        model_class.evict_rows(pks)
 
 
 class ModelMeta(type):
@@ -26,7 +63,17 @@ class ModelMeta(type):
             return super_new(cls, name, bases, attrs)
         new_class = super_new(cls, name, bases, attrs)
         model_manages.register(new_class.TABLE_NAME, new_class)
+        # 每个模型自己的映射字段 不和其他模型共用一个列表
+        new_class.QUERY_FIELDS = []
         new_class.fields, new_class.indexes = new_class.get_fields()
+        # 查询形状 -> (映射字段条件, 索引)
+        new_class.PLAN_CACHE = {}
+        # 精确计数缓存 (计数SQL, 参数) -> (过期时间, 数量)
+        new_class.COUNT_CACHE = {}
+        # 库里已有的分区 (过期时间, [yyyymm, ...])
+        new_class.PARTITION_TABLES = (0, [])
+        # 保存到旁表的大字段
+        new_class.LARGE_FIELDS = [f_obj.name for f_obj in new_class.fields.values() if getattr(f_obj, 'large', False)]
 
         return new_class
 
@@ -259,20 +306,44 @@ class MysqlBaseModel(BaseModel):
     PK_NAME = 'id'
     # 连接
     conn = mysql_connect
+    # 更新时使用一条 insert ... on duplicate key update 完成, 版本号在SQL里计算
+    UPSERT_SAVE = False
+    # 建表选项
+    TABLE_OPTIONS = TABLE_OPTIONS
+    # get_cached_count 缓存的秒数 和最多缓存的条数
+    COUNT_CACHE_TTL = 60
+    COUNT_CACHE_SIZE = 10000
+    # 水平分片 HashShard / RangeShard。 设置后 DB_NAME, TABLE_NAME 由分片决定
+    SHARD = None
+    # 行缓存 LocalRowCache。 get_by_pks 先查缓存
+    ROW_CACHE = None
+    # get_page_items 默认先取主键再取数据。 也可以每次传 deferred=True
+    DEFERRED_PAGE = False
+    # 按时间分表 MonthPartition。 设置后 TABLE_NAME 是模板表, 数据在 {TABLE_NAME}_{yyyymm}
+    PARTITION = None
+    # 已有分区列表缓存的秒数
+    PARTITION_CACHE_TTL = 60
+    # 需要的分区不在缓存里时 重新查询的最小间隔秒数
+    PARTITION_MISS_TTL = 1
+    # 大字段的压缩方式 auto / zstd / zlib, 空字符串不压缩
+    LARGE_COMPRESSION = 'auto'
 
     def to_python(self, value_dict: dict = {}):
         # 各个字段具体格式转换
         for k, v in value_dict.items():
             if k in self.fields:
                 f_obj = self.fields[k]
-                if isinstance(f_obj, ObjectField):
+                if f_obj.large and is_large_ref(v):
+                    # 大字段先放占位 访问时再加载
+                    self.__dict__[f_obj.name] = LargeRef()
+                elif isinstance(f_obj, ObjectField):
                     # 重新初始化一个类对象
                     fb = f_obj.__class__()
                     #fb = deepcopy(f_obj)
                     fb.to_python(v)
                     setattr(self, k, fb)
                 elif isinstance(f_obj, ListField):
-                    fb = f_obj.__class__(item_class=f_obj.item_cls)
+                    fb = f_obj.__class__(item_class=f_obj.item_cls, lazy=f_obj.lazy)
                     fb.to_python(v)
                     setattr(self, k, fb)
                 else:
@@ -286,7 +357,10 @@ class MysqlBaseModel(BaseModel):
             f_obj = self.fields.get(k)
             if k not in self.fields:
                 continue
-            if isinstance(value, ObjectField):
+            if f_obj.large:
+                # 大字段的值在旁表
+                f_dict = {f_obj.name: large_ref()}
+            elif isinstance(value, ObjectField):
                 f_dict = {
                     f_obj.name: value.to_db(is_hb=False)
                 }
@@ -302,21 +376,127 @@ class MysqlBaseModel(BaseModel):
             db_dict.update(f_dict)
         return db_dict
 
-    def save(self):
-        # 保存数据
-        # 初始化版本信息
+    def prepare_save(self, tm: int = 0):
+        # 保存前 初始化版本信息 和 时间戳
         if 'dver' in self.fields:
             # 描述符 有默认值。判断有无得从__dict__ 来搞
             if 'dver' not in self.__dict__:
                 self.dver = 0
         # 添加时间戳
-        tm = int(time.time() * 1000)
+        if not tm:
+            tm = int(time.time() * 1000)
 
-        if 'create_time' in self.fields and 'create_time' not in self.__dict__:
+        # 从库里加载的对象(包括只加载了部分字段的) 不补 create_time
+        if 'create_time' in self.fields and 'create_time' not in self.__dict__ and not self.is_loaded():
             self.create_time = tm
         if 'update_time' in self.fields:
             self.update_time = tm
 
+    def mark_loaded(self):
+        # 标记为和库里一致。 清空修改记录, 之后 save 只更新修改过的字段
+        clear_changed(self)
+        for f_obj in self.fields.values():
+            clear_nested(self.__dict__.get(f_obj.name))
+        self.__dict__[LOADED_KEY] = True
+
+    def is_loaded(self) -> bool:
+        return bool(self.__dict__.get(LOADED_KEY))
+
+    def get_changes(self):
+        # 加载后修改过的字段
+        # 返回 {json路径tuple: 值}, [删除的json路径tuple]
+        changed = get_changed(self)
+        set_dict = {}
+        remove_list = [(name,) for name in get_removed(self)]
+
+        for f_obj in self.fields.values():
+            name = f_obj.name
+            if name not in self.__dict__:
+                continue
+            value = self.__dict__[name]
+            if f_obj.large:
+                # 大字段 data 里只写引用, 值由 save_large 写入旁表
+                if self.large_changed(name, value):
+                    set_dict[(name,)] = large_ref()
+            elif name in changed:
+                if isinstance(value, (ObjectField, ListField)):
+                    set_dict[(name,)] = value.to_db(is_hb=False)
+                else:
+                    set_dict[(name,)] = f_obj.to_db(value, is_hb=False)[name]
+            elif isinstance(value, ObjectField):
+                # 子对象只更新修改过的子字段
+                sub_fields = {sub_obj.name: sub_obj for sub_obj in value.fields.values()}
+                for sub_name in get_changed(value):
+                    sub_obj = sub_fields.get(sub_name)
+                    if sub_obj and sub_name in value.__dict__:
+                        sub_value = value.__dict__[sub_name]
+                        set_dict[(name, sub_name)] = sub_obj.to_db(sub_value, is_hb=False)[sub_name]
+                for sub_name in get_removed(value):
+                    remove_list.append((name, sub_name))
+            elif isinstance(value, ListField):
+                if value.items_changed():
+                    # 元素原地修改过 整体写入
+                    set_dict[(name,)] = value.to_db(is_hb=False)
+                elif get_changed(value):
+                    # append / insert / pop 只发送变化的元素
+                    ops = value.pending_ops()
+                    set_dict[(name,)] = ArrayOps(ops) if ops else value.to_db(is_hb=False)
+
+        return set_dict, remove_list
+
+    def check_partial(self) -> bool:
+        # 只加载了部分字段的对象 不允许保存没有加载的字段
+        only = self.__dict__.get(ONLY_KEY)
+        if not only:
+            return True
+        set_dict, remove_list = self.get_changes()
+        allowed = only | AUTO_FIELDS
+        not_loaded = [path[0] for path in list(set_dict) + remove_list if path[0] not in allowed]
+        if not_loaded:
+            print(f'{self.__class__.__name__} fields:{not_loaded} not loaded can not save')
+            return False
+        return True
+
+    def has_changed(self) -> bool:
+        set_dict, remove_list = self.get_changes()
+        return bool(set_dict or remove_list)
+
+    def prepare_update(self):
+        # 部分更新的参数。 版本号交给SQL计算, 内存里同步加1
+        set_dict, remove_list = self.get_changes()
+        version_field = ''
+        if 'dver' in self.fields:
+            version_field = 'dver'
+            set_dict.pop(('dver',), None)
+            old_version = self.__dict__.get('dver', 0)
+            self.__dict__['dver'] = old_version + 1 if old_version < 127 else 0
+        return set_dict, remove_list, version_field
+
+    def save(self, upsert: Optional[bool] = None):
+        # 保存数据
+        # upsert 不传时 使用类配置 UPSERT_SAVE
+        if self.is_loaded() and not self.has_changed():
+            # 加载后没有修改 不需要访问数据库
+            return
+        if self.SHARD and not self.locate_shard():
+            return
+        # 先确定分片 事务按实例所在的库查找
+        tx = current_transaction(self.DB_NAME)
+        if tx and tx.batch and not tx.flushing:
+            # 事务 batch 模式 结束时合并执行
+            tx.add('save', self, upsert)
+            return
+        self.prepare_save()
+        if upsert is None:
+            upsert = self.UPSERT_SAVE
+        if self.multi_table():
+            if not (self.locate_partition() if self.PARTITION else self.locate_shard()):
+                return
+            if self.id and not self.is_loaded():
+                # 插入到分片时要带上主键
+                upsert = True
+        large_values, large_removed = self.large_changes()
+
         if not self.id:
             # 没有主键
             if self.PK_NAME != 'id':
@@ -327,9 +507,24 @@ class MysqlBaseModel(BaseModel):
                 # 主键是默认的ID。直接插入
                 id = self.conn.insert(self.DB_NAME, self.TABLE_NAME, self.to_db())
                 self.id = id
+                if id > 0:
+                    self.mark_loaded()
+        elif self.is_loaded():
+            # 从库里加载的对象 只更新修改过的json路径
+            if not self.check_partial():
+                return
+            set_dict, remove_list, version_field = self.prepare_update()
+            self.conn.update_fields(self.DB_NAME, self.TABLE_NAME, self.id, set_dict, remove_list, version_field)
+            self.mark_loaded()
+        elif upsert:
+            # 一次往返。 内存里的 dver 不会回写, 以库里的为准
+            version_field = 'dver' if 'dver' in self.fields else ''
+            self.conn.upsert(self.DB_NAME, self.TABLE_NAME, self.id, self.to_db(), version_field=version_field)
+            self.mark_loaded()
         else:
-            # 更新版本用所以不用再实例化为对象。
-            raw_dict = self.conn.get_by_pk(self.DB_NAME, self.TABLE_NAME, self.id)
+            # 更新版本用所以不用再实例化为对象。 版本要从主库读
+            with use_primary():
+                raw_dict = self.conn.get_by_pk(self.DB_NAME, self.TABLE_NAME, self.id)
             if raw_dict:
                 # 处理版本信息
                 if 'dver' in self.fields:
@@ -342,18 +537,294 @@ class MysqlBaseModel(BaseModel):
                                  self.id,
                                  self.to_db(),
                                  self.PK_NAME)
+                self.mark_loaded()
             else:
-                # 插入
-                self.conn.insert(self.DB_NAME, self.TABLE_NAME, self.to_db())
+                # 插入。 库里的行用自增ID
+                id = self.conn.insert(self.DB_NAME, self.TABLE_NAME, self.to_db())
+                if id > 0:
+                    self.id = id
+                    self.mark_loaded()
+        self.evict_rows([self.id])
+        if (large_values or large_removed) and self.is_loaded():
+            self.save_large(large_values, large_removed)
 
     def delete(self):
         # 删除对象
         if not self.id:
             print('instance no pk')
         else:
-            self.conn.delete(self.__class__.DB_NAME, self.__class__.TABLE_NAME, self.id)
+            if self.SHARD and not self.locate_shard():
+                return
+            if self.PARTITION and not self.locate_partition(create=False):
+                print(f'{self.__class__.__name__} partition not exists id:{self.id}')
+                return
+            tx = current_transaction(self.DB_NAME)
+            if tx and tx.batch and not tx.flushing:
+                tx.add('delete', self)
+            else:
+                self.conn.delete(self.DB_NAME, self.TABLE_NAME, self.id)
+                self.delete_large_rows(self.DB_NAME, self.TABLE_NAME, [self.id])
+                self.evict_rows([self.id])
             self.id = None
 
+    @classmethod
+    def evict_rows(cls, pks: Optional[list] = None):
+        # 删除行缓存。 不传主键时全部删除
+        if cls.ROW_CACHE is None:
+            return
+        if pks is None:
+            cls.ROW_CACHE.clear()
+        else:
+            cls.ROW_CACHE.delete_many(pks)
+
+    @classmethod
+    def use_row_cache(cls, pk_name: str, only: List[str]) -> bool:
+        # 只缓存按 id 读取的完整行。 分片、分区模型不使用
+        return cls.ROW_CACHE is not None and pk_name == 'id' and not only and not cls.multi_table()
+
+    @classmethod
+    def multi_table(cls) -> bool:
+        # 数据分布在多个表 (分片或者分区)
+        return bool(cls.SHARD or cls.PARTITION)
+
+    @classmethod
+    @contextmanager
+    def atomic(cls, db_name: str = '', batch: bool = False):
+        # 事务 with App.atomic(): ...  不传 db_name 使用模型的库
+        # batch 作用域内的 save()/delete() 先收集, 结束时合并成批量语句。 新对象的 id 结束后才有
+        with cls.conn.atomic(db_name or cls.DB_NAME) as tx:
+            if tx and batch:
+                tx.batch = True
+                tx.flush = flush_pending
+            yield tx
+
+    def large_changed(self, name: str, value) -> bool:
+        # 大字段加载后是否修改过。 还是占位的没有修改
+        if isinstance(value, LargeRef):
+            return False
+        if not self.is_loaded() or name in get_changed(self):
+            return True
+        return nested_changed(value)
+
+    def large_changes(self):
+        # 需要写入旁表的大字段 {字段名: 值}, 删除的大字段 [字段名]
+        values = {}
+        for name in self.LARGE_FIELDS:
+            value = self.__dict__.get(name, LargeRef())
+            if not self.large_changed(name, value):
+                continue
+            if isinstance(value, (ObjectField, ListField)):
+                values[name] = value.to_db(is_hb=False)
+            else:
+                values[name] = self.fields[name].to_db(value, is_hb=False)[name]
+        removed = [name for name in get_removed(self) if name in self.LARGE_FIELDS]
+        return values, removed
+
+    def large_rows(self, values: dict) -> List[tuple]:
+        # 旁表的行 [(主键, 字段名, 压缩方式, 值)]
+        return [(self.id, name) + compress(value, self.LARGE_COMPRESSION) for name, value in values.items()]
+
+    def save_large(self, values: dict, removed: List[str] = []):
+        # 大字段写入旁表。 和主表不在一个事务里, 需要一致时放在 atomic() 里保存
+        if values:
+            self.conn.set_large(self.DB_NAME, self.TABLE_NAME, self.large_rows(values))
+        if removed:
+            self.conn.delete_large(self.DB_NAME, self.TABLE_NAME, [self.id], removed)
+
+    @classmethod
+    def delete_large_rows(cls, db_name: str, table_name: str, pks: list):
+        if cls.LARGE_FIELDS and pks:
+            cls.conn.delete_large(db_name, table_name, pks)
+
+    def large_pending(self) -> List[str]:
+        # 还没有加载的大字段
+        return [name for name in self.LARGE_FIELDS if isinstance(self.__dict__.get(name), LargeRef)]
+
+    def apply_large(self, names: List[str], rows: dict):
+        # 旁表读到的值 {字段名: (压缩方式, 值)} 设置到实例上, 不算修改。 旁表没有的去掉占位
+        for name in names:
+            if name not in rows:
+                self.__dict__.pop(name, None)
+                continue
+            self.to_python({name: decompress(*rows[name])})
+            get_changed(self).discard(name)
+            clear_nested(self.__dict__.get(name))
+
+    def load_large(self, names: List[str] = []):
+        # 加载大字段。 names 为空时加载全部
+        pending = [name for name in self.large_pending() if not names or name in names]
+        if not pending or not self.id:
+            return
+        rows = self.conn.get_large(self.DB_NAME, self.TABLE_NAME, [self.id], pending)
+        self.apply_large(pending, rows.get(self.id, {}))
+
+    def access_large(self, name: str):
+        # 字段描述符访问到占位时调用
+        self.load_large([name])
+
+    @classmethod
+    def load_large_many(cls, instances: list):
+        # 批量加载多个实例的大字段。 同一个表的一次查询
+        groups = {}
+        for instance in instances:
+            if instance.large_pending():
+                groups.setdefault((instance.DB_NAME, instance.TABLE_NAME), []).append(instance)
+        for (db_name, table_name), items in groups.items():
+            rows = cls.conn.get_large(db_name, table_name, [item.id for item in items])
+            for item in items:
+                item.apply_large(item.large_pending(), rows.get(item.id, {}))
+
+    def locate_shard(self) -> bool:
+        # 分片模型 确定实例所在的库和表, 保存在实例上覆盖类属性。 从库里加载的实例已经确定
+        if 'TABLE_NAME' in self.__dict__:
+            return True
+        field = self.SHARD.field
+        value = self.id if field in ('id', self.PK_NAME) else getattr(self, field, None)
+        if value is None or value == '':
+            print(f'{self.__class__.__name__} shard field:{field} is null')
+            return False
+        self.__dict__['DB_NAME'], self.__dict__['TABLE_NAME'] = self.SHARD.locate(value)
+        return True
+
+    def partition_of(self) -> str:
+        # 实例所在的分区月份。 有主键按主键, 没有按分区字段
+        if self.id:
+            return self.PARTITION.pk_suffix(self.id)
+        value = self.__dict__.get(self.PARTITION.field)
+        if value is None or value == '':
+            return ''
+        return self.PARTITION.suffix(value)
+
+    def locate_partition(self, create: bool = True) -> bool:
+        # 分区模型 确定实例所在的表, 保存在实例上覆盖类属性。 分区不存在时 create 为真就创建
+        if 'TABLE_NAME' in self.__dict__:
+            return True
+        suffix = self.partition_of()
+        if not suffix:
+            print(f'{self.__class__.__name__} partition unknown id:{self.id} field:{self.PARTITION.field}')
+            return False
+        if suffix not in self.partition_suffixes(wanted=[suffix]):
+            if not create:
+                return False
+            self.create_partition(suffix)
+        self.__dict__['TABLE_NAME'] = self.PARTITION.table_name(self.TABLE_NAME, suffix)
+        return True
+
+    @classmethod
+    def partition_missed(cls, wanted: Iterable[str] = ()) -> bool:
+        # 当前月份或 wanted 里的分区不在缓存里。 可能是其他进程刚创建的, 需要重新查询
+        expire, suffixes = cls.PARTITION_TABLES
+        if expire - cls.PARTITION_CACHE_TTL + cls.PARTITION_MISS_TTL > time.time():
+            # 刚查询过
+            return False
+        return any(suffix not in suffixes for suffix in [cls.PARTITION.current()] + list(wanted))
+
+    @classmethod
+    def pk_partitions(cls, pk_list: list) -> List[str]:
+        # 主键所在的分区
+        return sorted({suffix for suffix in map(cls.PARTITION.pk_suffix, pk_list) if suffix})
+
+    @classmethod
+    def partition_suffixes(cls, refresh: bool = False, wanted: Iterable[str] = ()) -> List[str]:
+        # 库里已有的分区月份 从旧到新。 缓存 PARTITION_CACHE_TTL 秒
+        # 用到的分区(wanted, 当前月份)不在缓存里时 提前重新查询
+        expire, suffixes = cls.PARTITION_TABLES
+        if refresh or expire < time.time() or cls.partition_missed(wanted):
+            rows = cls.conn.raw_query(cls.DB_NAME, PARTITION_TABLES_SQL, (f'{cls.TABLE_NAME}\\_%',), read=True)
+            suffixes = cls.PARTITION.parse_tables(cls.TABLE_NAME, [row[0] for row in rows])
+            cls.PARTITION_TABLES = (time.time() + cls.PARTITION_CACHE_TTL, suffixes)
+        return suffixes
+
+    @classmethod
+    def create_partition(cls, suffix: str) -> str:
+        # 按模板表创建分区表
+        # DDL 会隐式提交事务 用单独的连接执行
+        table_name = cls.PARTITION.table_name(cls.TABLE_NAME, suffix)
+        sqls = cls.PARTITION.create_sqls(cls.TABLE_NAME, suffix)
+        if cls.LARGE_FIELDS:
+            sqls.append(large_table_sql(table_name))
+        cls.conn.run_ddl(cls.DB_NAME, sqls)
+        expire, suffixes = cls.PARTITION_TABLES
+        cls.PARTITION_TABLES = (expire, sorted(set(suffixes) | {suffix}))
+        return cls.PARTITION.table_name(cls.TABLE_NAME, suffix)
+
+    @classmethod
+    def drop_partitions(cls, keep: int) -> List[str]:
+        # 删除最近 keep 个月以前的分区表。 返回删除的表
+        tables = []
+        for suffix in cls.PARTITION.expired(cls.partition_suffixes(refresh=True), keep):
+            table_name = cls.PARTITION.table_name(cls.TABLE_NAME, suffix)
+            sqls = [f'drop table if exists {table_name}']
+            if cls.LARGE_FIELDS:
+                sqls.append(f'drop table if exists {large_table(table_name)}')
+            cls.conn.run_ddl(cls.DB_NAME, sqls)
+            tables.append(table_name)
+        cls.partition_suffixes(refresh=True)
+        return tables
+
+    @classmethod
+    def partition_locations(cls, suffixes: List[str]) -> List[tuple]:
+        return [(cls.DB_NAME, cls.PARTITION.table_name(cls.TABLE_NAME, suffix)) for suffix in suffixes]
+
+    @classmethod
+    def partition_ordered(cls, order_by: List[str]) -> bool:
+        # 按 id 或者分区字段排序时 分区的先后就是结果的先后, 可以逐个分区查询
+        return not order_by or parse_order(order_by, cls.PK_NAME)[0][0] == cls.PARTITION.field
+
+    @classmethod
+    def partition_page_locations(cls, query: dict, cursor, desc: bool, order_by: List[str]) -> List[tuple]:
+        # 逐个查询的分区 按结果顺序排列。 游标之前的分区已经查完 不再查询
+        if order_by:
+            orders = parse_order(order_by, cls.PK_NAME, desc)
+            desc = orders[0][1]
+            values = cursor_values(cursor, orders) or [None]
+            # 游标的最后一个值是主键
+            last = cls.PARTITION.pk_suffix(values[-1]) if cls.PK_NAME == 'id' else ''
+        else:
+            last = cls.PARTITION.pk_suffix(cursor) if cursor else ''
+        suffixes = cls.PARTITION.select(cls.PARTITION_TABLES[1], query, desc)
+        if last:
+            suffixes = [suffix for suffix in suffixes if (suffix <= last if desc else suffix >= last)]
+        return cls.partition_locations(suffixes)
+
+    @classmethod
+    def bulk_create(cls, instances: List['MysqlBaseModel'], batch_size: int = 500) -> List['MysqlBaseModel']:
+        # 批量添加。 多行insert 每批提交一次。 自增ID回写到实例上
+        instances = list(instances)
+        if not instances:
+            return instances
+
+        tm = int(time.time() * 1000)
+        # 按实例所在的表分组 {(DB_NAME, TABLE_NAME): [实例]}
+        groups = {}
+        for instance in instances:
+            instance.prepare_save(tm)
+            if instance.id:
+                # 已经有主键 不能用自增ID插入 逐个 upsert
+                instance.save(upsert=True)
+                continue
+            if cls.multi_table():
+                if not (instance.locate_partition() if cls.PARTITION else instance.locate_shard()):
+                    continue
+            groups.setdefault((instance.DB_NAME, instance.TABLE_NAME), []).append(instance)
+
+        for (db_name, table_name), group in groups.items():
+            data_list = [instance.to_db() for instance in group]
+            large_list = [instance.large_changes()[0] for instance in group]
+            ids = cls.conn.bulk_insert(db_name, table_name, data_list, batch_size=batch_size)
+            if len(ids) != len(group):
+                print('bulk create error')
+                continue
+
+            large_rows = []
+            for instance, pk, large_values in zip(group, ids, large_list):
+                instance.id = pk
+                large_rows += instance.large_rows(large_values)
+            if large_rows:
+                cls.conn.set_large(db_name, table_name, large_rows)
+
+        return instances
+
     @classmethod
     def get_fields(cls):
         fields = {}
@@ -384,84 +855,227 @@ class MysqlBaseModel(BaseModel):
     @classmethod
     def generate_table_config(cls) -> dict:
         # 生成数据库表信息
-        table = {}
+        # 映射字段 -> 生成列, Index -> 索引
+        table = {
+            'columns': [],
+            'indexes': [],
+            'options': cls.TABLE_OPTIONS,
+        }
+        for field_obj in cls.fields.values():
+            if isinstance(field_obj, BaseField) and field_obj.column_mapping:
+                table['columns'].append(column_config(field_obj))
+
+        for index_obj in cls.indexes:
+            table['indexes'].append(index_config(index_obj))
+
+        # 自定义主键需要唯一索引
+        if cls.PK_NAME != 'id' and cls.PK_NAME in cls.QUERY_FIELDS:
+            if [cls.PK_NAME] not in [index['fields'] for index in table['indexes'] if index['unique']]:
+                table['indexes'].append(index_config(Index(cls.PK_NAME, unique=True)))
         return table
 
+    @classmethod
+    def create_table_sql(cls) -> str:
+        # 建表语句
+        return create_table_sql(cls.TABLE_NAME, cls.generate_table_config())
+
     @classmethod
     def create_table(cls) -> bool:
         # 创建表
         is_ok = False
 
+        if not cls.TABLE_NAME:
+            print(f"create:{cls.__name__} table error not set tablename")
+            return is_ok
+
+        # 建表在启动脚本里执行 patch_model 之后也用同步连接
+        is_ok = True
+        for db_name, table_name in cls.shard_all():
+            is_ok = mysql_connect.create_table(db_name, table_name, cls.generate_table_config()) and is_ok
+            if cls.LARGE_FIELDS:
+                mysql_connect.raw_query(db_name, large_table_sql(table_name))
         return is_ok
 
     @classmethod
-    def get_by_pks(cls, pk_list: List[str], pk_name: str = '') -> dict:
+    def sync_table(cls, dry_run: bool = False) -> List[str]:
+        # 表不存在时建表, 存在时补齐缺少的生成列和索引
+        # 返回执行(dry_run 时是需要执行)的语句
+        # 和 create_table 一样 patch_model 之后也用同步连接
+        if not cls.TABLE_NAME:
+            return []
+
+        locations = cls.shard_all()
+        if cls.PARTITION:
+            rows = mysql_connect.raw_query(cls.DB_NAME, PARTITION_TABLES_SQL, (f'{cls.TABLE_NAME}\\_%',))
+            suffixes = cls.PARTITION.parse_tables(cls.TABLE_NAME, [row[0] for row in rows])
+            locations = [(cls.DB_NAME, cls.TABLE_NAME)] + cls.partition_locations(suffixes)
+        sqls = []
+        for db_name, table_name in locations:
+            sqls += mysql_connect.sync_table(db_name, table_name, cls.generate_table_config(), dry_run=dry_run)
+            if cls.LARGE_FIELDS and mysql_connect.table_schema(db_name, large_table(table_name))[0] is None:
+                sqls.append(large_table_sql(table_name))
+                if not dry_run:
+                    mysql_connect.raw_query(db_name, sqls[-1])
+        return sqls
+
+    @classmethod
+    def shard_all(cls) -> List[tuple]:
+        # 所有分片的 (DB_NAME, TABLE_NAME)。 没有分片时就是模型自己的
+        # 分区模型是模板表和已有的分区表
+        if cls.SHARD:
+            return list(cls.SHARD.shards)
+        if cls.PARTITION:
+            return [(cls.DB_NAME, cls.TABLE_NAME)] + cls.partition_locations(cls.PARTITION_TABLES[1])
+        return [(cls.DB_NAME, cls.TABLE_NAME)]
+
+    @classmethod
+    def shard_query(cls, query: dict) -> List[tuple]:
+        # 查询条件涉及的分片。 分区模型是和条件有交集的分区
+        if cls.SHARD:
+            return cls.SHARD.locate_query(query)
+        if cls.PARTITION:
+            return cls.partition_locations(cls.PARTITION.select(cls.PARTITION_TABLES[1], query))
+        return [(cls.DB_NAME, cls.TABLE_NAME)]
+
+    @classmethod
+    def shard_pks(cls, pk_list: List[str], pk_name: str) -> List[tuple]:
+        # 按分片分组主键 [((DB_NAME, TABLE_NAME), [pk, ...]), ...]
+        if cls.PARTITION:
+            suffixes = cls.PARTITION_TABLES[1]
+            if pk_name != 'id':
+                return [(location, pk_list) for location in cls.partition_locations(suffixes)]
+            # 主键确定分区。 不存在的分区不用查
+            groups = {}
+            for pk in pk_list:
+                suffix = cls.PARTITION.pk_suffix(pk)
+                if suffix in suffixes:
+                    groups.setdefault(suffix, []).append(pk)
+            return [(cls.partition_locations([suffix])[0], pks) for suffix, pks in groups.items()]
+        if not cls.SHARD:
+            return [((cls.DB_NAME, cls.TABLE_NAME), pk_list)]
+        if pk_name == cls.SHARD.field or (pk_name == cls.PK_NAME and cls.SHARD.field == 'id'):
+            return list(cls.SHARD.group(pk_list).items())
+        # 不是按主键分片 只能每个分片都查
+        return [(location, pk_list) for location in cls.SHARD.shards]
+
+    @classmethod
+    def page_orders(cls, desc: bool, order_by: List[str]) -> tuple:
+        # 合并分片结果用的排序 和 SQL 的 order by 一致
+        if order_by:
+            return parse_order(order_by, cls.PK_NAME, desc)
+        return (('id', desc),)
+
+    @classmethod
+    def load_instance(cls, raw_json: dict, only: List[str] = [], location: tuple = ()) -> 'MysqlBaseModel':
+        # 库里的json 实例化为对象
+        # only 只加载了部分字段。 库里没有的字段 JSON_OBJECT 返回的是 null
+        # location 分片、分区模型 实例所在的 (DB_NAME, TABLE_NAME)
+        instance = cls()
+        if location:
+            instance.__dict__['DB_NAME'], instance.__dict__['TABLE_NAME'] = location
+        if only:
+            raw_json = {k: v for k, v in raw_json.items() if v is not None}
+            instance.__dict__[ONLY_KEY] = set(only)
+        instance.to_python(raw_json)
+        instance.id = raw_json['pk']
+        instance.mark_loaded()
+        return instance
+
+    @classmethod
+    def get_by_pks(cls, pk_list: List[str], pk_name: str = '', ordered: bool = False, only: List[str] = [],
+                   with_large: bool = False) -> dict:
+        # ordered 按传入主键的顺序返回
+        # only 只加载部分字段。 这样的对象保存时只能修改加载过的字段
+        # with_large 同时批量加载大字段
 
         result = {}
 
         if not pk_name:
             pk_name = cls.PK_NAME
-
-        raw_lines_dict = cls.conn.get_by_pks(cls.DB_NAME, cls.TABLE_NAME, pk_list, pk_name=pk_name)
-
-        for key, raw_json in raw_lines_dict.items():
-            instance = cls()
-            instance.to_python(raw_json)
-            instance.id = raw_json['pk']
-            result[key] = instance
+        only = cls.get_only(only)
+
+        if cls.PARTITION:
+            cls.partition_suffixes(wanted=cls.pk_partitions(pk_list) if pk_name == 'id' else [])
+        if cls.multi_table():
+            groups = cls.shard_pks(pk_list, pk_name)
+            results = map_shards(lambda group: cls.conn.get_by_pks(*group[0], group[1], pk_name=pk_name, only=only),
+                                 groups)
+            raw_lines_dict, locations = {}, {}
+            for (location, _), raw_dict in zip(groups, results):
+                raw_lines_dict.update(raw_dict)
+                locations.update(dict.fromkeys(raw_dict, location))
+        else:
+            use_cache = cls.use_row_cache(pk_name, only)
+            cached = cls.ROW_CACHE.get_many(pk_list) if use_cache else {}
+            missing = [pk for pk in pk_list if pk not in cached]
+            raw_lines_dict = {}
+            if missing:
+                raw_lines_dict = cls.conn.get_by_pks(cls.DB_NAME, cls.TABLE_NAME, missing, pk_name=pk_name, only=only)
+            # 事务中读到的可能没有提交 不放入缓存
+            if use_cache and raw_lines_dict and not current_transaction(cls.DB_NAME):
+                cls.ROW_CACHE.set_many(raw_lines_dict)
+            raw_lines_dict.update(cached)
+            locations = {}
+
+        if ordered:
+            # 按传入主键的顺序返回
+            keys = [pk for pk in dict.fromkeys(pk_list) if pk in raw_lines_dict]
+        else:
+            keys = raw_lines_dict.keys()
+        for key in keys:
+            result[key] = cls.load_instance(raw_lines_dict[key], only, locations.get(key, ()))
+        if with_large:
+            cls.load_large_many(list(result.values()))
 
         return result
 
     @classmethod
-    def get(cls, pk: str = '', pk_name: str = ''):
+    def get(cls, pk: str = '', pk_name: str = '', only: List[str] = [], with_large: bool = False):
 
         if not pk:
             print("no pk")
             return
-        return cls.get_by_pks([pk, ], pk_name=pk_name).get(pk)
+        return cls.get_by_pks([pk, ], pk_name=pk_name, only=only, with_large=with_large).get(pk)
 
     @classmethod
-    def find_index(cls, query_fields):
-        # 按查询条件匹配最长的索引（没有范围选择）
-        index_fields = []
-        max_length = 0
-
+    def plan_index(cls, query_fields, order_field: str = '') -> Optional[IndexPlan]:
+        # 按查询条件选择得分最高的索引
+        # 得分: 唯一索引点查 > 等值前缀长度 > 一个范围列 > 可以按索引顺序排序
         if not cls.indexes:
-            return index_fields
+            return None
+        plans = plan_index(cls.indexes, tuple(query_fields), order_field or cls.PK_NAME)
+        return plans[0] if plans else None
 
-        for index_obj in cls.indexes:
-
-            for max_len, field in enumerate(index_obj.field_list):
-                if field not in query_fields:
-                    if max_len > max_length:
-                        max_length = max_len
-                        index_fields = index_obj.field_list
-                        max_len = -1
-                    break
-
-            if max_len > 0:
-                if not index_fields:
-                    index_fields = index_obj.field_list
-                else:
-                    if max_len > max_length:
-                        index_fields = index_obj.field_list
-
-        return index_fields
+    @classmethod
+    def find_index(cls, query_fields, order_field: str = ''):
+        # 兼容旧接口。 返回选中索引的字段
+        plan = cls.plan_index(query_fields, order_field)
+        if not plan:
+            return []
+        return plan.fields
 
     @classmethod
-    def get_page_items(cls, **filter) -> list:
-        # 根据查询条件分页获取数据
-        #filter 里需要有
-        # cursor: int = 0
-        # limit: int = 10
-        # desc: bool = True
+    def explain_plan(cls, **filter) -> dict:
+        # 查看查询条件选择的索引 和每个索引的得分
+        query = normalize_query(cls.filter_query(filter))
+        order_by = cls.get_order_by(filter)
+        order_field = parse_order(order_by, cls.PK_NAME)[0][0] if order_by else cls.PK_NAME
+        plans = plan_index(cls.indexes, tuple(query), order_field)
+        return {
+            'query_keys': list(query),
+            'index': plans[0].to_dict() if plans else None,
+            'candidates': [plan.to_dict() for plan in plans],
+            'sql': cls.compile(**filter).select_sql,
+        }
 
-        result = []
+    @classmethod
+    def filter_query(cls, filter: dict) -> dict:
+        # 只保留做了字段映射的查询条件
         query = {}
         for field, value in filter.items():
             # 支持运算符
             if '__' in field:
-                f, _ = field.split('__')
+                f, _ = split_key(field)
                 if f not in cls.QUERY_FIELDS:
                     continue
                 else:
@@ -470,13 +1084,163 @@ class MysqlBaseModel(BaseModel):
                 continue
             else:
                 query[field] = value
+        return query
+
+    @classmethod
+    def compile_filter(cls, filter: dict):
+        # 映射字段过滤和索引选择 按查询形状(条件key的集合)缓存
+        # 返回 查询条件, 索引字段
+        # 排序影响索引选择 也是形状的一部分
+        order_by = tuple(cls.get_order_by(filter))
+        shape = (tuple(sorted(filter)), order_by)
+        plan = cls.PLAN_CACHE.get(shape)
+        if plan is None:
+            query_keys = tuple(cls.filter_query(dict.fromkeys(shape[0])))
+            order_field = parse_order(order_by, cls.PK_NAME)[0][0] if order_by else ''
+            index_fields = tuple(cls.find_index(normalize_query(dict.fromkeys(query_keys, True)), order_field))
+            plan = cls.PLAN_CACHE[shape] = (query_keys, index_fields)
+
+        query_keys, index_fields = plan
+        return {key: filter[key] for key in query_keys}, list(index_fields)
+
+    @classmethod
+    def get_order_by(cls, filter: dict) -> List[str]:
+        # 排序只支持做了字段映射的列和主键
+        order_by = []
+        for field in filter.get('order_by') or []:
+            column = field.lstrip('-+')
+            if column not in cls.QUERY_FIELDS and column not in ('id', cls.PK_NAME):
+                print(f'{cls.__name__} order by field:{column} not mapped')
+                continue
+            order_by.append(field)
+        return order_by
 
-        # 是否命中索引
-        index_fields = cls.find_index(filter)
+    @classmethod
+    def get_only(cls, only: List[str]) -> List[str]:
+        # 只加载的字段必须是模型定义的字段。 字段名会拼进SQL
+        result = []
+        for name in only:
+            if name not in cls.fields:
+                print(f'{cls.__name__} only field:{name} not defined')
+                continue
+            result.append(name)
+        return result
 
-        cursor = int(filter.get('cursor', 0))
+    @classmethod
+    def page_options(cls, filter: dict):
+        # 分页参数。 返回 cursor, limit, desc, only, order_by
+        order_by = cls.get_order_by(filter)
+        cursor = filter.get('cursor') or 0
+        if not order_by:
+            cursor = int(cursor)
         limit = int(filter.get('limit', 10))
         desc = bool(filter.get('desc', True))
+        only = cls.get_only(filter.get('only') or [])
+        if only and order_by:
+            # 生成游标需要排序列的值
+            only += [column for column, _ in parse_order(order_by, cls.PK_NAME)
+                     if column != 'id' and column not in only]
+        return cursor, limit, desc, only, order_by
+
+    @classmethod
+    def make_cursor(cls, instance: 'MysqlBaseModel', order_by: List[str] = []):
+        # 下一页的游标。 没有 order_by 时就是主键
+        # 有 order_by 时是 (排序列的值, 主键) 编码后的字符串
+        if not order_by:
+            return instance.id
+        db_dict = instance.to_db()
+        values = []
+        for column, _ in parse_order(order_by, cls.PK_NAME):
+            values.append(instance.id if column == 'id' else db_dict.get(column))
+        return encode_cursor(values)
+
+    @classmethod
+    def compile(cls, **filter) -> CompiledQuery:
+        # 查询条件编译后的SQL。 用于查看实际执行的语句
+        query, index_fields = cls.compile_filter(filter)
+        query = normalize_query(query)
+        cursor, _, desc, only, order_by = cls.page_options(filter)
+        orders = parse_order(order_by, cls.PK_NAME, desc) if order_by else ()
+        return compile_query(cls.TABLE_NAME, tuple(sorted(query)), tuple(index_fields), desc, cls.PK_NAME,
+                             bool(cursor), tuple(only), orders)
+
+    @classmethod
+    def explain_target(cls, query: dict, index_fields: list, cursor, limit: int, desc: bool, only: list, order_by: list):
+        # 开启 query_advisor 时 每种查询形状第一次执行 返回要 EXPLAIN 的 sql, 参数, 条件key
+        # 不需要时返回 None
+        if not query_advisor.enabled or cls.multi_table():
+            # 分片、分区模型的表名由数据决定 不做 EXPLAIN
+            return None
+        plan, query, values = page_plan(cls.TABLE_NAME, query, cursor, desc, cls.PK_NAME, index_fields, only, order_by)
+        if not plan or not query_advisor.claim(cls.__name__, plan.select_sql):
+            return None
+        return plan.select_sql, plan.bind(query, values, limit), list(query)
+
+    @classmethod
+    def record_explain(cls, target: tuple, order_by: list, rows: list):
+        # 记录 EXPLAIN 结果
+        sql, _, query_keys = target
+        if not rows:
+            query_advisor.release(cls.__name__, sql)
+            return
+        order_field = parse_order(order_by, cls.PK_NAME)[0][0] if order_by else cls.PK_NAME
+        try:
+            query_advisor.record(cls, sql, query_keys, order_field, rows[0][0])
+        except Exception as e:
+            query_advisor.release(cls.__name__, sql)
+            print(f'{cls.__name__} record explain error:{e}')
+
+    @classmethod
+    def get_page_items(cls, **filter) -> list:
+        # 根据查询条件分页获取数据
+        #filter 里需要有
+        # cursor: int = 0
+        # limit: int = 10
+        # desc: bool = True
+        # only: list = [] 只加载部分字段
+        # order_by: list = [] 按映射列排序 ['-update_time']。 cursor 用 make_cursor 生成
+        # deferred: bool = DEFERRED_PAGE 先取一页主键 再用 get_by_pks 取数据
+
+        result = []
+        query, index_fields = cls.compile_filter(filter)
+        cursor, limit, desc, only, order_by = cls.page_options(filter)
+
+        target = cls.explain_target(query, index_fields, cursor, limit, desc, only, order_by)
+        if target:
+            try:
+                rows = cls.conn.raw_query(cls.DB_NAME, f'explain format=json {target[0]}', target[1], read=True)
+                cls.record_explain(target, order_by, rows)
+            except Exception as e:
+                query_advisor.release(cls.__name__, target[0])
+                print(f'{cls.__name__} explain error:{e}')
+
+        if cls.PARTITION:
+            cls.partition_suffixes()
+        if cls.PARTITION and cls.partition_ordered(order_by):
+            # 从新到旧(正序时从旧到新)逐个分区查询 取满 limit 就停止
+            for location in cls.partition_page_locations(query, cursor, desc, order_by):
+                items = cls.conn.query(*location, query, cursor=cursor, limit=limit - len(result), desc=desc,
+                                       pk_name=cls.PK_NAME, index_fields=index_fields, only=only, order_by=order_by)
+                result += [cls.load_instance(item, only, location) for item in items]
+                if len(result) >= limit:
+                    break
+            return result
+
+        if cls.multi_table():
+            # 每个分片用同一个游标取一页 合并后取前 limit 条
+            def work(location):
+                items = cls.conn.query(*location, query, cursor=cursor, limit=limit, desc=desc, pk_name=cls.PK_NAME,
+                                       index_fields=index_fields, only=only, order_by=order_by)
+                return [cls.load_instance(item, only, location) for item in items]
+
+            groups = map_shards(work, cls.shard_query(query))
+            return merge_items(groups, cls.page_orders(desc, order_by), limit)
+
+        if filter.get('deferred', cls.DEFERRED_PAGE):
+            # 先用索引取一页主键 再按主键取数据, 可以命中行缓存
+            pks = cls.conn.query_ids(cls.DB_NAME, cls.TABLE_NAME, query, cursor=cursor, limit=limit, desc=desc,
+                                     pk_name=cls.PK_NAME, index_fields=index_fields, order_by=order_by)
+            return list(cls.get_by_pks(pks, pk_name='id', ordered=True, only=only).values())
 
         items = cls.conn.query(cls.DB_NAME,
                                cls.TABLE_NAME,
@@ -485,59 +1249,341 @@ class MysqlBaseModel(BaseModel):
                                limit=limit,
                                desc=desc,
                                pk_name=cls.PK_NAME,
-                               index_fields=index_fields
+                               index_fields=index_fields,
+                               only=only,
+                               order_by=order_by,
                                )
 
         for item in items:
-            pk = item['pk']
-            obj = cls()
-            obj.to_python(item)
-            obj.id = pk
-            result.append(obj)
+            result.append(cls.load_instance(item, only))
 
         return result
 
     @classmethod
     def get_query_count(cls, **filter) -> int:
         count = 0
-        query = {}
-        for field, value in filter.items():
-            # 支持运算符
-            if '__' in field:
-                f, _ = field.split('__')
-                if f not in cls.QUERY_FIELDS:
-                    continue
-                else:
-                    query[field] = value
-            elif field not in cls.QUERY_FIELDS:
-                continue
-            else:
-                query[field] = value
-        # 是否命中索引
-        index_fields = cls.find_index(filter)
+        query, index_fields = cls.compile_filter(filter)
+
+        if cls.PARTITION:
+            cls.partition_suffixes()
+        if cls.multi_table():
+            counts = map_shards(lambda location: cls.conn.query_count(*location, query, index_fields=index_fields),
+                                cls.shard_query(query))
+            return sum(counts)
 
         count = cls.conn.query_count(cls.DB_NAME, cls.TABLE_NAME, query,index_fields=index_fields)
         return count
 
     @classmethod
-    def raw_query(cls, sql: str):
+    def aggregate_options(cls, group_by: List[str], kwargs: dict):
+        # 拆分聚合、查询条件和排序。 返回 聚合, 查询条件, 排序 ; 字段没有映射时返回 None, None, None
+        aggregates = {}
+        filter = {}
+        for key, value in kwargs.items():
+            if isinstance(value, Aggregate):
+                aggregates[key] = value
+            else:
+                filter[key] = value
+
+        # 只有 COUNT 可以用 *
+        no_field = [alias for alias, agg in aggregates.items()
+                    if not agg.field or (agg.field == '*' and (not isinstance(agg, Count) or agg.distinct))]
+        if no_field:
+            print(f'{cls.__name__} aggregate:{no_field} need field')
+            return None, None, None
+
+        fields = list(group_by) + [agg.field for agg in aggregates.values() if agg.field != '*']
+        not_mapped = [field for field in fields if field not in cls.QUERY_FIELDS and field != 'id']
+        if not_mapped:
+            print(f'{cls.__name__} aggregate fields:{not_mapped} not mapped')
+            return None, None, None
+
+        # 排序只能是分组字段或者聚合的别名
+        order_by = []
+        for field in filter.pop('order_by', None) or []:
+            if field.lstrip('-+') not in list(group_by) + list(aggregates):
+                print(f'{cls.__name__} aggregate order by field:{field} not selected')
+                continue
+            order_by.append(field)
+        return aggregates, filter, order_by
 
-        result = cls.conn.raw_query(cls.DB_NAME, sql)
-        return result
+    @classmethod
+    def aggregate(cls, **kwargs) -> dict:
+        # 聚合 没有分组 返回一个 dict
+        # App.aggregate(total=Sum('amount'), num=Count(), status=1)
+        if cls.multi_table():
+            print(f'{cls.__name__} aggregate not supported on multi table model')
+            return {}
+        aggregates, filter, _ = cls.aggregate_options([], kwargs)
+        if not aggregates:
+            return {}
+        query, index_fields = cls.compile_filter(filter)
+        items = cls.conn.aggregate(cls.DB_NAME, cls.TABLE_NAME, query, aggregates, index_fields=index_fields)
+        return items[0] if items else {}
 
     @classmethod
-    def objects(cls):
-        # 遍历所有对象
-        cursor = 0
-        num = 100
-        while 1:
-            items = cls.get_page_items(cursor=cursor, limit=num)
-            for item in items:
-                yield item
-            if len(items) < num:
+    def group_by(cls, fields: List[str], **kwargs) -> List[dict]:
+        # 分组聚合 每组返回一个 dict
+        # App.group_by(['status'], num=Count(), order_by=['-num'], limit=10, user_id=1)
+        if cls.multi_table():
+            print(f'{cls.__name__} group by not supported on multi table model')
+            return []
+        aggregates, filter, order_by = cls.aggregate_options(fields, kwargs)
+        if aggregates is None:
+            return []
+        query, index_fields = cls.compile_filter(filter)
+        return cls.conn.aggregate(cls.DB_NAME, cls.TABLE_NAME, query, aggregates,
+                                  group_by=fields,
+                                  index_fields=index_fields,
+                                  order_by=order_by,
+                                  limit=int(filter.get('limit', 0)))
+
+    @classmethod
+    def exists(cls, **filter) -> bool:
+        # 是否有满足条件的数据。 比 get_query_count 便宜, 找到一行就停止
+        query, index_fields = cls.compile_filter(filter)
+        if cls.PARTITION:
+            cls.partition_suffixes()
+        if cls.multi_table():
+            return any(map_shards(lambda location: cls.conn.exists(*location, query, index_fields=index_fields),
+                                  cls.shard_query(query)))
+        return cls.conn.exists(cls.DB_NAME, cls.TABLE_NAME, query, index_fields=index_fields)
+
+    @classmethod
+    def get_approx_count(cls, **filter) -> int:
+        # 估算的数量。 不扫描数据 只适合展示量级
+        query, index_fields = cls.compile_filter(filter)
+        if cls.PARTITION:
+            cls.partition_suffixes()
+        if cls.multi_table():
+            return sum(map_shards(lambda location: cls.conn.estimate_count(*location, query, index_fields=index_fields),
+                                  cls.shard_query(query)))
+        return cls.conn.estimate_count(cls.DB_NAME, cls.TABLE_NAME, query, index_fields=index_fields)
+
+    @classmethod
+    def count_cache_key(cls, filter: dict):
+        # 按编译后的计数SQL和参数缓存
+        query, index_fields = cls.compile_filter(filter)
+        plan, query = where_plan(cls.TABLE_NAME, query, index_fields)
+        key = (plan.count_sql, tuple(plan.bind_where(query)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    @classmethod
+    def get_count_cache(cls, key) -> Optional[int]:
+        item = cls.COUNT_CACHE.get(key) if key else None
+        if item and item[0] > time.time():
+            return item[1]
+        return None
+
+    @classmethod
+    def set_count_cache(cls, key, count: int, ttl: int = 0):
+        ttl = ttl or cls.COUNT_CACHE_TTL
+        if not key or ttl <= 0:
+            return
+        if len(cls.COUNT_CACHE) >= cls.COUNT_CACHE_SIZE:
+            cls.COUNT_CACHE.clear()
+        cls.COUNT_CACHE[key] = (time.time() + ttl, count)
+
+    @classmethod
+    def get_cached_count(cls, ttl: int = 0, **filter) -> int:
+        # 精确数量 缓存 ttl 秒(默认 COUNT_CACHE_TTL)
+        key = cls.count_cache_key(filter)
+        count = cls.get_count_cache(key)
+        if count is None:
+            count = cls.get_query_count(**filter)
+            cls.set_count_cache(key, count, ttl)
+        return count
+
+    @classmethod
+    def get_page_with_count(cls, **filter):
+        # 分页数据和总数 一次查询。 返回 [对象], 总数
+        # 参数同 get_page_items
+        if cls.multi_table():
+            # 多个表不能一次查询 分别取分页和总数
+            return cls.get_page_items(**filter), cls.get_query_count(**filter)
+        result = []
+        query, index_fields = cls.compile_filter(filter)
+        cursor, limit, desc, only, order_by = cls.page_options(filter)
+
+        items, total = cls.conn.query_with_count(cls.DB_NAME,
+                                                 cls.TABLE_NAME,
+                                                 query,
+                                                 cursor=cursor,
+                                                 limit=limit,
+                                                 desc=desc,
+                                                 pk_name=cls.PK_NAME,
+                                                 index_fields=index_fields,
+                                                 only=only,
+                                                 order_by=order_by,
+                                                 )
+        for item in items:
+            result.append(cls.load_instance(item, only))
+
+        # 顺便更新计数缓存
+        cls.set_count_cache(cls.count_cache_key(filter), total)
+        return result, total
+
+    @classmethod
+    def get_update_values(cls, values: dict):
+        # 批量修改的参数。 借用一个临时实例做类型转换
+        # 自动更新 update_time, 版本号交给SQL计算
+        instance = cls()
+        for attr, value in values.items():
+            if attr not in cls.fields:
+                print(f'{cls.__name__} no field:{attr}')
+                continue
+            if cls.fields[attr].large:
+                print(f'{cls.__name__} large field:{attr} can not update by filter')
+                continue
+            setattr(instance, attr, value)
+        if 'update_time' in cls.fields and 'update_time' not in values:
+            instance.update_time = int(time.time() * 1000)
+
+        set_dict, _ = instance.get_changes()
+        version_field = ''
+        if 'dver' in cls.fields:
+            version_field = 'dver'
+            set_dict.pop(('dver',), None)
+        return set_dict, version_field
+
+    @classmethod
+    def update_where(cls, values: dict, chunk_size: int = 0, **filter) -> int:
+        # 按条件批量修改。 一条 update 语句, 返回影响行数
+        # chunk_size > 0 时按主键区间分段执行
+        query, index_fields = cls.compile_filter(filter)
+        if not query:
+            print('no query condition can not update')
+            return 0
+        set_dict, version_field = cls.get_update_values(values)
+
+        def work(location):
+            return cls.conn.update_where(*location,
+                                         set_dict,
+                                         query,
+                                         index_fields=index_fields,
+                                         version_field=version_field,
+                                         chunk_size=chunk_size)
+
+        if cls.PARTITION:
+            cls.partition_suffixes()
+        count = sum(map_shards(work, cls.shard_query(query)))
+        # 分片的写在工作线程里执行 读写路由在这里记录
+        mark_write()
+        cls.evict_rows()
+        return count
+
+    @classmethod
+    def delete_where(cls, chunk_size: int = 0, **filter) -> int:
+        # 按条件批量删除。 返回影响行数
+        query, index_fields = cls.compile_filter(filter)
+        if not query:
+            print('no query condition can not delete')
+            return 0
+
+        def work(location):
+            if cls.LARGE_FIELDS:
+                return cls.delete_where_pks(location, query, index_fields, chunk_size)
+            return cls.conn.delete_where(*location, query, index_fields=index_fields, chunk_size=chunk_size)
+
+        if cls.PARTITION:
+            cls.partition_suffixes()
+        count = sum(map_shards(work, cls.shard_query(query)))
+        # 分片的写在工作线程里执行 读写路由在这里记录
+        mark_write()
+        cls.evict_rows()
+        return count
+
+    @classmethod
+    def delete_where_pks(cls, location: tuple, query: dict, index_fields: list, chunk_size: int = 0) -> int:
+        # 有大字段的模型 按条件分批取主键, 删除主表的行和旁表的大字段
+        total, cursor = 0, 0
+        limit = chunk_size or 1000
+        while True:
+            with use_primary():
+                pks = cls.conn.query_ids(*location, query, cursor=cursor, limit=limit, desc=False,
+                                         index_fields=index_fields)
+            if not pks:
                 break
-            else:
-                cursor += num
+            total += cls.conn.delete_by_pks(*location, pks, chunk_size=limit)
+            cls.delete_large_rows(*location, pks)
+            if len(pks) < limit:
+                break
+            cursor = pks[-1]
+        return total
+
+    @classmethod
+    def delete_by_pks(cls, pk_list: list, chunk_size: int = 1000) -> int:
+        # 根据主键批量删除。 分片、分区模型按主键所在的表分组
+        def work(group):
+            (db_name, table_name), pks = group
+            count = cls.conn.delete_by_pks(db_name, table_name, pks, chunk_size=chunk_size)
+            cls.delete_large_rows(db_name, table_name, pks)
+            return count
+
+        if cls.PARTITION:
+            cls.partition_suffixes(wanted=cls.pk_partitions(pk_list))
+        count = sum(map_shards(work, cls.shard_pks(pk_list, 'id')))
+        mark_write()
+        cls.evict_rows(pk_list)
+        return count
+
+    @classmethod
+    def raw_query(cls, sql: str, args: Optional[tuple] = None):
+
+        result = cls.conn.raw_query(cls.DB_NAME, sql, args)
+        return result
+
+    @classmethod
+    def objects(cls, chunk_size: int = 100, prefetch: bool = False, server_side: bool = False, **filter):
+        # 遍历所有对象。 按主键正序, 支持 get_page_items 的查询条件
+        # 默认按上一批最后的主键翻页(id > cursor)
+        # server_side 使用服务端游标 一次查询流式读取
+        # prefetch 处理当前批次时 后台线程预取下一批。 事务中不预取, 后台线程看不到未提交的写入
+        # 分片、分区模型依次遍历每个表, 主键只在表内有序
+        query, index_fields = cls.compile_filter(filter)
+        multi = cls.multi_table()
+        if cls.PARTITION:
+            cls.partition_suffixes()
+
+        if server_side:
+            for location in cls.shard_query(query):
+                for chunk in cls.conn.stream(*location, query, index_fields=index_fields, chunk_size=chunk_size):
+                    for item in chunk:
+                        yield cls.load_instance(item, location=location if multi else ())
+            return
+
+        def fetch(location, cursor):
+            return cls.conn.query(*location,
+                                  query,
+                                  cursor=cursor,
+                                  limit=chunk_size,
+                                  desc=False,
+                                  pk_name='id',
+                                  index_fields=index_fields)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch and not in_transaction() else None
+        try:
+            for location in cls.shard_query(query):
+                items = fetch(location, 0)
+                while items:
+                    next_future = None
+                    if executor and len(items) >= chunk_size:
+                        next_future = executor.submit(fetch, location, items[-1]['pk'])
+                    for item in items:
+                        yield cls.load_instance(item, location=location if multi else ())
+                    if len(items) < chunk_size:
+                        break
+                    if next_future:
+                        items = next_future.result()
+                    else:
+                        items = fetch(location, items[-1]['pk'])
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
 
     def __getattr__(self, attr_name):
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    按月分表
+    模型上声明 PARTITION 后, 数据按时间字段写到 {TABLE_NAME}_{yyyymm}, TABLE_NAME 本身只做模板表。
+    分区表用 create table ... like 模板表 创建, 自增 id 从 yyyymm * ID_STEP 开始, 所以主键就能确定分区,
+    get_by_pks / delete / 游标翻页都不需要额外信息。
+    get_page_items 按时间条件只查有交集的分区, 按 id 或分区字段排序时从新到旧依次查询, 取满 limit 就停止。
+    过期数据 drop_partitions(keep) 直接删表。
+
+    用法:
+        class Event(MysqlBaseModel):
+            PARTITION = MonthPartition('create_time')
+            create_time = DateTimeField(column_mapping=True)
+'''
+
+import time
+from datetime import datetime
+from typing import List
+
+from mbase.db.query import split_key
+
+
+# 分区表自增 id 的起点 yyyymm * ID_STEP。 每个月最多 ID_STEP 行
+ID_STEP = 10 ** 10
+
+PARTITION_TABLES_SQL = ('select TABLE_NAME from information_schema.TABLES '
+                        'where TABLE_SCHEMA = database() and TABLE_NAME like %s')
+
+
+def ms_value(value) -> int:
+    # 毫秒时间戳。 和 DateTimeField 一致
+    if isinstance(value, datetime):
+        return int(time.mktime(value.timetuple()) * 1000)
+    return int(value)
+
+
+def month_suffix(value) -> str:
+    return time.strftime('%Y%m', time.localtime(ms_value(value) / 1000))
+
+
+def shift_month(suffix: str, months: int) -> str:
+    # 202601 往前/往后 months 个月
+    index = int(suffix[:4]) * 12 + int(suffix[4:]) - 1 + months
+    return f'{index // 12:04d}{index % 12 + 1:02d}'
+
+
+class MonthPartition(object):
+
+    def __init__(self, field: str = 'create_time'):
+        self.field = field
+
+    def table_name(self, base_table: str, suffix: str) -> str:
+        return f'{base_table}_{suffix}'
+
+    def suffix(self, value) -> str:
+        return month_suffix(value)
+
+    def current(self) -> str:
+        # 当前月份的分区
+        return month_suffix(time.time() * 1000)
+
+    def pk_suffix(self, pk) -> str:
+        # 主键所在的分区。 不是分区表的 id 返回空
+        try:
+            suffix = str(int(pk) // ID_STEP)
+        except (TypeError, ValueError):
+            return ''
+        return suffix if len(suffix) == 6 else ''
+
+    def first_id(self, suffix: str) -> int:
+        return int(suffix) * ID_STEP
+
+    def create_sqls(self, base_table: str, suffix: str) -> List[str]:
+        # 按模板表建分区表 并设置自增起点
+        table_name = self.table_name(base_table, suffix)
+        return [
+            f'create table if not exists {table_name} like {base_table}',
+            f'alter table {table_name} auto_increment = {self.first_id(suffix)}',
+        ]
+
+    def parse_tables(self, base_table: str, table_names: List[str]) -> List[str]:
+        # 库里的表名 -> 分区月份 从旧到新
+        prefix = f'{base_table}_'
+        suffixes = []
+        for table_name in table_names:
+            suffix = table_name[len(prefix):]
+            if table_name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+                suffixes.append(suffix)
+        return sorted(suffixes)
+
+    def bounds(self, query: dict) -> tuple:
+        # 查询条件里分区字段的范围 (最早月份, 最晚月份)。 没有限制的一边是空
+        lower, upper = '', ''
+        for key, value in query.items():
+            column, op = split_key(key)
+            if column != self.field:
+                continue
+            if op == '':
+                low = high = self.suffix(value)
+            elif op in ('gt', 'gte'):
+                low, high = self.suffix(value), ''
+            elif op in ('lt', 'lte'):
+                low, high = '', self.suffix(value)
+            elif op == 'between':
+                low, high = self.suffix(value[0]), self.suffix(value[1])
+            elif op == 'in' and value:
+                suffixes = [self.suffix(item) for item in value]
+                low, high = min(suffixes), max(suffixes)
+            else:
+                continue
+            if low and (not lower or low > lower):
+                lower = low
+            if high and (not upper or high < upper):
+                upper = high
+        return lower, upper
+
+    def select(self, suffixes: List[str], query: dict, desc: bool = True) -> List[str]:
+        # 和查询条件有交集的分区。 desc 从新到旧
+        lower, upper = self.bounds(query)
+        selected = [suffix for suffix in suffixes
+                    if (not lower or suffix >= lower) and (not upper or suffix <= upper)]
+        return sorted(selected, reverse=desc)
+
+    def expired(self, suffixes: List[str], keep: int, now: float = 0) -> List[str]:
+        # 保留最近 keep 个月(包括当前月) 更早的分区
+        cutoff = shift_month(month_suffix((now or time.time()) * 1000), 1 - keep)
+        return [suffix for suffix in suffixes if suffix < cutoff]
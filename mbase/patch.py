@@ -21,7 +21,11 @@ def patch_model():
     from mbase.model import MysqlBaseModel as old_model
 
     # 需要更改的异步方法
-    attrs = ['save', 'delete', 'get_by_pks', 'get', 'get_page_items', 'get_query_count']
+    attrs = ['save', 'delete', 'bulk_create', 'get_by_pks', 'get', 'get_page_items', 'get_query_count',
+             'update_where', 'delete_where', 'delete_where_pks', 'delete_by_pks', 'objects',
+             'exists', 'get_approx_count', 'get_cached_count', 'get_page_with_count', 'aggregate', 'group_by',
+             'atomic', 'locate_partition', 'partition_suffixes', 'create_partition', 'drop_partitions',
+             'save_large', 'delete_large_rows', 'load_large', 'access_large', 'load_large_many']
 
     for attr in attrs:
 
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    水平分片
+    模型上声明 SHARD 后, save / get_by_pks / delete 按分片键路由到对应的 (DB_NAME, TABLE_NAME),
+    get_page_items / get_query_count 并发查询所有分片再合并。
+
+    用法:
+        class App(MysqlBaseModel):
+            SHARD = HashShard('user_id', [('db0', 'app'), ('db1', 'app')])
+            user_id = IntField(column_mapping=True)
+
+    分片键的值保存后不能修改。 按 id 分片时 id 要在保存前生成;
+    按其他字段分片并使用自增 id 时, 各分片要配置不同的 auto_increment_offset 避免 id 重复。
+'''
+
+import asyncio
+import bisect
+import contextvars
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from mbase.db.transaction import in_transaction
+
+
+class Shard(ABC):
+    # shards 每个分片的 (DB_NAME, TABLE_NAME)。 子类实现 index 确定值所在的分片
+
+    def __init__(self, field: str = 'id', shards: List[tuple] = []):
+        self.field = field
+        self.shards = [tuple(shard) for shard in shards]
+
+    @abstractmethod
+    def index(self, value) -> int:
+        # 值所在分片的下标
+        pass
+
+    def locate(self, value) -> tuple:
+        return self.shards[self.index(value)]
+
+    def group(self, values: list) -> dict:
+        # 按分片分组 {(DB_NAME, TABLE_NAME): [value, ...]}
+        groups = {}
+        for value in values:
+            groups.setdefault(self.locate(value), []).append(value)
+        return groups
+
+    def locate_query(self, query: dict) -> List[tuple]:
+        # 查询条件里有分片键的等值或 in 条件时 只查相关的分片
+        if self.field in query:
+            return [self.locate(query[self.field])]
+        key = f'{self.field}__in'
+        if key in query:
+            return list(self.group(list(query[key])))
+        return list(self.shards)
+
+
+class HashShard(Shard):
+    # 整数取模, 其他值按 crc32 取模
+
+    def index(self, value) -> int:
+        if isinstance(value, str) and value.isdigit():
+            value = int(value)
+        if isinstance(value, int):
+            return value % len(self.shards)
+        return zlib.crc32(str(value).encode('utf-8')) % len(self.shards)
+
+
+class RangeShard(Shard):
+    # bounds 分片的上界(不含), 比分片数少一个。 最后一个分片没有上界
+    # RangeShard('id', [('db0', 'app'), ('db1', 'app')], bounds=[10000000])
+
+    def __init__(self, field: str = 'id', shards: List[tuple] = [], bounds: list = []):
+        super().__init__(field, shards)
+        if len(bounds) != len(self.shards) - 1:
+            print(f'range shard bounds:{len(bounds)} not match shards:{len(self.shards)}')
+        self.bounds = list(bounds)
+
+    def index(self, value) -> int:
+        if isinstance(value, str) and value.isdigit():
+            value = int(value)
+        return min(bisect.bisect_right(self.bounds, value), len(self.shards) - 1)
+
+
+def map_shards(work, locations: list) -> list:
+    # 并发在每个分片上执行 work(location)。 复制 contextvars 保证读写路由一致
+    # 事务中依次执行, 其他线程拿不到事务的连接
+    # 工作线程里的 mark_write 不会回到调用方, 写操作要在调用方再 mark_write
+    if len(locations) <= 1 or in_transaction():
+        return [work(location) for location in locations]
+    with ThreadPoolExecutor(max_workers=len(locations)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, work, location) for location in locations]
+        return [future.result() for future in futures]
+
+
+async def amap_shards(work, locations: list) -> list:
+    # 异步版 map_shards。 只有一个分片时直接 await, gather 会在复制的上下文里执行
+    if len(locations) <= 1:
+        return [await work(location) for location in locations]
+    return await asyncio.gather(*[work(location) for location in locations])
+
+
+def merge_items(groups: List[list], orders: tuple, limit: int) -> list:
+    # 合并各分片已排好序的结果。 每个分片用同一个游标取 limit 条, 合并后前 limit 条就是全局的一页
+    # orders ((列, 是否倒序), ...) 和 SQL 的 order by 一致, null 正序在前 倒序在后
+    items = [item for group in groups for item in group]
+    values = {}
+    for item in items:
+        db_dict = item.to_db()
+        values[id(item)] = [item.id if column == 'id' else db_dict.get(column) for column, _ in orders]
+
+    # 多次稳定排序 从最后一列开始
+    for position in range(len(orders) - 1, -1, -1):
+        is_desc = orders[position][1]
+
+        def sort_key(item, position=position):
+            value = values[id(item)][position]
+            return (value is not None, value)
+
+        items.sort(key=sort_key, reverse=is_desc)
+    return items[:limit]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    data 列json编解码性能对比。 不需要连接数据库
+    python sample/codec_bench.py
+'''
+
+import time
+
+from mbase.db import codec
+from mbase.model import MysqlBaseModel
+from mbase.fields import IntField, StringField, DateTimeField, ListField, ObjectField
+
+
+class User(ObjectField):
+    name = StringField()
+    age = IntField()
+
+
+class Address(ObjectField):
+    name = StringField()
+    num = IntField()
+
+
+class App(MysqlBaseModel):
+    DB_NAME = 'bench'
+    TABLE_NAME = 'app'
+
+    name = StringField(column_mapping=True)
+    create_time = DateTimeField()
+    update_time = DateTimeField()
+    dver = IntField(column_mapping=True)
+    user = User()
+    address = ListField(item_class=Address)
+
+
+def make_doc(size: int = 50) -> dict:
+    app = App(name='你猜我猜')
+    app.user = User(name='hhh', age=12)
+    app.address = [Address(name=f'name_{i}', num=i) for i in range(size)]
+    app.prepare_save()
+    return app.to_db()
+
+
+def bench(codec_name: str, doc: dict, rows: int = 100, rounds: int = 50):
+    codec.set_codec(codec_name)
+    raw_rows = [codec.dumps(doc) for _ in range(rows)]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for _ in range(rows):
+            codec.dumps(doc)
+    dumps_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for raw in raw_rows:
+            codec.loads(raw)
+    loads_time = time.perf_counter() - start
+
+    # 解码结果和标准库一致
+    assert codec.loads(raw_rows[0]) == doc
+
+    total = rows * rounds
+    print(f'{codec_name:8s} dumps:{dumps_time / total * 1e6:8.2f}us/row  loads:{loads_time / total * 1e6:8.2f}us/row')
+
+
+if __name__ == '__main__':
+
+    for size in (10, 200):
+        doc = make_doc(size)
+        print(f'doc with {size} list items, {len(codec.json_dumps(doc))} bytes')
+        for codec_name in codec.CODECS:
+            bench(codec_name, doc)
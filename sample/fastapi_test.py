@@ -18,6 +18,7 @@ patch_model()
 
 from mbase.model import MysqlBaseModel
 from mbase.fields import StringField, IntField, DateTimeField
+from mbase.db.route import sticky_primary
 
 # 模型
 class App(MysqlBaseModel):
@@ -56,14 +57,16 @@ async def update_item(item_id: int, request: Request):
     print(content)
     name = content.get('name')
     print(name)
-    item = await App.get(pk=int(item_id))
-    if item and name:
-        item.name = name
-        await item.save()
+    # 配置了从库时 保存之后 5 秒内的读走主库, 保证读到刚写的数据
+    with sticky_primary(5):
         item = await App.get(pk=int(item_id))
-        return {'item_id': item.to_db()}
-    else:
-        return {'error': 'not find'}
+        if item and name:
+            item.name = name
+            await item.save()
+            item = await App.get(pk=int(item_id))
+            return {'item_id': item.to_db()}
+        else:
+            return {'error': 'not find'}
 
 
 if __name__ == "__main__":
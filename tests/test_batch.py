@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    批量读 ReadBatch。 用假连接检查合并成 UNION ALL 的路径和分片模型的单独查询
+    python -m pytest tests
+'''
+
+import json
+
+from mbase.batch import ReadBatch
+from mbase.fields import IntField, StringField
+from mbase.model import MysqlBaseModel
+from mbase.shard import HashShard
+
+
+class BatchConn(object):
+    # batch_query 按登记的顺序返回 rows 里的结果
+
+    def __init__(self, rows: dict):
+        self.rows = rows
+        self.calls = []
+
+    def batch_query(self, db_name: str, parts: list) -> dict:
+        self.calls.append((db_name, parts))
+        return {tag: self.rows.get(tag, []) for tag in range(len(parts))}
+
+
+class ShardConn(object):
+    # 分片模型单独查询 get_by_pks
+
+    def __init__(self):
+        self.calls = []
+
+    def get_by_pks(self, db_name: str, table_name: str, pks: list, pk_name: str = 'id', only: list = []) -> dict:
+        self.calls.append((db_name, table_name, list(pks)))
+        return {pk: {'pk': pk, 'user_id': pk, 'name': f'{table_name}_{pk}'} for pk in pks}
+
+
+class App(MysqlBaseModel):
+    DB_NAME = 'test'
+    TABLE_NAME = 'app'
+
+    name = StringField()
+    status = IntField(column_mapping=True)
+
+
+class Feed(MysqlBaseModel):
+    DB_NAME = 'test'
+    TABLE_NAME = 'feed'
+
+    name = StringField()
+    status = IntField(column_mapping=True)
+
+
+class ShardApp(MysqlBaseModel):
+    DB_NAME = 'test'
+    TABLE_NAME = 'shard_app'
+    SHARD = HashShard('user_id', [('db0', 'shard_app'), ('db1', 'shard_app')])
+
+    user_id = IntField(column_mapping=True)
+    name = StringField()
+
+
+def row(pk: int, **data) -> tuple:
+    return pk, json.dumps(data)
+
+
+def test_union_all_path():
+    conn = BatchConn({
+        0: [row(1, name='a', status=1)],
+        1: [row(3, name='c', status=1), row(2, name='b', status=1)],
+        2: [row(10, name='f1', status=1), row(12, name='f2', status=1)],
+    })
+    App.conn = Feed.conn = conn
+
+    batch = ReadBatch()
+    app = batch.get(App, 1)
+    apps = batch.get_by_pks(App, [2, 3], ordered=True)
+    feeds = batch.get_page_items(Feed, status=1, limit=10)
+    results = batch.execute()
+
+    # 同一个库的三个查询一次往返
+    assert len(conn.calls) == 1
+    db_name, parts = conn.calls[0]
+    assert db_name == 'test' and len(parts) == 3
+    assert app.result.id == 1 and app.result.name == 'a'
+    assert list(apps.result) == [2, 3]
+    # 分页结果按 id 倒序重新排序
+    assert [item.id for item in feeds.result] == [12, 10]
+    assert results == [app.result, apps.result, feeds.result]
+
+
+def test_missing_rows():
+    App.conn = BatchConn({})
+    batch = ReadBatch()
+    app = batch.get(App, 404)
+    apps = batch.get_by_pks(App, [405])
+    batch.execute()
+    assert app.result is None
+    assert apps.result == {}
+
+
+def test_multi_table_fallback():
+    conn = BatchConn({0: [row(1, name='a', status=1)]})
+    App.conn = conn
+    ShardApp.conn = shard_conn = ShardConn()
+
+    batch = ReadBatch()
+    app = batch.get(App, 1)
+    shard_apps = batch.get_by_pks(ShardApp, [1, 2], ordered=True)
+    batch.execute()
+
+    # 分片模型不参与合并 按分片单独查询
+    assert len(conn.calls) == 1 and len(conn.calls[0][1]) == 1
+    assert sorted(call[0] for call in shard_conn.calls) == ['db0', 'db1']
+    assert app.result.name == 'a'
+    assert [item.name for item in shard_apps.result.values()] == ['shard_app_1', 'shard_app_2']
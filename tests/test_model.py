@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    @Author  : minglei.guo
+    @Contact : minglei@skyplatanus.com
+    @Version : 1.0
+    @Time    : 2026-10-18
+
+    模型保存时的修改检测。 用记录调用的假连接, 不需要数据库
+    python -m pytest tests
+'''
+
+from mbase.fields import IntField, ListField, ObjectField, StringField
+from mbase.model import MysqlBaseModel
+
+
+class FakeConn(object):
+    # 记录调用 [(方法名, 参数)]
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args))
+            return 1
+        return call
+
+
+class Address(ObjectField):
+    name = StringField()
+    num = IntField()
+
+
+class Profile(ObjectField):
+    nick = StringField()
+
+
+class App(MysqlBaseModel):
+    DB_NAME = 'test'
+    TABLE_NAME = 'app'
+    conn = FakeConn()
+
+    name = StringField()
+    profile = Profile()
+    address = ListField(item_class=Address)
+
+
+def load_app() -> App:
+    App.conn.calls = []
+    return App.load_instance({
+        'pk': 1,
+        'name': 'app',
+        'profile': {'nick': 'n'},
+        'address': [{'name': 'a', 'num': 1}, {'name': 'b', 'num': 2}],
+    })
+
+
+def update_fields(app: App) -> dict:
+    calls = [args for name, args in app.conn.calls if name == 'update_fields']
+    assert len(calls) == 1
+    return calls[0][3]
+
+
+def test_no_change_skips_save():
+    app = load_app()
+    app.save()
+    assert app.conn.calls == []
+
+
+def test_list_item_change_writes_whole_list():
+    app = load_app()
+    app.address[0].num = 99
+    assert app.has_changed()
+    app.save()
+    set_dict = update_fields(app)
+    assert set_dict[('address',)] == [{'name': 'a', 'num': 99}, {'name': 'b', 'num': 2}]
+    # 保存后清空元素的修改记录
+    assert not app.has_changed()
+
+
+def test_list_append_uses_array_ops():
+    app = load_app()
+    app.address.append(Address(name='c', num=3))
+    app.save()
+    set_dict = update_fields(app)
+    assert set_dict[('address',)].ops == [('append', None, {'name': 'c', 'num': 3})]
+